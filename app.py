@@ -2,12 +2,19 @@
 
 import eventlet
 eventlet.monkey_patch()
+import eventlet.tpool
+import eventlet.event
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, has_request_context, url_for, send_file
 from flask_socketio import SocketIO, join_room
 from pathlib import Path
 from datetime import datetime
-import json, os, requests, re, logging
+import json, os, requests, re, logging, atexit, unicodedata, difflib, sqlite3, threading, time, sys, gzip, hashlib, csv, io, bisect, heapq, math, ipaddress, socket
+from collections import deque, OrderedDict
+from requests.adapters import HTTPAdapter
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 
 
@@ -15,10 +22,139 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+# ======================
+# Métricas (formato Prometheus en GET /metrics)
+# ======================
+# Contadores e histogramas en proceso, sin dependencias: observar es un
+# bisect + dos sumas. Con serve.py cada worker tiene sus propias series.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape_label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _label_str(names, values, extra=""):
+    parts = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+
+    def inc(self, key=(), value=1):
+        self.values[key] = self.values.get(key, 0) + value
+
+    def expose(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in sorted(self.values.items()):
+            out.append(f"{self.name}{_label_str(self.labels, key)} {v}")
+        return out
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # key -> [conteos por bucket (+Inf al final), suma]
+
+    def observe(self, key, value):
+        s = self.series.get(key)
+        if s is None:
+            s = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def expose(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self.series.items()):
+            acc = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                le_label = 'le="%s"' % le
+                out.append(f"{self.name}_bucket{_label_str(self.labels, key, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, key)} {total}")
+            out.append(f"{self.name}_count{_label_str(self.labels, key)} {acc}")
+        return out
+
+class Gauge:
+    """Valor calculado al scrapear: `fn()` devuelve un número o {labels: número}.
+
+    `kind="counter"` para exponer contadores que ya viven en otro lado.
+    """
+    def __init__(self, name, help, fn, labels=(), kind="gauge"):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help, fn, tuple(labels), kind
+
+    def expose(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception:
+            log.exception("[metrics] gauge %s", self.name)
+            return out
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        for key, v in items:
+            if v is not None:
+                out.append(f"{self.name}{_label_str(self.labels, key)} {v}")
+        return out
+
+METRICS = []
+
+def metric(m):
+    METRICS.append(m)
+    return m
+
+HTTP_LATENCY = metric(Histogram("http_request_duration_seconds", "Latencia por ruta Flask.", ("route", "method")))
+HTTP_REQUESTS = metric(Counter("http_requests_total", "Respuestas por ruta y status.", ("route", "method", "status")))
+UPSTREAM_LATENCY = metric(Histogram("upstream_request_duration_seconds", "Latencia de llamadas al upstream Realtime.", ("path",)))
+UPSTREAM_REQUESTS = metric(Counter("upstream_requests_total", "Llamadas al upstream por resultado (ok, http_4xx, http_5xx, error, rejected).", ("path", "outcome")))
+EMITS = metric(Counter("socketio_emits_total", "Emits de Socket.IO por evento.", ("event",)))
+EMIT_BYTES = metric(Counter("socketio_emit_bytes_total", "Bytes JSON emitidos por evento (estimado: 1 de cada EMIT_BYTES_SAMPLE emits, x N; 0 = apagado).", ("event",)))
+SHED = metric(Counter("requests_shed_total", "Requests rechazados por admisión (rate_limited, queue_full, queue_timeout, circuit_open, state_busy).", ("route", "reason")))
+COALESCED = metric(Counter("socketio_coalesced_total", "Emits agrupados (recommend/reset, /api/batch) por resultado (sent, suppressed = fusionado o pisado por uno posterior).", ("event", "outcome")))
+
+def render_metrics():
+    lines = []
+    for m in METRICS:
+        lines.extend(m.expose())
+    return "\n".join(lines) + "\n"
+
+# Medir bytes obliga a serializar el payload otra vez: por defecto apagado;
+# EMIT_BYTES_SAMPLE=N mide 1 de cada N emits y lo cuenta N veces.
+EMIT_BYTES_SAMPLE = int(os.getenv("EMIT_BYTES_SAMPLE") or 0)
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO que cuenta emits por evento (y bytes de payload si se muestrea)."""
+    _emitted = 0
+
+    def emit(self, event, *args, **kwargs):
+        EMITS.inc((event,))
+        if EMIT_BYTES_SAMPLE and args:
+            self._emitted += 1
+            if self._emitted % EMIT_BYTES_SAMPLE == 0:
+                try:
+                    EMIT_BYTES.inc((event,), EMIT_BYTES_SAMPLE * len(json.dumps(args[0], separators=(",", ":"))))
+                except (TypeError, ValueError):
+                    pass
+        return super().emit(event, *args, **kwargs)
+
+
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet")
+# Con varios workers, SOCKETIO_MESSAGE_QUEUE (p. ej. redis://localhost:6379/0)
+# reparte los emits entre procesos: un cart_update hecho en el worker B llega
+# al navegador conectado al worker A. Sin la variable todo queda en proceso.
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE") or None
+socketio = InstrumentedSocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode="eventlet",
+    message_queue=SOCKETIO_MESSAGE_QUEUE,
+    channel=os.getenv("SOCKETIO_CHANNEL", "flask-socketio"),
+)
 
 MENU_PATH = Path("static/menu.json")
+RESTAURANT_NAME = os.getenv("RESTAURANT_NAME") or "VUEN AI"
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("server")
@@ -27,42 +163,194 @@ log = logging.getLogger("server")
 # Helpers
 # ======================
 
-def load_menu():
-    if MENU_PATH.exists():
+def load_menu(path=MENU_PATH):
+    if path.exists():
         try:
-            return json.loads(MENU_PATH.read_text(encoding="utf-8"))
+            return json.loads(path.read_text(encoding="utf-8"))
         except Exception:
             return []
     return []
 
+def save_menu(items, path=MENU_PATH):
+    """Escritura atómica: archivo temporal en el mismo directorio + rename."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps(items, indent=2) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class MenuPayload:
+    """Menú pre-codificado para GET /api/menu: JSON, gzip y ETag por contenido."""
+    __slots__ = ("body", "gzipped", "etag", "generation")
+
+    def __init__(self, items, generation):
+        self.body = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.gzipped = gzip.compress(self.body, 9, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:20]
+        self.generation = generation
+
+def menu_price(value):
+    """Precio como float finito >= 0; ValueError si no (inf/NaN romperían el JSON de /api/menu)."""
+    try:
+        price = float(value or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid price: {value!r}") from None
+    if price < 0 or not math.isfinite(price):
+        raise ValueError(f"invalid price: {value!r}")
+    return price
+
 def normalize_menu(items):
+    """Ítems con los 5 campos; None (columna CSV faltante) cuenta como vacío. ValueError si un precio no sirve."""
     cleaned = []
     for item in (items or []):
         cleaned.append({
-            "name": str(item.get("name","")).strip(),
-            "price": float(item.get("price", 0) or 0),
-            "img_ref": str(item.get("img_ref","")).strip(),
-            "ingredients": str(item.get("ingredients","")).strip(),
-            "description": str(item.get("description","")).strip(),
+            "name": str(item.get("name") or "").strip(),
+            "price": menu_price(item.get("price")),
+            "img_ref": str(item.get("img_ref") or "").strip(),
+            "ingredients": str(item.get("ingredients") or "").strip(),
+            "description": str(item.get("description") or "").strip(),
         })
     return cleaned
 
-def build_menu_prompt(menu_items):
-    lines = []
-    for it in menu_items:
-        name = it.get("name","").strip()
-        price = it.get("price", 0)
-        desc = (it.get("description") or "").strip()
-        ingr = (it.get("ingredients") or "").strip()
-        base = f"- {name} — ${price:0.2f}"
+# ---- Importación por streaming (CSV / JSONL) ----
+MENU_FIELDS = ("name", "price", "img_ref", "ingredients", "description")
+
+def iter_import_rows(stream, fmt):
+    """Genera (nº de fila, dict) leyendo `stream` (texto) fila a fila."""
+    if fmt == "csv":
+        for n, row in enumerate(csv.DictReader(stream), start=2):
+            yield n, row
+        return
+    for n, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield n, e
+            continue
+        yield n, row
+
+def validate_import_row(row):
+    """Devuelve (item normalizado, None) o (None, mensaje de error)."""
+    if isinstance(row, Exception):
+        return None, f"invalid json: {row}"
+    if not isinstance(row, dict):
+        return None, "row must be an object"
+    name = str(row.get("name") or "").strip()
+    if not name:
+        return None, "missing name"
+    try:
+        return normalize_menu([row])[0], None
+    except ValueError as e:
+        return None, str(e)
+
+def diff_menu_import(current, rows, replace=True, max_errors=100):
+    """Compara filas importadas contra `current` sin materializar la entrada.
+
+    Devuelve (nuevo menú, reporte). Los ítems se emparejan por
+    normalize(name); el orden existente se conserva y los nuevos van al
+    final. Con replace=False los ítems ausentes se mantienen. Un replace
+    sin ninguna fila válida no borra nada: el reporte trae "error".
+    """
+    by_key = {normalize(it["name"]): i for i, it in enumerate(current)}
+    updated = {}
+    added = []
+    seen = set()
+    errors, error_count, total = [], 0, 0
+    for n, row in rows:
+        total += 1
+        item, err = validate_import_row(row)
+        if err is None:
+            key = normalize(item["name"])
+            if key in seen:
+                err = f"duplicate name: {item['name']}"
+        if err is not None:
+            error_count += 1
+            if len(errors) < max_errors:
+                errors.append({"row": n, "error": err})
+            continue
+        seen.add(key)
+        idx = by_key.get(key)
+        if idx is None:
+            added.append(item)
+        elif current[idx] != item:
+            updated[idx] = item
+        if total % 500 == 0:
+            socketio.sleep(0)  # ceder el hub en catálogos grandes
+
+    refused = replace and not seen and bool(current)
+    removed_idx = set() if not replace or refused else {i for k, i in by_key.items() if k not in seen}
+    menu = []
+    for i, it in enumerate(current):
+        if i in removed_idx:
+            continue
+        menu.append(updated.get(i, it))
+    menu.extend(added)
+    report = {
+        "rows": total,
+        "error_count": error_count,
+        "errors": errors,
+        "added": len(added),
+        "changed": len(updated),
+        "removed": len(removed_idx),
+        "added_names": [it["name"] for it in added[:100]],
+        "changed_names": [it["name"] for it in list(updated.values())[:100]],
+        "removed_names": [current[i]["name"] for i in sorted(removed_idx)[:100]],
+    }
+    if refused:
+        report["error"] = "replace with 0 valid rows would empty the menu"
+    return menu, report
+
+# Línea de prompt por ítem, memoizada: al importar/editar un menú grande solo
+# se formatean los ítems que cambiaron.
+_PROMPT_LINES = {}
+
+def menu_prompt_line(it):
+    name = it.get("name","").strip()
+    price = it.get("price", 0)
+    desc = (it.get("description") or "").strip()
+    ingr = (it.get("ingredients") or "").strip()
+    key = (name, price, desc, ingr)
+    line = _PROMPT_LINES.get(key)
+    if line is None:
+        line = f"- {name} — ${price:0.2f}"
         if desc:
-            base += f": {desc}"
+            line += f": {desc}"
         if ingr:
-            base += f" (ingredientes: {ingr})"
-        lines.append(base)
+            line += f" (ingredientes: {ingr})"
+        if len(_PROMPT_LINES) > 50000:
+            _PROMPT_LINES.clear()
+        _PROMPT_LINES[key] = line
+    return line
+
+# MENU_CONTEXT=search: las instrucciones llevan solo un resumen compacto
+# (nombre + precio de los primeros MENU_SUMMARY_ITEMS) y el detalle se
+# consulta con la tool `search_menu`, así el body de sesión no crece con el menú.
+MENU_CONTEXT = (os.getenv("MENU_CONTEXT") or "full").strip().lower()
+MENU_SUMMARY_ITEMS = int(os.getenv("MENU_SUMMARY_ITEMS") or 30)
+# Tool suggest_items (requiere ORDER_HISTORY_DB): "lo que suelen pedir con tu carrito".
+SUGGEST_TOOL_ENABLED = (os.getenv("SUGGEST_TOOL") or "").strip() in ("1", "true")
+
+def menu_summary_lines(menu_items, limit):
+    lines = [f"- {it.get('name','').strip()} — ${it.get('price', 0):0.2f}" for it in menu_items[:limit]]
+    rest = len(menu_items) - len(lines)
+    if rest > 0:
+        lines.append(f"- (+{rest} more items: use `search_menu`)")
+    return lines
+
+def build_menu_prompt(menu_items, compact=None, restaurant=None):
+    if compact is None:
+        compact = MENU_CONTEXT == "search"
+    if compact:
+        lines = menu_summary_lines(menu_items, MENU_SUMMARY_ITEMS)
+    else:
+        lines = [menu_prompt_line(it) for it in menu_items]
     ts = datetime.now().strftime("%Y-%m-%d %H:%M")
     header = [
-        "You are a realtime voice agent for a restaurant called VUEN AI.",
+        f"You are a realtime voice agent for a restaurant called {restaurant or RESTAURANT_NAME}.",
         f"Use ONLY the following official menu",
         "Recommend at most 1–3 items: name + price + a short reason.",
         "If unsure, ask. Keep answers short and conversational.",
@@ -75,6 +363,12 @@ def build_menu_prompt(menu_items):
         "- Use `get_cart` when asked for cart status, item count, or total price. Do NOT include `client_id`; the client routes it.",
         "- Use `get_order_status` to retrieve the current order flow step (0..5).",
         "- Use `transition_order_status` to change UI flow (cart/checkout/success).",
+        *([
+            "- Use `search_menu` to look up dishes by name, ingredient or description (prices, ingredients, allergies, what's available). The list below is only a summary; ALWAYS search before saying an item does not exist.",
+        ] if compact else []),
+        *([
+            "- Use `suggest_items` to get items other customers frequently ordered together with the current cart; offer at most one of them, briefly.",
+        ] if SUGGEST_TOOL_ENABLED else []),
         "",
         "IMPORTANT!! Before you call `transition_order_status`, ALWAYS call `get_order_status` to ensure the state is fresh.",
         "When you use these tools, include a short `reply` so the user hears an immediate response.",
@@ -95,6 +389,18 @@ def build_menu_prompt(menu_items):
 
 def normalize(s): return str(s or "").strip().lower()
 
+def env_int(name, default):
+    try:
+        return int(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+def env_float(name, default):
+    try:
+        return float(os.getenv(name) or default)
+    except ValueError:
+        return default
+
 def clamp_qty_allow_zero(q):
     try:
         q = int(q)
@@ -104,29 +410,464 @@ def clamp_qty_allow_zero(q):
     if q > 99: q = 99
     return q
 
-def get_menu_item_by_name(name):
-    key = normalize(name)
-    for it in MENU_CACHE:
-        if normalize(it.get("name")) == key:
-            return it
-    return None
+# ---- Índice de nombres del menú (exacto -> alias -> fuzzy acotado) ----
+# Sinónimos frecuentes que dice el modelo en español; se aplican por palabra
+# (o frase) después de quitar acentos, así que las claves van sin tildes.
+_NAME_SYNONYMS = {
+    "papas fritas": "fries",
+    "papitas": "fries",
+    "papas": "fries",
+    "hamburguesa": "burger",
+    "hamburguesas": "burger",
+    "pollo": "chicken",
+    "pescado": "fish",
+    "queso": "cheese",
+    "doble": "double",
+    "bebida": "drink",
+    "gaseosa": "drink",
+    "refresco": "drink",
+    "manzana": "apple",
+    "pastel": "pie",
+    "pay": "pie",
+    "sandwich de": "sandwich",
+    "sanduche": "sandwich",
+    "emparedado": "sandwich",
+}
+_SYNONYM_RE = re.compile(
+    r"\b(" + "|".join(sorted(map(re.escape, _NAME_SYNONYMS), key=len, reverse=True)) + r")\b"
+)
+_FUZZY_MAX_CANDIDATES = 8
+_FUZZY_CUTOFF = 0.72
+
+def fold_name(s):
+    """Clave tolerante: sin acentos, sin paréntesis/puntuación, singular."""
+    s = unicodedata.normalize("NFKD", normalize(s))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = re.sub(r"\([^)]*\)", " ", s)
+    s = re.sub(r"[^a-z0-9]+", " ", s)
+    s = _SYNONYM_RE.sub(lambda m: _NAME_SYNONYMS[m.group(1)], s)
+    words = []
+    for w in s.split():
+        if len(w) > 3 and w.endswith("es") and w[-3] in "sxz":
+            w = w[:-2]
+        elif len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        words.append(w)
+    return " ".join(words)
+
+def _trigrams(s):
+    s = f"  {s} "
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+def build_menu_index(menu_items):
+    """Construye el índice de nombres una sola vez por menú.
+
+    - exact: normalize(name) -> item
+    - alias: fold_name(name) -> item (acentos, plurales, sinónimos)
+    - grams: trigrama -> claves alias (para el fallback fuzzy)
+    - search: índice invertido de nombre/ingredientes/descripción
+    """
+    exact, alias, grams = {}, {}, {}
+    for it in menu_items:
+        exact.setdefault(normalize(it.get("name")), it)
+        key = fold_name(it.get("name"))
+        if not key or key in alias:
+            continue
+        alias[key] = it
+        for g in _trigrams(key):
+            grams.setdefault(g, []).append(key)
+    return {"exact": exact, "alias": alias, "grams": grams, "fuzzy": {},
+            "search": build_search_index(menu_items)}
+
+def _fuzzy_lookup(index, key):
+    counts = {}
+    for g in _trigrams(key):
+        for cand in index["grams"].get(g, ()):
+            counts[cand] = counts.get(cand, 0) + 1
+    if not counts:
+        return None
+    best = sorted(counts, key=counts.get, reverse=True)[:_FUZZY_MAX_CANDIDATES]
+    match = difflib.get_close_matches(key, best, n=1, cutoff=_FUZZY_CUTOFF)
+    return index["alias"][match[0]] if match else None
+
+def get_menu_item_by_name(name, snap=None):
+    index = (snap or current_tenant().snapshot).index
+    it = index["exact"].get(normalize(name))
+    if it is not None:
+        return it
+    key = fold_name(name)
+    if not key:
+        return None
+    it = index["alias"].get(key)
+    if it is not None:
+        return it
+    cache = index["fuzzy"]
+    if key not in cache:
+        # Cache acotado: se descarta entero con el índice al cambiar el menú.
+        if len(cache) >= 1024:
+            cache.clear()
+        cache[key] = _fuzzy_lookup(index, key)
+    return cache[key]
+
+# ---- Búsqueda en el menú (índice invertido para la tool search_menu) ----
+# Peso por campo: un match en el nombre pesa más que en ingredientes o descripción.
+_SEARCH_FIELDS = (("name", 3.0), ("ingredients", 2.0), ("description", 1.0))
+_SEARCH_STOPWORDS = frozenset(
+    "a al and con de del el en la las lo los of or para por the to un una with y".split()
+)
+
+def _search_tokens(s):
+    return [t for t in fold_name(s).split() if len(t) > 1 and t not in _SEARCH_STOPWORDS]
+
+def build_search_index(menu_items):
+    """token -> (lista [(peso, ítem)] de mayor a menor, {ítem: peso}) + vocabulario ordenado."""
+    rows = {}
+    for i, it in enumerate(menu_items):
+        for field, weight in _SEARCH_FIELDS:
+            for tok in set(_search_tokens(it.get(field))):
+                row = rows.setdefault(tok, {})
+                row[i] = row.get(i, 0.0) + weight
+    postings = {
+        tok: (sorted(((w, i) for i, w in row.items()), key=lambda p: (-p[0], p[1])), row)
+        for tok, row in rows.items()
+    }
+    return {"items": menu_items, "postings": postings, "vocab": sorted(postings), "planes": {}}
+
+def _prefix_tokens(search, tok, limit=16):
+    vocab = search["vocab"]
+    i = bisect.bisect_left(vocab, tok)
+    out = []
+    while i < len(vocab) and len(out) < limit and vocab[i].startswith(tok):
+        out.append(vocab[i])
+        i += 1
+    return out
+
+def _search_planes(search, tok):
+    """Pesos de `tok` como bit-planes: planes[b] tiene el bit i si el bit b
+    del peso del ítem i está prendido. Se arman al primer uso y se cachean
+    con el índice (cache acotado, como el fuzzy de nombres)."""
+    cache = search["planes"]
+    planes = cache.get(tok)
+    if planes is None:
+        row = search["postings"][tok][1]
+        nbytes = len(search["items"]) // 8 + 1
+        bufs = [bytearray(nbytes) for _ in range(int(max(row.values())).bit_length())]
+        for i, w in row.items():
+            w = int(w)
+            for b, buf in enumerate(bufs):
+                if w >> b & 1:
+                    buf[i >> 3] |= 1 << (i & 7)
+        planes = [int.from_bytes(buf, "little") for buf in bufs]
+        if len(cache) >= 4096:
+            cache.clear()
+        cache[tok] = planes
+    return planes
+
+def _add_planes(acc, planes):
+    """acc += planes, suma bit a bit en paralelo para todos los ítems (ripple-carry)."""
+    carry = 0
+    for j in range(max(len(acc), len(planes))):
+        x = acc[j] if j < len(acc) else 0
+        y = planes[j] if j < len(planes) else 0
+        s = x ^ y ^ carry
+        carry = (x & y) | (carry & (x ^ y))
+        if j < len(acc):
+            acc[j] = s
+        else:
+            acc.append(s)
+    if carry:
+        acc.append(carry)
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def search_menu_index(search, query, limit=5):
+    """Top-`limit` ítems por puntaje (suma de pesos por token).
+
+    Los tokens sin match exacto se buscan por prefijo con la mitad de peso.
+    El puntaje de todos los ítems se suma a la vez en bit-planes (enteros
+    de Python, un bit por ítem) y el top-k sale bajando del plane más alto
+    al más bajo, así el costo no depende de cuántos ítems tiene un token
+    frecuente. Empates: gana el ítem que va antes en el menú.
+    """
+    terms = []  # (token, factor); el puntaje interno va x2 para que el prefijo (x0.5) sea entero
+    for tok in _search_tokens(query):
+        if tok in search["postings"]:
+            terms.append((tok, 1.0))
+        elif len(tok) >= 3:
+            terms.extend((t, 0.5) for t in _prefix_tokens(search, tok))
+    if not terms or limit <= 0:
+        return []
+    acc = []
+    for tok, f in terms:
+        planes = _search_planes(search, tok)
+        _add_planes(acc, [0] + planes if f == 1.0 else planes)
+
+    # Selección por planes: `chosen` ya está en el top; `cand` son los que
+    # siguen empatados en todos los bits vistos hasta ahora.
+    chosen, cand = 0, 0
+    for p in acc:
+        cand |= p
+    for p in reversed(acc):
+        hi = cand & p
+        n = (chosen | hi).bit_count()
+        if n > limit:
+            cand = hi
+        else:
+            chosen |= hi
+            cand &= ~p
+            if n == limit:
+                cand = 0
+                break
+    ids = list(_bits(chosen))
+    for i in _bits(cand):
+        if len(ids) >= limit:
+            break
+        ids.append(i)
+
+    rows = [(search["postings"][tok][1], f) for tok, f in terms]
+    ids.sort(key=lambda i: (-sum(row.get(i, 0.0) * f for row, f in rows), i))
+    return [search["items"][i] for i in ids]
+
+def search_menu(query, limit=5):
+    return search_menu_index(current_tenant().snapshot.index["search"], query, limit)
+
+def search_menu_result(query, limit=None):
+    """Respuesta de la tool search_menu (HTTP y Socket.IO)."""
+    q = str(query or "").strip()
+    try:
+        limit = max(1, min(10, int(limit or 5)))
+    except (TypeError, ValueError):
+        limit = 5
+    return {"ok": True, "query": q, "items": search_menu(q, limit) if q else []}
 
-def apply_ops_to_cart(cart_items, ops):
-    if cart_items is None:
-        cart_items = []
-    items = list(cart_items)
+# ---- Carrito: líneas compactas, claves normalizadas, totales en centavos ----
+def to_cents(price):
+    try:
+        return int(round(float(price or 0) * 100))
+    except Exception:
+        return 0
 
-    def find_idx(nm):
-        k = normalize(nm)
-        for i, it in enumerate(items):
-            if normalize(it.get("name")) == k:
-                return i
-        return -1
+class CartLine:
+    # gen: generación del menú con la que se cotizó la línea (ver Cart.reprice).
+    __slots__ = ("name", "price_cents", "img_ref", "qty", "gen")
+
+    def __init__(self, name, price_cents, img_ref, qty, gen=0):
+        self.name = name
+        self.price_cents = price_cents
+        self.img_ref = img_ref
+        self.qty = qty
+        self.gen = gen
+
+    def to_dict(self):
+        return {"name": self.name, "price": self.price_cents / 100, "img_ref": self.img_ref, "qty": self.qty}
+
+CART_DELTA_LOG = env_int("CART_DELTA_LOG", 64)
+
+class Cart:
+    """Carrito de un cliente.
+
+    `lines` conserva el orden de inserción (dict) y está indexado por
+    normalize(name); `total_cents` y `count` se actualizan en cada op, así
+    que leer total/cantidad es O(1). `to_list()` produce exactamente la
+    forma JSON que esperan `cart_update` y app.js.
+
+    `cleared` guarda las líneas ([clave, qty, centavos]) del último `clear`
+    hasta que se agrega algo de nuevo: app.js vacía el carrito justo antes
+    de pasar a 5, y así el historial de pedidos aún sabe qué se compró.
+
+    `epoch` (ms de creación) identifica esta instancia: si el reaper expulsa
+    el carrito, el siguiente arranca de nuevo en version 0 con otro epoch y
+    app.js sabe que debe descartar su versión en vez de ignorar los eventos.
+
+    Cada cambio sube `version` y deja un delta compacto en `log` (acotado):
+      {"v": n, "t": "put", "line": {...}}   línea nueva o precio/imagen nuevos
+      {"v": n, "t": "qty", "name": ..., "qty": q}
+      {"v": n, "t": "del", "name": ...}
+      {"v": n, "t": "clear"}
+    """
+    __slots__ = ("lines", "total_cents", "count", "version", "log", "cleared", "epoch")
+
+    def __init__(self):
+        self.lines = {}
+        self.total_cents = 0
+        self.count = 0
+        self.version = 0
+        self.epoch = int(time.time() * 1000)
+        self.log = deque(maxlen=CART_DELTA_LOG)
+        self.cleared = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    @property
+    def total(self):
+        return self.total_cents / 100
+
+    def _record(self, delta):
+        self.version += 1
+        delta["v"] = self.version
+        self.log.append(delta)
+
+    def _set_qty(self, line, qty):
+        delta = qty - line.qty
+        line.qty = qty
+        self.count += delta
+        self.total_cents += delta * line.price_cents
+        self._record({"t": "qty", "name": line.name, "qty": qty})
+
+    def _put(self, key, mi, qty, gen):
+        line = CartLine(mi["name"], to_cents(mi.get("price")), mi.get("img_ref") or "", qty, gen)
+        self.lines[key] = line
+        self.cleared = None
+        self.count += qty
+        self.total_cents += qty * line.price_cents
+        self._record({"t": "put", "line": line.to_dict()})
+
+    def _drop(self, key):
+        line = self.lines.pop(key)
+        self.count -= line.qty
+        self.total_cents -= line.qty * line.price_cents
+        self._record({"t": "del", "name": line.name})
+
+    def add(self, key, mi, qty, gen=0):
+        line = self.lines.get(key)
+        if line is not None:
+            self._set_qty(line, line.qty + qty)
+        else:
+            self._put(key, mi, qty, gen)
+
+    def remove(self, key, qty):
+        line = self.lines.get(key)
+        if line is None:
+            return
+        if line.qty <= qty:
+            self._drop(key)
+        else:
+            self._set_qty(line, line.qty - qty)
+
+    def set(self, key, mi, qty, gen=0):
+        # `set` refresca precio/imagen desde el menú actual (sin mover la línea).
+        line = self.lines.get(key)
+        if line is None:
+            self._put(key, mi, qty, gen)
+            return
+        line.gen = gen
+        price_cents = to_cents(mi.get("price"))
+        img_ref = mi.get("img_ref") or ""
+        if price_cents == line.price_cents and img_ref == line.img_ref:
+            if qty != line.qty:
+                self._set_qty(line, qty)
+            return
+        self.total_cents += qty * price_cents - line.qty * line.price_cents
+        self.count += qty - line.qty
+        line.price_cents, line.img_ref, line.qty = price_cents, img_ref, qty
+        self._record({"t": "put", "line": line.to_dict()})
+
+    def discard(self, key):
+        if key in self.lines:
+            self._drop(key)
+
+    def stale(self, gen):
+        return any(ln.gen != gen for ln in self.lines.values())
+
+    def reprice(self, gen, items):
+        """Recotiza las líneas de otra generación con `items` (normalize(name) -> ítem).
+
+        Solo toca las líneas cuyo precio o imagen cambió (delta "put"); si el
+        ítem ya no está en el menú la línea conserva su precio."""
+        for key, line in self.lines.items():
+            if line.gen == gen:
+                continue
+            line.gen = gen
+            mi = items.get(key)
+            if mi is None:
+                continue
+            price_cents = to_cents(mi.get("price"))
+            img_ref = mi.get("img_ref") or ""
+            if price_cents == line.price_cents and img_ref == line.img_ref:
+                continue
+            self.total_cents += line.qty * (price_cents - line.price_cents)
+            line.price_cents, line.img_ref = price_cents, img_ref
+            self._record({"t": "put", "line": line.to_dict()})
+
+    def clear(self):
+        if not self.lines:
+            return
+        self.cleared = self.order_lines()
+        self.lines.clear()
+        self.total_cents = 0
+        self.count = 0
+        self._record({"t": "clear"})
+
+    def deltas_since(self, version):
+        """Deltas posteriores a `version`, o None si hace falta un snapshot."""
+        if version == self.version:
+            return []
+        if version > self.version or not self.log or self.log[0]["v"] > version + 1:
+            return None
+        return [d for d in self.log if d["v"] > version]
+
+    def to_list(self):
+        return [ln.to_dict() for ln in self.lines.values()]
+
+    def order_lines(self):
+        """[[clave, qty, centavos], ...] del carrito, o del último clear si está vacío."""
+        if self.lines:
+            return [[k, ln.qty, ln.price_cents] for k, ln in self.lines.items()]
+        return list(self.cleared or [])
+
+    def to_state(self):
+        state = {
+            "v": self.version,
+            "e": self.epoch,
+            "lines": [[k, ln.name, ln.price_cents, ln.img_ref, ln.qty, ln.gen] for k, ln in self.lines.items()],
+            "log": list(self.log),
+        }
+        if self.cleared:
+            state["cleared"] = self.cleared
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        cart = cls()
+        for key, name, price_cents, img_ref, qty, *gen in (state.get("lines") or []):
+            line = CartLine(name, int(price_cents), img_ref, int(qty), int(gen[0]) if gen else 0)
+            cart.lines[key] = line
+            cart.count += line.qty
+            cart.total_cents += line.qty * line.price_cents
+        cart.version = int(state.get("v") or 0)
+        cart.epoch = int(state.get("e") or 0)
+        cart.log.extend(state.get("log") or [])
+        cart.cleared = state.get("cleared") or None
+        return cart
+
+def invalid_ops(ops):
+    """Mensaje de error si `ops` no es una lista de objetos; None si sirve."""
+    if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+        return "ops must be a list of objects"
+    return None
+
+def apply_ops_to_cart(cart, ops, snap=None):
+    """Aplica `ops` sobre `cart` (Cart) en sitio con el menú `snap` (por
+    defecto el vigente del tenant) y lo devuelve. Antes recotiza las líneas
+    que se cotizaron con otra generación del menú."""
+    if cart is None:
+        cart = Cart()
+    snap = snap or current_tenant().snapshot
+    gen = snap.generation
+    cart.reprice(gen, snap.index["exact"])
 
     for op in (ops or []):
         kind = normalize(op.get("op"))
         if kind == "clear":
-            items = []
+            cart.clear()
             continue
 
         name = (op.get("name") or "").strip()
@@ -134,78 +875,1678 @@ def apply_ops_to_cart(cart_items, ops):
             continue
 
         qty = clamp_qty_allow_zero(op.get("qty", 1))
-        idx = find_idx(name)
+        mi = get_menu_item_by_name(name, snap)
+        key = normalize(mi["name"] if mi else name)
 
         if kind == "add":
             if qty <= 0: qty = 1
-            mi = get_menu_item_by_name(name)
             if not mi:
                 continue
-            if idx >= 0:
-                items[idx]["qty"] = int(items[idx].get("qty", 0)) + qty
-            else:
-                items.append({
-                    "name": mi["name"],
-                    "price": float(mi.get("price") or 0),
-                    "img_ref": mi.get("img_ref") or "",
-                    "qty": qty
-                })
+            cart.add(key, mi, qty, gen)
 
         elif kind == "remove":
             if qty <= 0: qty = 1
-            if idx < 0:
-                continue
-            cur = int(items[idx].get("qty", 1))
-            if cur <= qty:
-                items.pop(idx)
-            else:
-                items[idx]["qty"] = cur - qty
+            cart.remove(key, qty)
 
         elif kind == "set":
             if qty <= 0:
-                if idx >= 0:
-                    items.pop(idx)
+                cart.discard(key)
                 continue
-            mi = get_menu_item_by_name(name)
             if not mi:
                 continue
-            if idx >= 0:
-                items[idx]["qty"] = qty
-                items[idx]["price"] = float(mi.get("price") or 0)
-                items[idx]["img_ref"] = mi.get("img_ref") or ""
-            else:
-                items.append({
-                    "name": mi["name"],
-                    "price": float(mi.get("price") or 0),
-                    "img_ref": mi.get("img_ref") or "",
-                    "qty": qty
-                })
-
-    return items
-
-def cart_total(items):
-    t = 0.0
-    for it in (items or []):
+            cart.set(key, mi, qty, gen)
+
+    return cart
+
+def cart_total(cart):
+    return round(cart.total, 2) if cart else 0.0
+
+# ======================
+# State store
+# ======================
+# CARTS / ORDER_STATUS / CHECKOUT_PREFILL se exponen como mapas; el backend
+# decide dónde viven. Toda lectura-modificación-escritura por cliente va
+# dentro de `STATE.transaction(client_id)`, que además marca al cliente como
+# activo (`touch`) para la expulsión por TTL/LRU (ver state_reaper).
+#   STATE_BACKEND=memory  (default) dicts en proceso, un solo worker.
+#   STATE_BACKEND=sqlite  archivo SQLite en modo WAL compartido entre workers
+#                         (STATE_DB_PATH, default state.db). Un lock ajeno se
+#                         espera con green sleeps (nunca bloquea el hub) hasta
+#                         STATE_DB_BUSY_TIMEOUT segundos; después StateBusy -> 503.
+
+class StateBusy(Exception):
+    """El archivo de estado sigue bloqueado por otro proceso tras STATE_DB_BUSY_TIMEOUT."""
+
+class MemoryStateStore:
+    _STRIPES = 64
+
+    def __init__(self, journal=None):
+        if journal is not None:
+            self.carts = _JournaledMap(journal, "cart")
+            self.order_status = _JournaledMap(journal, "status")
+            self.checkout_prefill = _JournaledMap(journal, "prefill")
+        else:
+            self.carts = {}
+            self.order_status = {}
+            self.checkout_prefill = {}
+        self.last_seen = OrderedDict()  # client_id -> ts, del menos al más reciente
+        self._locks = [threading.RLock() for _ in range(self._STRIPES)]
+
+    @contextmanager
+    def transaction(self, client_id):
+        with self._locks[hash(client_id) % self._STRIPES]:
+            self.touch(client_id)
+            yield
+
+    def touch(self, client_id):
+        if client_id:
+            self.last_seen[client_id] = time.time()
+            self.last_seen.move_to_end(client_id)
+
+    def seen_at(self, client_id):
+        return self.last_seen.get(client_id)
+
+    def client_count(self):
+        return len(self.last_seen)
+
+    def lru_clients(self, limit, older_than=None):
+        out = []
+        for cid, ts in self.last_seen.items():
+            if len(out) >= limit or (older_than is not None and ts >= older_than):
+                break
+            out.append(cid)
+        return out
+
+    def evict(self, client_id):
+        self.carts.pop(client_id, None)
+        self.order_status.pop(client_id, None)
+        self.checkout_prefill.pop(client_id, None)
+        self.last_seen.pop(client_id, None)
+
+    def stats(self):
+        # Aproximado: muestreo de hasta 200 clientes, extrapolado.
+        sample = list(self.last_seen)[-200:]
+        per_client = 0
+        for cid in sample:
+            per_client += sys.getsizeof(cid) + 64
+            cart = self.carts.get(cid)
+            if cart is not None:
+                per_client += sys.getsizeof(cart.lines) + len(cart.lines) * 200 + len(cart.log) * 160
+            st = self.checkout_prefill.get(cid)
+            if st is not None:
+                per_client += 600
+        n = len(self.last_seen)
+        approx = int(per_client / len(sample) * n) if sample else 0
+        return {
+            "clients": n,
+            "carts": len(self.carts),
+            "order_status": len(self.order_status),
+            "checkout_prefill": len(self.checkout_prefill),
+            "approx_bytes": approx,
+        }
+
+class _SqliteMap(MutableMapping):
+    def __init__(self, store, ns, encode, decode):
+        self._store = store
+        self._ns = ns
+        self._encode = encode
+        self._decode = decode
+
+    def _query(self, sql, args=()):
+        return self._store._query(sql, args)
+
+    def _load(self, client_id):
+        rows = self._query("SELECT value FROM kv WHERE ns=? AND client_id=?", (self._ns, client_id))
+        if not rows:
+            raise KeyError(client_id)
+        return json.loads(rows[0][0])
+
+    def __getitem__(self, client_id):
+        return self._decode(self._load(client_id))
+
+    def __setitem__(self, client_id, value):
+        self._query(
+            "INSERT INTO kv(ns, client_id, value) VALUES(?,?,?) "
+            "ON CONFLICT(ns, client_id) DO UPDATE SET value=excluded.value",
+            (self._ns, client_id, json.dumps(self._encode(value), separators=(",", ":"))),
+        )
+
+    def __delitem__(self, client_id):
+        with self._store.lock:
+            cur = self._store._execute("DELETE FROM kv WHERE ns=? AND client_id=?", (self._ns, client_id))
+        if cur.rowcount == 0:
+            raise KeyError(client_id)
+
+    def __contains__(self, client_id):
+        return bool(self._query("SELECT 1 FROM kv WHERE ns=? AND client_id=?", (self._ns, client_id)))
+
+    def __iter__(self):
+        return iter([r[0] for r in self._query("SELECT client_id FROM kv WHERE ns=?", (self._ns,))])
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM kv WHERE ns=?", (self._ns,))[0][0]
+
+class _SqlitePrefillMap(_SqliteMap):
+    """Prefill con tarjeta/CVV fuera del archivo: como en el journal, esos
+    campos se quitan antes de escribir y quedan solo en memoria del worker
+    que los recibió (otro worker o un reinicio los vuelve a pedir).
+
+    Como la fila puede desaparecer sin pasar por aquí (la expulsa el reaper
+    de otro worker, o el cliente sigue en otro worker), los secretos caducan
+    tras `ttl` segundos sin uso y se descartan si la fila ya no existe."""
+
+    def __init__(self, store, ttl=6 * 3600):
+        super().__init__(store, "prefill", _prefill_to_journal, _prefill_from_journal)
+        self.ttl = ttl
+        self.secrets = OrderedDict()  # client_id -> (expira, {"card": ..., "cvv": ...}), más viejo primero
+        self.secrets_expired = 0
+
+    def _live_secrets(self, client_id, now):
+        entry = self.secrets.get(client_id)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self.secrets[client_id]
+            self.secrets_expired += 1
+            return None
+        self.secrets[client_id] = (now + self.ttl, entry[1])
+        self.secrets.move_to_end(client_id)
+        return entry[1]
+
+    def _expire(self, now):
+        while self.secrets:
+            cid, (expires, _s) = next(iter(self.secrets.items()))
+            if expires > now:
+                break
+            del self.secrets[cid]
+            self.secrets_expired += 1
+
+    def __getitem__(self, client_id):
         try:
-            t += float(it.get("price") or 0) * float(it.get("qty") or 1)
+            value = self._load(client_id)
+        except KeyError:
+            self.secrets.pop(client_id, None)  # fila expulsada en otro lado: no resucitar la tarjeta
+            raise
+        secrets = self._live_secrets(client_id, time.time())
+        if secrets:
+            value = {"raw": dict(value.get("raw") or {}, **secrets)}
+        return self._decode(value)
+
+    def __setitem__(self, client_id, value):
+        raw = value.get("raw") or {}
+        secrets = {k: raw[k] for k in _JOURNAL_SECRET_FIELDS if raw.get(k)}
+        super().__setitem__(client_id, value)
+        now = time.time()
+        self._expire(now)
+        if secrets:
+            self.secrets[client_id] = (now + self.ttl, secrets)
+            self.secrets.move_to_end(client_id)
+        else:
+            self.secrets.pop(client_id, None)
+
+    def __delitem__(self, client_id):
+        self.secrets.pop(client_id, None)
+        super().__delitem__(client_id)
+
+class SqliteStateStore:
+    """Estado compartido entre procesos en un archivo SQLite (WAL).
+
+    `transaction(client_id)` toma BEGIN IMMEDIATE, que serializa escritores
+    entre workers; dentro del proceso la conexión se protege con un RLock,
+    así que las transacciones anidadas simplemente reutilizan la externa.
+    El busy timeout de sqlite es 0: si otro proceso tiene el lock, `_execute`
+    reintenta con eventlet.sleep en vez de bloquear el hub. `touch` solo
+    escribe si la marca local tiene más de `touch_interval` segundos.
+    """
+
+    def __init__(self, path, busy_timeout=5.0, touch_interval=30.0, secret_ttl=6 * 3600):
+        self.lock = threading.RLock()
+        self.busy_timeout = busy_timeout
+        self.touch_interval = touch_interval
+        self._touched = {}  # client_id -> ts de la última escritura en `seen` desde este proceso
+        self.conn = sqlite3.connect(str(path), timeout=0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, client_id TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (ns, client_id)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (client_id TEXT PRIMARY KEY, ts REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS seen_ts ON seen(ts)")
+        self._depth = 0
+        self.carts = _SqliteMap(self, "cart", Cart.to_state, Cart.from_state)
+        self.order_status = _SqliteMap(self, "status", int, int)
+        self.checkout_prefill = _SqlitePrefillMap(self, secret_ttl)
+
+    @contextmanager
+    def transaction(self, client_id):
+        with self.lock:
+            outer = self._depth == 0
+            if outer:
+                self._execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                self.touch(client_id)
+                yield
+            except BaseException:
+                self._depth -= 1
+                if outer:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if outer:
+                self._execute("COMMIT")
+
+    def _execute(self, sql, args=()):
+        """conn.execute con reintentos verdes mientras otro proceso tenga el lock."""
+        deadline, delay = None, 0.001
+        while True:
+            try:
+                return self.conn.execute(sql, args)
+            except sqlite3.OperationalError as e:
+                msg = str(e)
+                if "locked" not in msg and "busy" not in msg:
+                    raise
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + self.busy_timeout
+                elif now >= deadline:
+                    raise StateBusy(msg) from e
+                eventlet.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self._execute(sql, args).fetchall()
+
+    def touch(self, client_id):
+        if not client_id:
+            return
+        now = time.time()
+        if now - self._touched.get(client_id, 0) < self.touch_interval:
+            return
+        if len(self._touched) > 100000:
+            self._touched.clear()
+        self._query(
+            "INSERT INTO seen(client_id, ts) VALUES(?,?) ON CONFLICT(client_id) DO UPDATE SET ts=excluded.ts",
+            (client_id, now),
+        )
+        self._touched[client_id] = now
+
+    def seen_at(self, client_id):
+        rows = self._query("SELECT ts FROM seen WHERE client_id=?", (client_id,))
+        return rows[0][0] if rows else None
+
+    def client_count(self):
+        return self._query("SELECT COUNT(*) FROM seen")[0][0]
+
+    def lru_clients(self, limit, older_than=None):
+        if older_than is None:
+            rows = self._query("SELECT client_id FROM seen ORDER BY ts LIMIT ?", (limit,))
+        else:
+            rows = self._query("SELECT client_id FROM seen WHERE ts < ? ORDER BY ts LIMIT ?", (older_than, limit))
+        return [r[0] for r in rows]
+
+    def evict(self, client_id):
+        self._query("DELETE FROM kv WHERE client_id=?", (client_id,))
+        self._query("DELETE FROM seen WHERE client_id=?", (client_id,))
+        self._touched.pop(client_id, None)
+        self.checkout_prefill.secrets.pop(client_id, None)
+
+    def stats(self):
+        counts = dict(self._query("SELECT ns, COUNT(*) FROM kv GROUP BY ns"))
+        page_count = self._query("PRAGMA page_count")[0][0]
+        page_size = self._query("PRAGMA page_size")[0][0]
+        self.checkout_prefill._expire(time.time())
+        return {
+            "clients": self.client_count(),
+            "carts": counts.get("cart", 0),
+            "order_status": counts.get("status", 0),
+            "checkout_prefill": counts.get("prefill", 0),
+            "prefill_secrets": len(self.checkout_prefill.secrets),
+            "prefill_secrets_expired": self.checkout_prefill.secrets_expired,
+            "approx_bytes": page_count * page_size,
+        }
+
+# ---- Journal del estado en memoria (JOURNAL_PATH) ----
+# Cada escritura en CARTS / ORDER_STATUS / CHECKOUT_PREFILL encola el valor
+# final del cliente ({"ns","id","v"}; v=null = borrado), no la op: el replay
+# es idempotente y no depende de los precios del menú. Un green thread los
+# escribe por lotes (escrituras repetidas del mismo cliente en un lote se
+# colapsan) y el I/O va a un hilo de eventlet.tpool, así que los handlers
+# nunca tocan disco. Cada JOURNAL_COMPACT_EVERY registros se escribe un
+# snapshot y el journal se reinicia: el arranque lee un snapshot + pocas líneas.
+# Cada línea lleva un número de secuencia ("s") y el snapshot guarda el último
+# que cubre: si un crash deja el journal viejo junto al snapshot nuevo, el
+# replay salta esas líneas en vez de aplicarlas encima.
+# Tarjeta y CVV no se escriben a disco; tras un reinicio hay que pedirlos de nuevo.
+
+_JOURNAL_SECRET_FIELDS = ("card", "cvv")
+
+def _prefill_to_journal(st):
+    raw = st.get("raw") or {}
+    return {"raw": {k: v for k, v in raw.items() if k not in _JOURNAL_SECRET_FIELDS}}
+
+def _prefill_from_journal(value):
+    raw = dict(value.get("raw") or {})
+    ok, missing, cleaned, checks = validate_prefill_fields(raw)
+    return {"raw": raw, "cleaned": cleaned, "valid": ok, "missing": missing, "checks": checks}
+
+class _JournaledMap(dict):
+    """dict que además encola cada escritura/borrado en el journal."""
+    __slots__ = ("_journal", "_ns")
+
+    def __init__(self, journal, ns):
+        super().__init__()
+        self._journal = journal
+        self._ns = ns
+
+    def __setitem__(self, client_id, value):
+        dict.__setitem__(self, client_id, value)
+        self._journal.record(self._ns, client_id, value)
+
+    def __delitem__(self, client_id):
+        dict.__delitem__(self, client_id)
+        self._journal.record(self._ns, client_id, None)
+
+    def pop(self, client_id, *default):
+        if client_id in self:
+            self._journal.record(self._ns, client_id, None)
+        return dict.pop(self, client_id, *default)
+
+class StateJournal:
+    CODECS = {
+        "cart": (Cart.to_state, Cart.from_state),
+        "status": (int, int),
+        "prefill": (_prefill_to_journal, _prefill_from_journal),
+    }
+
+    def __init__(self, path, flush_interval=0.2, batch_max=500, compact_every=20000, fsync=False):
+        self.path = Path(path)
+        self.snapshot_path = self.path.with_name(self.path.name + ".snapshot.json")
+        self.flush_interval = flush_interval
+        self.batch_max = batch_max
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.pending = {}  # (ns, client_id) -> valor codificado | None
+        self.seq = 0  # último número de secuencia escrito
+        self.lines_since_compact = 0
+        self.store = None
+        self.stats = {"records": 0, "coalesced": 0, "batches": 0, "lines": 0, "compactions": 0,
+                      "replayed_lines": 0, "skipped_lines": 0, "replay_ms": 0.0}
+        self._fh = None
+        self._wake = threading.Event()
+
+    def record(self, ns, client_id, value):
+        key = (ns, client_id)
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[key] = None if value is None else self.CODECS[ns][0](value)
+        self.stats["records"] += 1
+        if len(self.pending) >= self.batch_max:
+            self._wake.set()
+
+    # -- escritura (hilo de tpool) --
+    def _write_lines(self, items):
+        data = "".join(
+            json.dumps({"s": seq, "ns": ns, "id": cid, "v": v}, separators=(",", ":")) + "\n"
+            for seq, ((ns, cid), v) in items
+        )
+        if self._fh is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fh = open(self.path, "a", encoding="utf-8")
+            # Línea cortada por un crash: cerrarla para no pegarle el próximo registro.
+            if self._fh.tell() > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        data = "\n" + data
+        self._fh.write(data)
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+
+    def _write_snapshot(self, snap):
+        tmp = self.snapshot_path.with_name(self.snapshot_path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        # Con el snapshot ya en disco, el journal anterior sobra.
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = open(self.path, "w", encoding="utf-8")
+
+    def _take_pending(self):
+        """Vacía la cola numerando cada registro a continuación de self.seq."""
+        batch, self.pending = self.pending, {}
+        start = self.seq + 1
+        self.seq += len(batch)
+        return list(enumerate(batch.items(), start))
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch = self._take_pending()
+        eventlet.tpool.execute(self._write_lines, batch)
+        self.stats["batches"] += 1
+        self.stats["lines"] += len(batch)
+        self.lines_since_compact += len(batch)
+
+    def compact(self):
+        st = self.store
+        # Lo encolado después del último flush ya está en memoria (y en el
+        # snapshot), pero sus líneas llevarán s > seq y se reaplican: idempotente.
+        snap = {"ts": time.time(), "seq": self.seq}
+        for ns, mapping in (("cart", st.carts), ("status", st.order_status), ("prefill", st.checkout_prefill)):
+            encode = self.CODECS[ns][0]
+            snap[ns] = {cid: encode(v) for cid, v in dict.items(mapping)}
+        eventlet.tpool.execute(self._write_snapshot, snap)
+        self.lines_since_compact = 0
+        self.stats["compactions"] += 1
+
+    def run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self.lines_since_compact >= self.compact_every:
+                    self.compact()
+            except Exception:
+                log.exception("[journal] write failed")
+
+    def close(self):
+        """Vaciado síncrono (atexit)."""
+        if self.pending:
+            self._write_lines(self._take_pending())
+
+    # -- arranque --
+    def replay(self, store):
+        """Reconstruye `store` desde snapshot + journal y lo deja enganchado."""
+        self.store = store
+        t0 = time.perf_counter()
+        maps = {"cart": store.carts, "status": store.order_status, "prefill": store.checkout_prefill}
+        covered = 0  # líneas con s <= covered ya están en el snapshot
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snap = json.load(f)
+            covered = int(snap.get("seq") or 0)
+            for ns, mapping in maps.items():
+                decode = self.CODECS[ns][1]
+                for cid, v in (snap.get(ns) or {}).items():
+                    dict.__setitem__(mapping, cid, decode(v))
+        lines = skipped = 0
+        top = covered
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for raw in f:
+                    try:
+                        rec = json.loads(raw)
+                        mapping = maps[rec["ns"]]
+                    except (ValueError, KeyError):
+                        log.warning("[journal] línea inválida ignorada (¿escritura cortada?)")
+                        continue
+                    seq = rec.get("s")
+                    if seq is not None:  # journals de antes de la secuencia no la traen
+                        if seq <= covered:
+                            skipped += 1
+                            continue
+                        top = max(top, seq)
+                    if rec.get("v") is None:
+                        dict.pop(mapping, rec["id"], None)
+                    else:
+                        dict.__setitem__(mapping, rec["id"], self.CODECS[rec["ns"]][1](rec["v"]))
+                    lines += 1
+        for mapping in maps.values():
+            for cid in mapping:
+                store.touch(cid)
+        if skipped:
+            log.warning("[journal] %s líneas ya cubiertas por el snapshot (compactación cortada)", skipped)
+        self.seq = top
+        self.lines_since_compact = lines
+        self.stats["replayed_lines"] = lines
+        self.stats["skipped_lines"] = skipped
+        self.stats["replay_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        log.info("[journal] replay: %s clientes, %s líneas en %.1f ms",
+                 store.client_count(), lines, self.stats["replay_ms"])
+
+def make_journal(backend):
+    path = (os.getenv("JOURNAL_PATH") or "").strip()
+    if not path:
+        return None
+    if backend != "memory":
+        log.warning("[journal] JOURNAL_PATH se ignora con STATE_BACKEND=%s (ya es persistente)", backend)
+        return None
+    return StateJournal(
+        path,
+        flush_interval=env_float("JOURNAL_FLUSH_INTERVAL", 0.2),
+        batch_max=env_int("JOURNAL_BATCH_MAX", 500),
+        compact_every=env_int("JOURNAL_COMPACT_EVERY", 20000),
+        fsync=(os.getenv("JOURNAL_FSYNC") or "").strip() in ("1", "true"),
+    )
+
+def make_state_store(journal=None):
+    backend = (os.getenv("STATE_BACKEND") or "memory").strip().lower()
+    if backend == "sqlite":
+        path = os.getenv("STATE_DB_PATH") or "state.db"
+        log.info("[state] sqlite backend at %s", path)
+        return SqliteStateStore(path, busy_timeout=env_float("STATE_DB_BUSY_TIMEOUT", 5.0),
+                                touch_interval=env_float("STATE_TOUCH_INTERVAL", 30.0),
+                                secret_ttl=env_float("STATE_IDLE_TTL", 6 * 3600))
+    if backend != "memory":
+        raise RuntimeError(f"STATE_BACKEND desconocido: {backend}")
+    return MemoryStateStore(journal)
+
+# ---- Expulsión de estado por cliente (TTL + LRU) ----
+STATE_MAX_CLIENTS = env_int("STATE_MAX_CLIENTS", 10000)
+STATE_IDLE_TTL = env_float("STATE_IDLE_TTL", 6 * 3600)
+STATE_REAP_INTERVAL = env_float("STATE_REAP_INTERVAL", 60)
+STATE_EVICTIONS = {"idle": 0, "lru": 0, "runs": 0}
+
+def _evictable_first(client_id):
+    """0 = sesión terminada (estado 5) o carrito vacío; 1 = en curso."""
+    if STORE.order_status.get(client_id) == 5 or not STORE.carts.get(client_id):
+        return 0
+    return 1
+
+def reap_state(now=None):
+    """Una pasada: primero los inactivos > STATE_IDLE_TTL, luego si hay más de
+    STATE_MAX_CLIENTS se expulsan los menos recientes, prefiriendo sesiones
+    terminadas y carritos vacíos entre los candidatos más viejos."""
+    now = time.time() if now is None else now
+    cutoff = now - STATE_IDLE_TTL
+    evicted = {"idle": 0, "lru": 0}
+    while True:
+        batch = STORE.lru_clients(500, older_than=cutoff)
+        if not batch:
+            break
+        for cid in batch:
+            with STORE.transaction(cid):
+                STORE.evict(cid)
+            evicted["idle"] += 1
+        if len(batch) < 500:
+            break
+
+    over = STORE.client_count() - STATE_MAX_CLIENTS
+    if over > 0:
+        candidates = STORE.lru_clients(max(over * 4, 64))
+        ranked = sorted(enumerate(candidates), key=lambda ic: (_evictable_first(ic[1]), ic[0]))
+        for _i, cid in ranked[:over]:
+            with STORE.transaction(cid):
+                STORE.evict(cid)
+            evicted["lru"] += 1
+
+    STATE_EVICTIONS["idle"] += evicted["idle"]
+    STATE_EVICTIONS["lru"] += evicted["lru"]
+    STATE_EVICTIONS["runs"] += 1
+    if evicted["idle"] or evicted["lru"]:
+        log.info("[state-reaper] evicted idle=%s lru=%s", evicted["idle"], evicted["lru"])
+    return evicted
+
+def state_reaper():
+    while True:
+        socketio.sleep(STATE_REAP_INTERVAL)
+        try:
+            reap_state()
+            TENANTS.reap()
         except Exception:
-            pass
-    return round(t, 2)
+            log.exception("[state-reaper] failed")
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+# ======================
+# Upstream (OpenAI Realtime)
+# ======================
+# Un solo Session con keep-alive para todas las llamadas upstream. Con
+# eventlet.monkey_patch() los sockets, la cola del pool de urllib3 y el
+# semáforo son green: esperar upstream no bloquea el hub, pero el número de
+# llamadas en vuelo está acotado y un upstream degradado corta rápido.
+
+class UpstreamUnavailable(Exception):
+    def __init__(self, reason, retry_after=1, code="unavailable"):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.code = code
+
+class CircuitBreaker:
+    """closed -> (threshold fallos seguidos) -> open -> (cooldown) -> half-open.
+
+    En half-open pasa una sola llamada de prueba; si sale bien se cierra,
+    si falla vuelve a abrirse otro cooldown.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= self.cooldown:
+            self.probing = True
+            return True
+        return False
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 1
+        return max(1, int(self.cooldown - (time.monotonic() - self.opened_at)) + 1)
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+class UpstreamClient:
+    """Cliente upstream con a lo sumo `max_concurrency` llamadas en vuelo.
+
+    Hasta `queue_max` llamadas más esperan turno (como mucho `queue_timeout`
+    segundos); con la cola llena se rechaza al instante, así que bajo
+    sobrecarga la latencia queda acotada en vez de crecer con la cola.
+    """
+
+    def __init__(self, base_url, max_concurrency=20, connect_timeout=3.0, read_timeout=15.0,
+                 queue_timeout=2.0, queue_max=50, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.queue_timeout = queue_timeout
+        self.queue_max = queue_max
+        self.waiting = 0
+        self.breaker = breaker or CircuitBreaker(5, 30.0)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _acquire(self, path):
+        if self._slots.acquire(blocking=False):
+            return
+        if self.waiting >= self.queue_max:
+            UPSTREAM_REQUESTS.inc((path, "rejected"))
+            raise UpstreamUnavailable("upstream queue full", code="queue_full")
+        self.waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        if not acquired:
+            UPSTREAM_REQUESTS.inc((path, "rejected"))
+            raise UpstreamUnavailable("too many upstream requests in flight", code="queue_timeout")
+
+    def post_json(self, path, payload, headers=None):
+        self._acquire(path)
+        try:
+            if not self.breaker.allow():
+                UPSTREAM_REQUESTS.inc((path, "rejected"))
+                raise UpstreamUnavailable("upstream circuit open", self.breaker.retry_after(), "circuit_open")
+            hdrs = {"Content-Type": "application/json"}
+            hdrs.update(headers or {})
+            data = payload if isinstance(payload, (bytes, str)) else json.dumps(payload)
+            t0 = time.perf_counter()
+            try:
+                r = self.session.post(self.base_url + path, data=data, headers=hdrs, timeout=self.timeout)
+            except requests.RequestException:
+                UPSTREAM_LATENCY.observe((path,), time.perf_counter() - t0)
+                UPSTREAM_REQUESTS.inc((path, "error"))
+                self.breaker.failure()
+                raise
+            UPSTREAM_LATENCY.observe((path,), time.perf_counter() - t0)
+        finally:
+            self._slots.release()
+        UPSTREAM_REQUESTS.inc((path, "ok" if r.status_code < 400 else f"http_{r.status_code // 100}xx"))
+        if r.status_code >= 500 or r.status_code == 429:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return r
+
+UPSTREAM = UpstreamClient(
+    os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1",
+    max_concurrency=env_int("UPSTREAM_MAX_CONCURRENCY", 20),
+    connect_timeout=env_float("UPSTREAM_CONNECT_TIMEOUT", 3.0),
+    read_timeout=env_float("UPSTREAM_READ_TIMEOUT", 15.0),
+    queue_timeout=env_float("UPSTREAM_QUEUE_TIMEOUT", 2.0),
+    queue_max=env_int("UPSTREAM_QUEUE_MAX", 50),
+    breaker=CircuitBreaker(env_int("UPSTREAM_BREAKER_THRESHOLD", 5), env_float("UPSTREAM_BREAKER_COOLDOWN", 30.0)),
+)
+
+# ======================
+# Rate limit por cliente
+# ======================
+# Token bucket por client_id (o IP si no viene): `rate` tokens por segundo,
+# hasta `burst` acumulados. Los buckets viven en un LRU acotado; uno
+# expulsado vuelve lleno, lo que solo puede dejar pasar de más. rate=0 apaga.
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=100_000):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> [tokens, monotonic]
+
+    def take(self, key):
+        """0 si pasa; si no, segundos hasta que haya un token."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        b = self.buckets.get(key)
+        if b is None:
+            b = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] >= 1:
+            b[0] -= 1
+            return 0
+        return (1 - b[0]) / self.rate
+
+SESSION_LIMIT = TokenBucketLimiter(env_float("RATE_SESSION_PER_MIN", 6) / 60.0, env_float("RATE_SESSION_BURST", 3))
+CART_LIMIT = TokenBucketLimiter(env_float("RATE_CART_PER_SEC", 5), env_float("RATE_CART_BURST", 20))
+
+def rate_limited(limiter, route, client_id):
+    """None si pasa; si no, la respuesta 429 con Retry-After."""
+    key = tenant_key(client_id) if client_id else "ip:" + (request.remote_addr or "")
+    wait = limiter.take(key)
+    if not wait:
+        return None
+    SHED.inc((route, "rate_limited"))
+    retry_after = int(wait) + 1
+    return {"ok": False, "error": "rate_limited", "retry_after": retry_after}, 429, {"Retry-After": str(retry_after)}
+
+# ======================
+# Realtime session template
+# ======================
+# La parte estática del body de /realtime/sessions (tools + instrucciones
+# del menú) se codifica a JSON una vez por menú; por cliente solo se
+# renderiza el bloque de carrito/estado y se empalma como bytes.
+
+DEFAULT_REALTIME_MODEL = "gpt-4o-realtime-preview"
+DEFAULT_REALTIME_VOICE = "verse"
+
+ORDER_STATUS_LABELS = {
+    0: "0 (cart empty)",
+    1: "1 (cart has items)",
+    2: "2 (cart modal open)",
+    3: "3 (checkout form open)",
+    4: "4 (checkout valid, ready to finalize)",
+    5: "5 (order confirmation open)"
+}
+
+REALTIME_TOOLS = [
+    {
+        "type": "function",
+        "name": "update_front",
+        "description": "Update the client UI to show only the given item names in real time, and include a short reply to speak to the user.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "names": {"type": "array","items": {"type": "string"}},
+                "reply": {"type": "string"}
+            },
+            "required": ["names", "reply"]
+        }
+    },
+    {
+        "type": "function",
+        "name": "update_cart",
+        "description": (
+            "Add/remove items in the user's cart, or clear it. "
+            "Use `action`: 'apply' (default) or 'clear'. "
+            "Always include a short `reply` when appropriate."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "action": { "type": "string", "enum": ["apply", "clear"] },
+                "ops": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "op": {"type": "string", "enum": ["add", "remove", "set", "clear"]},
+                            "name":{"type": "string"},
+                            "qty": {"type": "integer", "minimum": 0}
+                        },
+                        "required": ["op"]
+                    }
+                },
+                "reply": {"type": "string"}
+            }
+        }
+    },
+    {
+        "type": "function",
+        "name": "get_cart",
+        "description": "Return the current cart state with item names, qty, unit prices and total. Always include a short reply.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "reply": {"type":"string"}
+            }
+        }
+    },
+    {
+        "type": "function",
+        "name": "get_order_status",
+        "description": "Return current order_status (0..5). ALWAYS call this before transition_order_status.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "reply": { "type": "string" }
+            }
+        }
+    },
+    {
+        "type": "function",
+        "name": "transition_order_status",
+        "description": (
+            "Advance or adjust the order flow UI for the current customer "
+            "(0:empty, 1:cart-with-items, 2:cart-open, 3:checkout-open, "
+            "4:checkout-valid, 5:success). Optionally include 'prefill' when to ∈ {3,4}. "
+            "Always include a short 'reply'."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "to": { "type": "integer", "enum": [0,1,2,3,4,5] },
+                "prefill": {
+                    "type": "object",
+                    "properties": {
+                        "name":  {"type": "string"},
+                        "phone": {"type": "string"},
+                        "email": {"type": "string"},
+                        "card":  {"type": "string"},
+                        "exp":   {"type": "string"},
+                        "cvv":   {"type": "string"}
+                    }
+                },
+                "reply": { "type": "string" }
+            },
+            "required": ["to", "reply"]
+        }
+    }
+]
+
+SEARCH_MENU_TOOL = {
+    "type": "function",
+    "name": "search_menu",
+    "description": (
+        "Search the restaurant menu by dish name, ingredient or description. "
+        "Returns matching items with price, ingredients and description."
+    ),
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "query": {"type": "string"},
+            "limit": {"type": "integer", "minimum": 1, "maximum": 10}
+        },
+        "required": ["query"]
+    }
+}
+
+SUGGEST_ITEMS_TOOL = {
+    "type": "function",
+    "name": "suggest_items",
+    "description": (
+        "Items frequently bought together with the customer's current cart, "
+        "learned from past completed orders (falls back to the most popular items)."
+    ),
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "limit": {"type": "integer", "minimum": 1, "maximum": 10}
+        }
+    }
+}
+
+def session_tools():
+    tools = REALTIME_TOOLS + [SEARCH_MENU_TOOL] if MENU_CONTEXT == "search" else REALTIME_TOOLS
+    return tools + [SUGGEST_ITEMS_TOOL] if SUGGEST_TOOL_ENABLED else tools
+
+class SessionTemplate:
+    """Body pre-codificado: `{"tools":[...],"instructions":"<menú>` + sufijo.
+
+    El prefijo de instrucciones se guarda como string JSON sin la comilla
+    de cierre; el sufijo por cliente se codifica sin la de apertura, así
+    que concatenarlos produce un único string JSON válido.
+    """
+    __slots__ = ("head", "instructions", "_defaults")
+
+    def __init__(self, instructions, tools):
+        self.instructions = instructions or ""
+        self.head = (
+            '{"tools":' + json.dumps(tools, separators=(",", ":"))
+            + ',"instructions":' + json.dumps(self.instructions)[:-1]
+        ).encode("utf-8")
+        self._defaults = self._tail(DEFAULT_REALTIME_MODEL, DEFAULT_REALTIME_VOICE)
+
+    @staticmethod
+    def _tail(model, voice):
+        return (',"model":' + json.dumps(model) + ',"voice":' + json.dumps(voice) + "}").encode("utf-8")
+
+    def render(self, model, voice, suffix=""):
+        if model == DEFAULT_REALTIME_MODEL and voice == DEFAULT_REALTIME_VOICE:
+            tail = self._defaults
+        else:
+            tail = self._tail(model, voice)
+        return self.head + json.dumps(suffix)[1:].encode("utf-8") + tail
+
+def render_session_context(client_id):
+    """Bloque por cliente (carrito + estado) que va al final de las instrucciones."""
+    cart = priced_cart_for(client_id)
+    if cart:
+        lines = [f"- {ln.name} x{ln.qty} — ${ln.price_cents / 100:0.2f} c/u" for ln in cart]
+        cart_block = "\n".join(lines) + f"\nTotal actual: ${cart.total:0.2f}"
+    else:
+        cart_block = "(carrito vacío)"
+    status_num = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
+    return (
+        "\n\nCurrent customer cart:\n" + cart_block
+        + "\n\nCurrent order status:\n- " + ORDER_STATUS_LABELS.get(status_num, str(status_num))
+    )
+
+def mint_realtime_session(api_key, payload):
+    return UPSTREAM.post_json(
+        "/realtime/sessions",
+        payload,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "OpenAI-Beta": "realtime=v1",
+        },
+    )
+
+def session_expires_at(data):
+    secret = data.get("client_secret") or {}
+    try:
+        return float(secret.get("expires_at") or data.get("expires_at"))
+    except (TypeError, ValueError):
+        return time.time() + 60
+
+class SessionPool:
+    """Pool opcional de sesiones efímeras ya minteadas con el menú base.
+
+    Un greenlet de fondo mantiene `size` sesiones (modelo/voz por defecto,
+    sin contexto de cliente) y las descarta `refresh_margin` segundos antes
+    de que expiren. Al entregar una, el contexto del cliente viaja aparte
+    como `session.update`. `invalidate()` (cambio de menú) sube la
+    generación para que las sesiones minteadas con el menú anterior, incluso
+    las que estén en vuelo, no se entreguen.
+    """
+
+    def __init__(self, size, refresh_margin=15.0):
+        self.size = size
+        self.refresh_margin = refresh_margin
+        self.generation = 0
+        self.sessions = deque()  # (generation, expires_at, data)
+        self.stats = {"hits": 0, "misses": 0, "minted": 0, "expired": 0, "invalidated": 0, "errors": 0}
+        self._wake = threading.Event()
+        self._started = False
+
+    def start(self):
+        if self.size > 0 and not self._started:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _fresh(self, entry, now):
+        gen, expires_at, _data = entry
+        return gen == self.generation and expires_at - now > self.refresh_margin
+
+    def _prune(self):
+        now = time.time()
+        kept = [e for e in self.sessions if self._fresh(e, now)]
+        self.stats["expired"] += len(self.sessions) - len(kept)
+        self.sessions = deque(kept)
+
+    def take(self):
+        if self.size <= 0:
+            return None
+        now = time.time()
+        while self.sessions:
+            entry = self.sessions.popleft()
+            if self._fresh(entry, now):
+                self.stats["hits"] += 1
+                self._wake.set()
+                return entry[2]
+            self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        self._wake.set()
+        return None
+
+    def invalidate(self):
+        self.generation += 1
+        self.stats["invalidated"] += len(self.sessions)
+        self.sessions.clear()
+        self._wake.set()
+
+    def snapshot(self):
+        return {"size": self.size, "ready": len(self.sessions), "generation": self.generation, **self.stats}
+
+    def _mint_one(self):
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            return False
+        gen = self.generation
+        payload = TENANTS.default.snapshot.template.render(DEFAULT_REALTIME_MODEL, DEFAULT_REALTIME_VOICE)
+        try:
+            r = mint_realtime_session(api_key, payload)
+            if r.status_code >= 400:
+                raise RuntimeError(f"{r.status_code}: {r.text[:200]}")
+            data = r.json()
+        except Exception as e:
+            self.stats["errors"] += 1
+            log.warning("[session-pool] mint failed: %s", e)
+            return False
+        if gen != self.generation:
+            self.stats["invalidated"] += 1
+            return True
+        self.sessions.append((gen, session_expires_at(data), data))
+        self.stats["minted"] += 1
+        return True
+
+    def _run(self):
+        while True:
+            self._prune()
+            if len(self.sessions) < self.size:
+                if not self._mint_one():
+                    self._wake.wait(5.0)
+                    self._wake.clear()
+                continue
+            # Pool lleno: dormir hasta que alguien tome una o venza la primera.
+            wait = min(e[1] for e in self.sessions) - self.refresh_margin - time.time()
+            self._wake.wait(max(0.5, wait))
+            self._wake.clear()
+
+# ======================
+# Estáticos con huella + imágenes del menú
+# ======================
+# Al arrancar, static/*.js|css se leen una vez, se nombran con el hash del
+# contenido (app.3f9c1e0b2a4d.js) y se guardan ya comprimidos (gzip y, si
+# está instalado `brotli`, br); /assets/<nombre> los sirve como inmutables.
+# Las plantillas usan asset_url("app.js"). ASSET_FINGERPRINT=0 vuelve a
+# /static/ sin caché larga (útil editando el JS).
+#
+# Las imágenes del menú (img_ref) se bajan una vez a IMAGE_CACHE_DIR y se
+# sirven como miniaturas en /img/<generation>/<clave>?w=<ancho>; el menú
+# servido trae `thumb` con esa ruta. Con Pillow se redimensionan; sin Pillow
+# se sirve el original cacheado. Un img_ref que no es http(s) se busca bajo
+# IMAGE_LOCAL_ROOT (fixtures locales, pruebas sin red).
+#
+# POST /api/menu no pide auth, así que img_ref no es confiable: solo se bajan
+# URLs con esquema de IMAGE_FETCH_SCHEMES y host en IMAGE_FETCH_HOSTS
+# ("*.dominio" vale para subdominios), nunca hacia IPs privadas, loopback o
+# link-local, y sin seguir redirects. Si falla, 404 (nada de redirigir al img_ref).
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ASSET_FINGERPRINT = (os.getenv("ASSET_FINGERPRINT") or "1").strip() not in ("0", "false")
+ASSET_EXTENSIONS = {".js": "application/javascript", ".css": "text/css"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+class StaticAsset:
+    __slots__ = ("name", "url_name", "mimetype", "body", "gzipped", "brotli", "etag")
+
+    def __init__(self, path):
+        self.body = path.read_bytes()
+        self.etag = hashlib.sha256(self.body).hexdigest()[:12]
+        self.name = path.name
+        self.url_name = f"{path.stem}.{self.etag}{path.suffix}"
+        self.mimetype = ASSET_EXTENSIONS[path.suffix]
+        self.gzipped = gzip.compress(self.body, 9, mtime=0)
+        self.brotli = brotli.compress(self.body, quality=11) if brotli is not None else None
+
+def build_asset_manifest(root):
+    """nombre -> StaticAsset y nombre con hash -> StaticAsset."""
+    by_name, by_url = {}, {}
+    if not ASSET_FINGERPRINT:
+        return by_name, by_url
+    for path in sorted(Path(root).iterdir()):
+        if path.suffix in ASSET_EXTENSIONS and path.is_file():
+            a = StaticAsset(path)
+            by_name[a.name] = by_url[a.url_name] = a
+    return by_name, by_url
+
+def encoded_response(body, gzipped, br, mimetype, etag, cache_control):
+    """Respuesta con la mejor codificación aceptada (br > gzip > identidad) y 304 por ETag."""
+    headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304, headers=headers)
+    elif br is not None and "br" in request.accept_encodings:
+        resp = Response(br, mimetype=mimetype, headers=headers)
+        resp.headers["Content-Encoding"] = "br"
+    elif gzipped is not None and "gzip" in request.accept_encodings:
+        resp = Response(gzipped, mimetype=mimetype, headers=headers)
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(body, mimetype=mimetype, headers=headers)
+    resp.set_etag(etag)
+    return resp
+
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR") or "data/images")
+IMAGE_LOCAL_ROOT = Path(os.getenv("IMAGE_LOCAL_ROOT") or "static").resolve()
+IMAGE_THUMBS = (os.getenv("IMAGE_THUMBS") or "1").strip() not in ("0", "false")
+IMAGE_WIDTHS = tuple(sorted(int(w) for w in (os.getenv("IMAGE_WIDTHS") or "160,320,640").split(",")))
+IMAGE_MAX_BYTES = env_int("IMAGE_MAX_BYTES", 10 * 1024 * 1024)
+IMAGE_FETCH_HOSTS = tuple(h.strip().lower() for h in (os.getenv("IMAGE_FETCH_HOSTS") or "restaurant.vuen.ai").split(",") if h.strip())
+IMAGE_FETCH_SCHEMES = tuple(s.strip().lower() for s in (os.getenv("IMAGE_FETCH_SCHEMES") or "https").split(",") if s.strip())
+IMAGE_CACHE_ENTRIES = env_int("IMAGE_CACHE_ENTRIES", 4096)
+IMAGE_ERROR_TTL = env_float("IMAGE_ERROR_TTL", 30.0)
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+_IMAGE_TYPES = {b"\x89PNG": ("image/png", ".png"), b"\xff\xd8\xff": ("image/jpeg", ".jpg"),
+                b"RIFF": ("image/webp", ".webp"), b"GIF8": ("image/gif", ".gif")}
+
+def image_key(img_ref):
+    return hashlib.sha256(img_ref.encode("utf-8")).hexdigest()[:20]
+
+def sniff_image(data):
+    for magic, kind in _IMAGE_TYPES.items():
+        if data.startswith(magic):
+            return kind
+    return None
+
+class ImageError(Exception):
+    pass
+
+def check_image_url(url, hosts=IMAGE_FETCH_HOSTS, schemes=IMAGE_FETCH_SCHEMES):
+    """ImageError si `url` no está permitida o resuelve a una dirección interna."""
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme.lower() not in schemes:
+        raise ImageError(f"scheme not allowed: {parts.scheme}")
+    if not any(host == h or (h.startswith("*.") and host.endswith(h[1:])) for h in hosts):
+        raise ImageError(f"host not allowed: {host}")
+    try:
+        port = parts.port or _DEFAULT_PORTS.get(parts.scheme.lower(), 443)
+    except ValueError as e:
+        raise ImageError(f"bad port: {e}")
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError) as e:
+        raise ImageError(f"cannot resolve {host}: {e}")
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not ip.is_global:
+            raise ImageError(f"{host} resolves to non-public address {ip}")
+
+class ImageCache:
+    """Originales en disco por clave de img_ref + miniaturas por ancho.
+
+    Cada img_ref se baja (o se lee de IMAGE_LOCAL_ROOT) una sola vez aunque
+    lleguen muchos requests a la vez: el primero lo trae y el resto espera
+    su resultado. Redimensionar va por tpool para no frenar el hub. Los
+    fallos se recuerdan `error_ttl` segundos para no reintentar el fetch en
+    cada request; resultados y fallos son LRU de `max_entries`."""
+
+    def __init__(self, root, local_root, widths, max_bytes=IMAGE_MAX_BYTES, fetch_timeout=10.0,
+                 max_entries=IMAGE_CACHE_ENTRIES, error_ttl=IMAGE_ERROR_TTL):
+        self.root = Path(root)
+        self.local_root = Path(local_root)
+        self.widths = widths
+        self.max_bytes = max_bytes
+        self.fetch_timeout = fetch_timeout
+        self.max_entries = max_entries
+        self.error_ttl = error_ttl
+        self.done = OrderedDict()    # (clave, ancho) -> (ruta, mimetype, etag), del menos al más reciente
+        self.failed = OrderedDict()  # (clave, ancho) -> (monotonic de expiración, mensaje)
+        self.inflight = {}  # (clave, ancho) -> eventlet Event
+        self.stats = {"hits": 0, "fetches": 0, "resized": 0, "errors": 0, "negative_hits": 0}
+
+    def _remember(self, lru, slot, value):
+        lru[slot] = value
+        lru.move_to_end(slot)
+        if len(lru) > self.max_entries:
+            lru.popitem(last=False)
+
+    def pick_width(self, requested):
+        try:
+            requested = int(requested)
+        except (TypeError, ValueError):
+            return self.widths[len(self.widths) // 2]
+        for w in self.widths:
+            if w >= requested:
+                return w
+        return self.widths[-1]
+
+    def get(self, img_ref, width):
+        """(ruta, mimetype, etag) de la miniatura; ImageError si no se puede."""
+        slot = (image_key(img_ref), width)
+        hit = self.done.get(slot)
+        if hit is not None:
+            self.done.move_to_end(slot)
+            self.stats["hits"] += 1
+            return hit
+        failed = self.failed.get(slot)
+        if failed is not None:
+            if failed[0] > time.monotonic():
+                self.stats["negative_hits"] += 1
+                raise ImageError(failed[1])
+            del self.failed[slot]
+        ev = self.inflight.get(slot)
+        if ev is not None:
+            return ev.wait()
+        ev = self.inflight[slot] = eventlet.event.Event()
+        try:
+            res = self._build(img_ref, slot[0], width)
+        except Exception as e:
+            self.stats["errors"] += 1
+            err = e if isinstance(e, ImageError) else ImageError(str(e))
+            if self.error_ttl > 0:
+                self._remember(self.failed, slot, (time.monotonic() + self.error_ttl, str(err)))
+            ev.send_exception(err)
+            raise err
+        finally:
+            self.inflight.pop(slot, None)
+        self._remember(self.done, slot, res)
+        ev.send(res)
+        return res
+
+    def _build(self, img_ref, key, width):
+        orig = self._original(img_ref, key)
+        data = orig.read_bytes()
+        kind = sniff_image(data[:16])
+        if kind is None:
+            raise ImageError("not an image")
+        thumb = orig
+        if Image is not None:
+            thumb = self.root / f"{key}.w{width}"
+            if not thumb.exists():
+                eventlet.tpool.execute(self._resize, orig, thumb, width)
+                self.stats["resized"] += 1
+            data = thumb.read_bytes()
+            kind = sniff_image(data[:16])
+        return thumb, kind[0], hashlib.sha256(data).hexdigest()[:20]
+
+    def _original(self, img_ref, key):
+        path = self.root / f"{key}.orig"
+        if path.exists():
+            return path
+        self.root.mkdir(parents=True, exist_ok=True)
+        if img_ref.startswith(("http://", "https://")):
+            check_image_url(img_ref)
+            self.stats["fetches"] += 1
+            with requests.get(img_ref, timeout=self.fetch_timeout, stream=True, allow_redirects=False) as r:
+                if r.status_code != 200:
+                    raise ImageError(f"HTTP {r.status_code}")
+                data = r.raw.read(self.max_bytes + 1, decode_content=True)
+        else:
+            src = (self.local_root / img_ref.removeprefix("file://").lstrip("/")).resolve()
+            if not src.is_relative_to(self.local_root) or not src.is_file():
+                raise ImageError("local image not found")
+            data = src.read_bytes()
+        if len(data) > self.max_bytes:
+            raise ImageError("image too large")
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        return path
+
+    @staticmethod
+    def _resize(src, dst, width):
+        # JPEG salvo que haya transparencia (un PNG opaco pesa varias veces más).
+        with Image.open(src) as im:
+            im.thumbnail((width, width * 4))
+            tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                im.save(tmp, "PNG", optimize=True)
+            else:
+                im.convert("RGB").save(tmp, "JPEG", quality=82, optimize=True, progressive=True)
+        os.replace(tmp, dst)
+
+IMAGES = ImageCache(IMAGE_CACHE_DIR, IMAGE_LOCAL_ROOT, IMAGE_WIDTHS)
+
+def with_thumbs(items, generation):
+    """Copia de `items` para el cliente, con `thumb` = ruta de la miniatura."""
+    if not IMAGE_THUMBS:
+        return items
+    return [dict(it, thumb=f"/img/{generation}/{image_key(it['img_ref'])}") if it.get("img_ref") else it
+            for it in items]
 
 # ======================
-# Global caches
+# Tenants (un restaurante = menú + caches derivados)
 # ======================
+# Sin TENANTS_DIR hay un solo tenant ("default": MENU_PATH + RESTAURANT_NAME).
+# Con TENANTS_DIR=tenants, /t/<id>/... (o <id>.TENANT_HOST_SUFFIX) usa
+# tenants/<id>/menu.json y tenants/<id>/tenant.json ({"name": ...}); se carga
+# al primer uso y se descarta tras TENANT_IDLE_TTL sin requests o si hay más
+# de TENANT_MAX cargados. El estado por cliente vive en el mismo STORE con la
+# clave "<tenant>/<client_id>" (ver TenantScopedStore), y las salas de
+# Socket.IO usan la misma clave.
+
+DEFAULT_TENANT = "default"
+TENANTS_DIR = (os.getenv("TENANTS_DIR") or "").strip() or None
+TENANT_HOST_SUFFIX = (os.getenv("TENANT_HOST_SUFFIX") or "").strip().lower() or None
+_TENANT_ID_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,62}$")
+_TENANT_PATH_RE = re.compile(r"^/t/([a-z0-9][a-z0-9_-]{0,62})(/.*)?$")
+
+class MenuSnapshot:
+    """Menú + todo lo derivado de él (índice, prompt, JSON, sesión) bajo una
+    misma `generation`. No se modifica nunca: un cambio de menú construye uno
+    nuevo y lo publica con una sola asignación (`tenant.snapshot = ...`), así
+    que quien lo lee una vez por request ve todo coherente."""
+    __slots__ = ("generation", "items", "index", "payload", "instructions", "template", "images")
+
+    def __init__(self, items, generation, restaurant):
+        self.generation = generation
+        self.items = items
+        self.index = build_menu_index(items)
+        self.payload = MenuPayload(with_thumbs(items, generation), generation)
+        self.images = {image_key(it["img_ref"]): it["img_ref"] for it in items if it.get("img_ref")}
+        self.instructions = build_menu_prompt(items, restaurant=restaurant)
+        self.template = SessionTemplate(self.instructions, session_tools())
+
+def _file_sig(path):
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+class Tenant:
+    """Un restaurante: su menu.json y el MenuSnapshot vigente.
+
+    La generación es el mtime del archivo en ms (o la anterior + 1 si no
+    avanza), así que todos los workers que leen el mismo menu.json coinciden
+    y sigue creciendo entre reinicios; CartLine.gen se compara contra ella."""
+
+    def __init__(self, tid, name, menu_path):
+        self.id = tid
+        self.name = name
+        self.menu_path = Path(menu_path)
+        self.last_used = time.time()
+        self.snapshot = None
+        self.file_sig = None
+        self.bad_sig = None
+        self.reload()
+
+    def read_menu(self):
+        """menu.json normalizado; excepción si falta, está a medio escribir o no es una lista."""
+        items = json.loads(self.menu_path.read_text(encoding="utf-8"))
+        if not isinstance(items, list):
+            raise ValueError("menu.json must be a JSON list")
+        return normalize_menu(items)
+
+    def reload(self):
+        """Vuelve a leer menu.json (el stat va antes de leer: si cambia en medio, se relee).
+
+        Si el archivo no se puede parsear se conserva el snapshot vigente y
+        file_sig no avanza, así el watcher reintenta en la próxima vuelta.
+        Devuelve el snapshot nuevo o None."""
+        sig = _file_sig(self.menu_path)
+        try:
+            menu = self.read_menu()
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            if sig != self.bad_sig:
+                self.bad_sig = sig
+                log.error("[menu] %s: no se pudo leer %s (%s); se mantiene el menú actual",
+                          self.id, self.menu_path, e)
+            if self.snapshot is not None:
+                return None
+            menu = []
+        self.file_sig, self.bad_sig = sig, None
+        return self.install(menu)
+
+    def install(self, menu):
+        prev = self.snapshot.generation if self.snapshot is not None else 0
+        disk = self.file_sig[0] // 1_000_000 if self.file_sig else 0
+        self.snapshot = snap = MenuSnapshot(menu, max(prev + 1, disk), self.name)
+        return snap
+
+    def replace_menu(self, menu):
+        """Instala `menu` (ya normalizado) y lo persiste en el menu.json del tenant."""
+        save_menu(menu, self.menu_path)
+        self.file_sig = _file_sig(self.menu_path)
+        snap = self.install(menu)
+        self.announce(snap)
+        return snap
+
+    def check_reload(self):
+        """Hot reload: recarga si menu.json cambió en disco (otro worker, edición a mano)."""
+        if _file_sig(self.menu_path) == self.file_sig:
+            return False
+        snap = self.reload()
+        if snap is None:
+            return False
+        log.info("[menu] %s recargado de %s (generation=%s, %s ítems)",
+                 self.id, self.menu_path, snap.generation, len(snap.items))
+        self.announce(snap)
+        return True
+
+    def announce(self, snap):
+        if self is TENANTS.default:
+            SESSION_POOL.invalidate()
+        socketio.emit("menu_updated", {"generation": snap.generation, "etag": snap.payload.etag},
+                      to=tenant_room(self.id))
+
+class TenantRegistry:
+    def __init__(self, root, max_tenants, idle_ttl):
+        self.root = Path(root) if root else None
+        self.max_tenants = max_tenants
+        self.idle_ttl = idle_ttl
+        self.default = Tenant(DEFAULT_TENANT, RESTAURANT_NAME, MENU_PATH)
+        self.loaded = OrderedDict()  # id -> Tenant, del menos al más reciente
+        self.stats = {"loads": 0, "evictions": 0, "unknown": 0}
+
+    def get(self, tid):
+        """Tenant `tid` (cargándolo si hace falta) o None si no existe."""
+        if tid == DEFAULT_TENANT:
+            return self.default
+        t = self.loaded.get(tid)
+        if t is not None:
+            self.loaded.move_to_end(tid)
+            t.last_used = time.time()
+            return t
+        if self.root is None or not _TENANT_ID_RE.match(tid or ""):
+            self.stats["unknown"] += 1
+            return None
+        base = self.root / tid
+        if not (base / "menu.json").exists():
+            self.stats["unknown"] += 1
+            return None
+        conf = {}
+        if (base / "tenant.json").exists():
+            try:
+                conf = json.loads((base / "tenant.json").read_text(encoding="utf-8"))
+            except ValueError:
+                log.warning("[tenants] tenant.json inválido en %s", base)
+        t = self.loaded[tid] = Tenant(tid, str(conf.get("name") or tid), base / "menu.json")
+        self.stats["loads"] += 1
+        while len(self.loaded) > self.max_tenants:
+            self.loaded.popitem(last=False)
+            self.stats["evictions"] += 1
+        return t
+
+    def reap(self, now=None):
+        cutoff = (time.time() if now is None else now) - self.idle_ttl
+        idle = [tid for tid, t in self.loaded.items() if t.last_used < cutoff]
+        for tid in idle:
+            del self.loaded[tid]
+        self.stats["evictions"] += len(idle)
+        return len(idle)
+
+    def snapshot(self):
+        return {"enabled": self.root is not None, "loaded": len(self.loaded), **self.stats}
+
+    def check_reload(self):
+        for t in [self.default, *self.loaded.values()]:
+            t.check_reload()
+
+MENU_WATCH_INTERVAL = env_float("MENU_WATCH_INTERVAL", 2.0)  # 0 = sin hot reload
+
+def menu_watcher():
+    while True:
+        socketio.sleep(MENU_WATCH_INTERVAL)
+        try:
+            TENANTS.check_reload()
+        except Exception:
+            log.exception("[menu-watcher] failed")
+
+def current_tenant_id():
+    if has_request_context():
+        return request.environ.get("app.tenant", DEFAULT_TENANT)
+    return DEFAULT_TENANT
+
+def current_tenant():
+    """Tenant del request/socket actual; fuera de un request, el default."""
+    if not has_request_context():
+        return TENANTS.default
+    t = request.environ.get("app.tenant_obj")
+    if t is None:
+        t = TENANTS.get(current_tenant_id()) or TENANTS.default
+    return t
+
+# client_id viene del navegador (uuid de app.js) o de integraciones: sin "/"
+# ni ":", si no "foo/a" del tenant default sería la clave de "a" en el tenant
+# foo y "tenant:x" la sala de broadcast de otro tenant.
+_CLIENT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class InvalidClientId(ValueError):
+    def __init__(self, client_id):
+        super().__init__(f"invalid client_id {client_id!r} (expected [A-Za-z0-9_-]{{1,64}})")
+
+def valid_client_id(client_id):
+    return bool(_CLIENT_ID_RE.match(client_id or ""))
+
+def tenant_key(client_id):
+    """Clave de estado / sala Socket.IO del cliente dentro del tenant actual.
+
+    InvalidClientId si `client_id` no cumple _CLIENT_ID_RE: todo acceso al
+    estado por cliente pasa por aquí, así que es el único punto de control."""
+    if not client_id:
+        return client_id
+    if not _CLIENT_ID_RE.match(client_id):
+        raise InvalidClientId(client_id)
+    tid = current_tenant_id()
+    if tid == DEFAULT_TENANT:
+        return client_id
+    return f"{tid}/{client_id}"
+
+def tenant_room(tid=None):
+    return "tenant:" + (tid or current_tenant_id())
+
+class TenantMiddleware:
+    """Resuelve el tenant por prefijo /t/<id> o por host antes de Flask y Socket.IO."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        tid = DEFAULT_TENANT
+        if TENANTS_DIR:
+            m = _TENANT_PATH_RE.match(environ.get("PATH_INFO", ""))
+            if m:
+                tid = m.group(1)
+                environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + "/t/" + tid
+                environ["PATH_INFO"] = m.group(2) or "/"
+            elif TENANT_HOST_SUFFIX:
+                host = (environ.get("HTTP_HOST") or "").split(":")[0].lower()
+                if host.endswith(TENANT_HOST_SUFFIX) and len(host) > len(TENANT_HOST_SUFFIX):
+                    tid = host[:-len(TENANT_HOST_SUFFIX)]
+        environ["app.tenant"] = tid
+        return self.wsgi_app(environ, start_response)
+
+class _TenantScopedMap(MutableMapping):
+    __slots__ = ("_map",)
+
+    def __init__(self, mapping):
+        self._map = mapping
+
+    def get(self, client_id, default=None):
+        return self._map.get(tenant_key(client_id), default)
+
+    def __getitem__(self, client_id):
+        return self._map[tenant_key(client_id)]
+
+    def __setitem__(self, client_id, value):
+        self._map[tenant_key(client_id)] = value
 
-MENU_CACHE = normalize_menu(load_menu())
-INSTRUCTIONS_CACHE = build_menu_prompt(MENU_CACHE)
+    def __delitem__(self, client_id):
+        del self._map[tenant_key(client_id)]
 
-# Estado
-CARTS = {}             # client_id -> [{name, price, img_ref, qty}]
-ORDER_STATUS = {}      # client_id -> int (0..5)
-CHECKOUT_PREFILL = {}  # client_id -> dict {raw, cleaned, valid}
+    def __contains__(self, client_id):
+        return tenant_key(client_id) in self._map
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __len__(self):
+        return len(self._map)
+
+class TenantScopedStore:
+    """Vista de STORE donde cada client_id se traduce con tenant_key()."""
+
+    def __init__(self, store):
+        self.store = store
+        self.carts = _TenantScopedMap(store.carts)
+        self.order_status = _TenantScopedMap(store.order_status)
+        self.checkout_prefill = _TenantScopedMap(store.checkout_prefill)
+
+    def transaction(self, client_id):
+        return self.store.transaction(tenant_key(client_id))
+
+    def touch(self, client_id):
+        self.store.touch(tenant_key(client_id))
+
+    def seen_at(self, client_id):
+        return self.store.seen_at(tenant_key(client_id))
+
+    def client_count(self):
+        return self.store.client_count()
+
+    def stats(self):
+        return self.store.stats()
+
+TENANTS = TenantRegistry(TENANTS_DIR, env_int("TENANT_MAX", 200), env_float("TENANT_IDLE_TTL", 1800))
+app.wsgi_app = TenantMiddleware(app.wsgi_app)  # por fuera del middleware de Socket.IO
+SESSION_POOL = SessionPool(env_int("SESSION_POOL_SIZE", 0), env_float("SESSION_POOL_REFRESH_MARGIN", 15.0))
+
+# Estado: STORE con claves crudas (reaper, journal); STATE/CARTS/... ven el tenant actual.
+JOURNAL = make_journal((os.getenv("STATE_BACKEND") or "memory").strip().lower())
+STORE = make_state_store(JOURNAL)
+STATE = TenantScopedStore(STORE)
+CARTS = STATE.carts                        # client_id -> Cart
+ORDER_STATUS = STATE.order_status          # client_id -> int (0..5)
+CHECKOUT_PREFILL = STATE.checkout_prefill  # client_id -> dict {raw, cleaned, valid, missing, checks}
 
 def get_cart_for(client_id):
-    return CARTS.get(client_id, [])
+    # Ojo: un Cart vacío es falsy (__len__), y hay que conservar su version/cleared.
+    cart = CARTS.get(client_id)
+    return cart if cart is not None else Cart()
+
+def priced_cart_for(client_id):
+    """Como get_cart_for, pero si el menú cambió desde que se cotizó alguna
+    línea la recotiza (y emite el cart_update) antes de devolverlo."""
+    cart = get_cart_for(client_id)
+    if client_id and cart.stale(current_tenant().snapshot.generation):
+        apply_cart_ops_for(client_id, [])
+        cart = get_cart_for(client_id)
+    return cart
 
 def compute_base_status_for_client(client_id):
     return 0 if len(get_cart_for(client_id)) == 0 else 1
@@ -218,75 +2559,711 @@ def set_order_status(client_id, new_status, announce=True, extra=None):
     if isinstance(extra, dict):
         payload.update(extra)
     if announce and changed:
-        socketio.emit("order_status", payload, to=client_id)
+        emit_event("order_status", payload, tenant_key(client_id))
         log.info("[order-status] %s -> %s (%s)", prev, new_status, client_id)
     return {"prev": prev, "next": int(new_status), "changed": changed}
 
+# ---- Validación de prefill: un validador por campo, patrones precompilados ----
+# Cada validador recibe el valor crudo y devuelve (ok, clave de `cleaned`, valor).
+# CHECKOUT_PREFILL guarda ese resultado por campo en `checks`, así un parche
+# parcial solo revalida los campos que cambiaron.
+_NON_DIGITS_RE = re.compile(r"\D+")
+_EMAIL_RE = re.compile(r"^[^\s@]+@[^\s@]+\.[^\s@]+$")
+_EXP_RE = re.compile(r"^(\d{2})/\d{2}$")
+
+def _check_name(v):
+    name = v.strip()
+    return (bool(name), "name", name)
+
+def _check_phone(v):
+    phone = _NON_DIGITS_RE.sub("", v)
+    return (len(phone) >= 7, "phone", phone)
+
+def _check_email(v):
+    email = v.strip()
+    return (_EMAIL_RE.match(email) is not None, "email", email)
+
+def _check_card(v):
+    card = _NON_DIGITS_RE.sub("", v)
+    return (13 <= len(card) <= 19, "card_last4", card[-4:])
+
+def _check_exp(v):
+    exp = v.strip()
+    m = _EXP_RE.match(exp)
+    return (m is not None and 1 <= int(m.group(1)) <= 12, "exp", exp)
+
+def _check_cvv(v):
+    cvv = _NON_DIGITS_RE.sub("", v)
+    return (len(cvv) in (3, 4), "cvv_len", len(cvv))
+
+PREFILL_VALIDATORS = {
+    "name": _check_name,
+    "phone": _check_phone,
+    "email": _check_email,
+    "card": _check_card,
+    "exp": _check_exp,
+    "cvv": _check_cvv,
+}
+_PREFILL_FIELDS = tuple(PREFILL_VALIDATORS)  # orden de `missing`
+
+def validate_prefill_fields(raw, fields=None, checks=None):
+    """Revalida `fields` (todos si None) sobre los `checks` previos.
+
+    Devuelve (ok, missing, cleaned, checks).
+    """
+    checks = {} if checks is None else dict(checks)
+    for f in (_PREFILL_FIELDS if fields is None else fields):
+        checks[f] = PREFILL_VALIDATORS[f](str(raw.get(f, "")))
+    results = [checks[f] for f in _PREFILL_FIELDS]
+    missing = [f for f, c in zip(_PREFILL_FIELDS, results) if not c[0]]
+    cleaned = {c[1]: c[2] for c in results}
+    return not missing, missing, cleaned, checks
+
 def validate_prefill(data):
-    data = data or {}
-    name = str(data.get("name","")).strip()
-    phone = re.sub(r"\D+", "", str(data.get("phone","")))
-    email = str(data.get("email","")).strip()
-    card = re.sub(r"\D+", "", str(data.get("card","")))
-    exp  = str(data.get("exp","")).strip()
-    cvv  = re.sub(r"\D+", "", str(data.get("cvv","")))
-
-    missing = []
-
-    if not name: missing.append("name")
-    if len(phone) < 7: missing.append("phone")
-    if not re.match(r"^[^\s@]+@[^\s@]+\.[^\s@]+$", email or ""): missing.append("email")
-    if not (13 <= len(card) <= 19): missing.append("card")
-    if not re.match(r"^\d{2}/\d{2}$", exp or ""):
-        missing.append("exp")
-    else:
-        try:
-            mm = int(exp[:2])
-            if not (1 <= mm <= 12):
-                missing.append("exp")
-        except Exception:
-            missing.append("exp")
-    if not (len(cvv) in (3,4)): missing.append("cvv")
-
-    ok = (len(missing) == 0)
-    cleaned = {
-        "name": name, "phone": phone, "email": email,
-        "card_last4": card[-4:] if card else "",
-        "exp": exp, "cvv_len": len(cvv)
-    }
+    ok, missing, cleaned, _checks = validate_prefill_fields(data or {})
     return ok, missing, cleaned
 
 # ---- NUEVO: fusión parcial de prefill por cliente ----
-_ALLOWED_PREFILL_KEYS = {"name","phone","email","card","exp","cvv"}
+_ALLOWED_PREFILL_KEYS = set(_PREFILL_FIELDS)
 
 def merge_prefill_patch(client_id, patch):
     st = CHECKOUT_PREFILL.get(client_id) or {"raw": {}, "cleaned": {}, "valid": False}
     raw = dict(st.get("raw") or {})
-    patch = patch or {}
-    for k, v in patch.items():
-        if k in _ALLOWED_PREFILL_KEYS and v is not None:
+    changed = []
+    for k, v in (patch or {}).items():
+        if k in _ALLOWED_PREFILL_KEYS and v is not None and raw.get(k) != str(v):
             raw[k] = str(v)
-    ok, missing, cleaned = validate_prefill(raw)
-    CHECKOUT_PREFILL[client_id] = {"raw": raw, "cleaned": cleaned, "valid": ok}
+            changed.append(k)
+    checks = st.get("checks")
+    if checks is None:  # entrada previa sin cache por campo
+        changed = None
+    elif not changed:
+        return st["valid"], list(st.get("missing") or []), raw
+    ok, missing, cleaned, checks = validate_prefill_fields(raw, changed, checks)
+    CHECKOUT_PREFILL[client_id] = {"raw": raw, "cleaned": cleaned, "valid": ok,
+                                   "missing": missing, "checks": checks}
     return ok, missing, raw
 
+def stored_prefill(client_id):
+    """(ok, missing, raw) del prefill guardado, sin revalidar si ya está cacheado."""
+    st = CHECKOUT_PREFILL.get(client_id) or {"raw": {}, "valid": False}
+    raw = dict(st.get("raw") or {})
+    if "checks" in st:
+        return st["valid"], list(st.get("missing") or []), raw
+    ok, missing, _cleaned = validate_prefill(raw)
+    return ok, missing, raw
+
+# ======================
+# Historial de pedidos + "se suele pedir con"
+# ======================
+# Con ORDER_HISTORY_DB=data/orders.db cada pedido que llega a 5 se guarda en
+# SQLite (una fila: tenant, cliente, total, [[clave, qty, centavos], ...]).
+# Como el journal, los handlers nunca tocan disco: `record` encola (después
+# de confirmar la transacción del cliente) y el mismo job lo escribe por lotes
+# vía eventlet.tpool; los modelos se construyen en ese job, no al importar.
+# Un job en segundo plano lee las filas nuevas (cursor por id, así que con
+# varios workers cada uno alcanza a todos) y actualiza por tenant la matriz
+# de co-ocurrencia y la popularidad, y el top-K de vecinos solo de los ítems
+# tocados. /api/menu/suggest y la tool suggest_items leen ese top-K: el
+# costo depende del tamaño del carrito, no del historial.
+
+ORDER_LINES_MAX = 50  # líneas por pedido que entran en la matriz (pares = n²)
+
+class CoPurchase:
+    __slots__ = ("orders", "counts", "pairs", "top", "popular")
+
+    def __init__(self):
+        self.orders = 0
+        self.counts = {}   # clave -> pedidos que la incluyen
+        self.pairs = {}    # clave -> {otra clave: pedidos con ambas}
+        self.top = {}      # clave -> [(otra, co), ...] los K mayores
+        self.popular = []  # [(clave, pedidos), ...] los K mayores
+
+    def add(self, keys, touched):
+        self.orders += 1
+        for a in keys:
+            self.counts[a] = self.counts.get(a, 0) + 1
+            row = self.pairs.setdefault(a, {})
+            for b in keys:
+                if b != a:
+                    row[b] = row.get(b, 0) + 1
+            touched.add(a)
+
+    def refresh(self, touched, k):
+        by_count = lambda kv: (kv[1], kv[0])
+        for a in touched:
+            self.top[a] = heapq.nlargest(k, self.pairs[a].items(), key=by_count)
+        self.popular = heapq.nlargest(k, self.counts.items(), key=by_count)
+
+class OrderHistory:
+    def __init__(self, path, refresh_interval=5.0, top_k=20, flush_interval=0.5):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        self.top_k = top_k
+        self.pending = []  # filas por escribir: (tenant, client_id, ts, total, lines_json)
+        self.conn = sqlite3.connect(str(path), timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS orders ("
+            " id INTEGER PRIMARY KEY, tenant TEXT NOT NULL, client_id TEXT NOT NULL,"
+            " ts REAL NOT NULL, total_cents INTEGER NOT NULL, lines TEXT NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.cursor = 0   # último id aplicado a los modelos
+        self.models = {}  # tenant -> CoPurchase
+        self.stats = {"recorded": 0, "applied": 0, "refresh_ms": 0.0}
+
+    def record(self, tenant, client_id, lines):
+        """Encola el pedido; lo escribe `flush` desde el job (sin I/O en el handler)."""
+        if not lines:
+            return False
+        total = sum(int(qty) * int(cents) for _k, qty, cents in lines)
+        self.pending.append((tenant, client_id, time.time(), total, json.dumps(lines, separators=(",", ":"))))
+        return True
+
+    def _insert(self, rows):
+        # hilo de tpool: un busy_timeout largo aquí no frena el hub
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO orders (tenant, client_id, ts, total_cents, lines) VALUES (?, ?, ?, ?, ?)", rows)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _select(self, cursor, batch):
+        return self.conn.execute(
+            "SELECT id, tenant, lines FROM orders WHERE id > ? ORDER BY id LIMIT ?", (cursor, batch)
+        ).fetchall()
+
+    def flush(self):
+        """Escribe los pedidos encolados en un lote; si falla, vuelven a la cola."""
+        if not self.pending:
+            return 0
+        rows, self.pending = self.pending, []
+        try:
+            with self.lock:
+                eventlet.tpool.execute(self._insert, rows)
+        except Exception:
+            self.pending[:0] = rows
+            raise
+        self.stats["recorded"] += len(rows)
+        return len(rows)
+
+    def close(self):
+        try:
+            with self.lock:
+                if self.pending:
+                    self._insert(self.pending)
+                    self.pending = []
+        except Exception:
+            log.exception("[orders] flush al cerrar falló")
+
+    def refresh(self, batch=5000):
+        """Aplica a los modelos los pedidos con id > cursor."""
+        t0 = time.perf_counter()
+        touched = {}
+        while True:
+            with self.lock:
+                rows = eventlet.tpool.execute(self._select, self.cursor, batch)
+            for oid, tenant, raw in rows:
+                keys = list(dict.fromkeys(k for k, _qty, _cents in json.loads(raw)))[:ORDER_LINES_MAX]
+                self.models.setdefault(tenant, CoPurchase()).add(keys, touched.setdefault(tenant, set()))
+                self.cursor = oid
+            self.stats["applied"] += len(rows)
+            if len(rows) < batch:
+                break
+            socketio.sleep(0)  # historial grande: ceder el hub entre lotes
+        for tenant, keys in touched.items():
+            self.models[tenant].refresh(keys, self.top_k)
+        self.stats["refresh_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        return sum(len(t) for t in touched.values())
+
+    def suggest(self, tenant, keys, limit):
+        """[(clave, score, motivo)]: co-ocurrencia con `keys` (confianza sumada) y luego populares."""
+        model = self.models.get(tenant)
+        if model is None:
+            return []
+        in_cart = set(keys)
+        scores = {}
+        for a in in_cart:
+            n = model.counts.get(a)
+            for b, co in model.top.get(a, ()):
+                if b not in in_cart:
+                    scores[b] = scores.get(b, 0.0) + co / n
+        out = [(b, round(sc, 4), "bought_with")
+               for b, sc in sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))]
+        seen = in_cart | scores.keys()
+        out.extend((b, round(n / model.orders, 4), "popular") for b, n in model.popular if b not in seen)
+        return out[:limit * 2]  # holgura para ítems que ya no están en el menú
+
+    def run(self):
+        """Primera vuelta: construye los modelos con todo el historial. Después
+        escribe lo encolado cada flush_interval y aplica lo nuevo cada refresh_interval."""
+        next_refresh = 0.0
+        while True:
+            try:
+                self.flush()
+                if time.monotonic() >= next_refresh:
+                    self.refresh()
+                    next_refresh = time.monotonic() + self.refresh_interval
+            except Exception:
+                log.exception("[orders] flush/refresh failed")
+            socketio.sleep(self.flush_interval)
+
+    def snapshot(self):
+        return {"path": str(self.path), "cursor": self.cursor, "tenants": len(self.models), "pending": len(self.pending),
+                "orders": sum(m.orders for m in self.models.values()), **self.stats}
+
+def make_order_history():
+    path = (os.getenv("ORDER_HISTORY_DB") or "").strip()
+    if not path:
+        return None
+    return OrderHistory(path, env_float("ORDER_HISTORY_REFRESH", 5.0), env_int("ORDER_SUGGEST_TOP_K", 20))
+
+ORDERS = make_order_history()
+
+def suggest_for(client_id, limit=None):
+    """Respuesta de /api/menu/suggest y de la tool suggest_items."""
+    try:
+        limit = max(1, min(10, int(limit or 3)))
+    except (TypeError, ValueError):
+        limit = 3
+    cart = priced_cart_for(client_id) if client_id else Cart()
+    if ORDERS is None:
+        return {"ok": True, "enabled": False, "client_id": client_id, "items": []}
+    exact = current_tenant().snapshot.index["exact"]
+    items = []
+    for key, score, reason in ORDERS.suggest(current_tenant_id(), list(cart.lines), limit):
+        it = exact.get(key)
+        if it is not None:
+            items.append(dict(it, score=score, reason=reason))
+            if len(items) == limit:
+                break
+    return {"ok": True, "enabled": True, "client_id": client_id,
+            "based_on": [ln.name for ln in cart], "items": items}
+
 # ======================
 # Socket.IO
 # ======================
 
+# ---- Emits diferidos: /api/batch junta los eventos de todas sus entradas ----
+class EmitBatch:
+    """Eventos de un request batch agrupados por (evento, sala).
+
+    Al final salen en una sola pasada: varios cart_update seguidos de un
+    mismo cliente se fusionan en uno (deltas concatenados; un snapshot
+    reemplaza lo anterior) y de order_status solo importa el último.
+    """
+
+    def __init__(self):
+        self.groups = {}  # (evento, sala) -> [payload, ...], en orden de llegada
+        self.queued = 0
+
+    def add(self, event, payload, room):
+        self.queued += 1
+        self.groups.setdefault((event, room), []).append(payload)
+
+    def flush(self):
+        sent = 0
+        for (event, room), payloads in self.groups.items():
+            merged = _merge_payloads(event, payloads)
+            for p in merged:
+                socketio.emit(event, p, to=room)
+            sent += len(merged)
+            COALESCED.inc((event, "sent"), len(merged))
+            if len(payloads) > len(merged):
+                COALESCED.inc((event, "suppressed"), len(payloads) - len(merged))
+        self.groups.clear()
+        return sent
+
+def _merge_payloads(event, payloads):
+    if event == "order_status":
+        return payloads[-1:]
+    if event != "cart_update":
+        return payloads
+    out = [payloads[0]]
+    for p in payloads[1:]:
+        prev = out[-1]
+        if "deltas" not in p:
+            out = [p]
+        elif "deltas" in prev and p.get("base") == prev["version"] and p.get("epoch") == prev.get("epoch"):
+            out[-1] = dict(prev, version=p["version"], deltas=prev["deltas"] + p["deltas"])
+        else:
+            out.append(p)
+    return out
+
+def emit_event(event, payload, room):
+    """socketio.emit, o a la EmitBatch del request si hay una activa."""
+    batch = request.environ.get("app.emit_batch") if has_request_context() else None
+    if batch is not None:
+        batch.add(event, payload, room)
+    else:
+        socketio.emit(event, payload, to=room)
+
+class EmitCoalescer:
+    """Emits "último gana" por sala.
+
+    El primer evento de una sala sale enseguida; los que llegan dentro de
+    `window` segundos se pisan entre sí y solo el último sale al cerrarse la
+    ventana. Así una ráfaga de update_front manda a lo sumo dos eventos.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.last_sent = {}  # sala -> monotonic del último emit
+        self.pending = {}    # sala -> (evento, payload) esperando a que cierre la ventana
+
+    def emit(self, event, data, room):
+        if self.window <= 0:
+            return self._send(room, event, data, time.monotonic())
+        now = time.monotonic()
+        prev = self.pending.get(room)
+        if prev is not None:
+            self.pending[room] = (event, data)
+            COALESCED.inc((prev[0], "suppressed"))
+            return False
+        last = self.last_sent.get(room)
+        if last is None or now - last >= self.window:
+            return self._send(room, event, data, now)
+        self.pending[room] = (event, data)
+        socketio.start_background_task(self._flush_later, room, last + self.window - now)
+        return False
+
+    def _flush_later(self, room, delay):
+        socketio.sleep(delay)
+        item = self.pending.pop(room, None)
+        if item is not None:
+            self._send(room, item[0], item[1], time.monotonic())
+
+    def _send(self, room, event, data, now):
+        if len(self.last_sent) >= 4096:
+            cutoff = now - self.window
+            self.last_sent = {r: t for r, t in self.last_sent.items() if t >= cutoff}
+        self.last_sent[room] = now
+        socketio.emit(event, data, to=room)
+        COALESCED.inc((event, "sent"))
+        return True
+
+RECOMMEND = EmitCoalescer(env_float("RECOMMEND_COALESCE_MS", 150) / 1000.0)
+
+def recommend_names(names, client_id=None):
+    """Resalta `names` en el kiosko de `client_id` (sin cliente: todo el tenant)."""
+    names = [str(n or "").strip() for n in names if str(n or "").strip()]
+    if client_id:
+        RECOMMEND.emit("recommend", {"client_id": client_id, "names": names}, tenant_key(client_id))
+    else:
+        RECOMMEND.emit("recommend", {"names": names}, tenant_room())
+    return names
+
+def recommend_reset(client_id=None):
+    if client_id:
+        RECOMMEND.emit("reset", {"client_id": client_id, "ok": True}, tenant_key(client_id))
+    else:
+        RECOMMEND.emit("reset", {"ok": True}, tenant_room())
+
+def order_status_for(client_id):
+    STATE.touch(client_id)
+    return ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
+
+def cart_state_for(client_id, since=None, epoch=None):
+    """Snapshot, o deltas desde `since` si `epoch` (cuando viene) es el del carrito actual."""
+    STATE.touch(client_id)
+    cart = priced_cart_for(client_id)
+    total = cart_total(cart)
+    status = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
+    out = {"ok": True, "client_id": client_id, "version": cart.version, "epoch": cart.epoch,
+           "total": total, "order_status": status}
+    if epoch is not None and str(epoch) != str(cart.epoch):
+        since = None
+    if since is not None:
+        try:
+            deltas = cart.deltas_since(int(since))
+        except ValueError:
+            deltas = None
+        if deltas is not None:
+            out.update({"since": int(since), "deltas": deltas})
+            return out
+    out["cart"] = cart.to_list()
+    return out
+
+def parse_if_match(value):
+    """`If-Match: "7"` / `W/"7"` / `7` -> 7; None si no viene o no es un entero."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        return None
+
+def apply_cart_ops_for(client_id, ops, expected_version=None):
+    """Aplica `ops`, emite `cart_update` y ajusta el order_status 0/1/2.
+
+    Con `expected_version` es un compare-and-set: si el carrito ya no está
+    en esa versión no se toca y se responde 409 con el estado actual.
+    Devuelve (respuesta, status HTTP).
+    """
+    with STATE.transaction(client_id):
+        new_cart = get_cart_for(client_id)
+        base = new_cart.version
+        if expected_version is not None and expected_version != base:
+            return {"ok": False, "error": "version_conflict", "client_id": client_id,
+                    "version": base, "epoch": new_cart.epoch, "expected_version": expected_version,
+                    "cart": new_cart.to_list()}, 409
+        apply_ops_to_cart(new_cart, ops)
+        CARTS[client_id] = new_cart
+        cart_list = new_cart.to_list()
+
+        # Solo deltas: el cliente los aplica si su versión == base, si no
+        # pide /api/cart/state?since=<su versión>. Si los cambios no caben
+        # en el log se manda el snapshot.
+        deltas = new_cart.deltas_since(base)
+        if deltas is None:
+            payload = {"client_id": client_id, "epoch": new_cart.epoch, "version": new_cart.version, "cart": cart_list}
+        elif deltas:
+            payload = {"client_id": client_id, "epoch": new_cart.epoch, "base": base, "version": new_cart.version, "deltas": deltas}
+        else:
+            payload = None
+        if payload is not None:
+            emit_event("cart_update", payload, tenant_key(client_id) if client_id else tenant_room())
+
+        cur_status = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
+        if cur_status in (0, 1, 2):
+            if len(new_cart) == 0:
+                set_order_status(client_id, 0, announce=True)
+            else:
+                new_status = 2 if cur_status == 2 else 1
+                set_order_status(client_id, new_status, announce=True)
+
+    return {"ok": True, "applied": len(ops), "cart": cart_list, "version": new_cart.version,
+            "epoch": new_cart.epoch, "client_id": client_id}, 200
+
 @socketio.on("register")
 def on_register(data):
-    client_id = (data or {}).get("client_id", "").strip()
+    client_id = str((data or {}).get("client_id") or "").strip()
+    if client_id and not valid_client_id(client_id):
+        log.warning("[socket-register] client_id inválido: %r", client_id[:80])
+        return
     if client_id:
-        join_room(client_id)
-        if client_id not in ORDER_STATUS:
-            ORDER_STATUS[client_id] = compute_base_status_for_client(client_id)
-        log.info("[socket-register] client_id=%s status=%s", client_id, ORDER_STATUS[client_id])
+        join_room(tenant_key(client_id))
+        with STATE.transaction(client_id):
+            if client_id not in ORDER_STATUS:
+                ORDER_STATUS[client_id] = compute_base_status_for_client(client_id)
+            status = ORDER_STATUS[client_id]
+        log.info("[socket-register] client_id=%s status=%s", client_id, status)
+
+# ---- Tools del modelo por Socket.IO: un evento + ack por tool call ----
+def added_names(ops):
+    names = []
+    for op in ops:
+        if not isinstance(op, dict):
+            continue
+        kind = str(op.get("op") or "").lower()
+        nm = str(op.get("name") or "").strip()
+        try:
+            qty = int(op.get("qty"))
+        except (TypeError, ValueError):
+            qty = 1 if kind == "add" else 0
+        if kind in ("add", "set") and nm and qty > 0 and nm not in names:
+            names.append(nm)
+    return names
+
+def _tool_update_front(client_id, args):
+    return {"ok": True, "names": recommend_names(args.get("names") or [], client_id)}
+
+def _tool_update_cart(client_id, args):
+    if str(args.get("action") or "apply").lower() == "clear":
+        res, _code = apply_cart_ops_for(client_id, [{"op": "clear"}])
+        recommend_reset(client_id)
+        return {"ok": True, "action": "clear", "version": res["version"]}
+    ops = args.get("ops") or []
+    res, _code = apply_cart_ops_for(client_id, ops, parse_if_match(args.get("expected_version")))
+    if not res["ok"]:
+        return res
+    names = added_names(ops)
+    if names:
+        recommend_names(names, client_id)
+    return {"ok": True, "action": "apply", "applied": len(ops), "version": res["version"]}
+
+def _tool_get_cart(client_id, args):
+    return cart_state_for(client_id, args.get("since"), args.get("epoch"))
+
+def _tool_get_order_status(client_id, args):
+    return {"ok": True, "status": order_status_for(client_id)}
+
+def _tool_transition_order_status(client_id, args):
+    if args.get("to") == 5:
+        apply_cart_ops_for(client_id, [{"op": "clear"}])
+    res, _code = transition_order_status(client_id, args)
+    return res
+
+def _tool_search_menu(client_id, args):
+    return search_menu_result(args.get("query"), args.get("limit"))
+
+def _tool_suggest_items(client_id, args):
+    return suggest_for(client_id, args.get("limit"))
+
+TOOL_HANDLERS = {
+    "update_front": _tool_update_front,
+    "update_cart": _tool_update_cart,
+    "get_cart": _tool_get_cart,
+    "get_order_status": _tool_get_order_status,
+    "transition_order_status": _tool_transition_order_status,
+    "search_menu": _tool_search_menu,
+    "suggest_items": _tool_suggest_items,
+}
+
+@socketio.on("tool_call")
+def on_tool_call(data):
+    """{client_id, name, args} -> el resultado de la tool vuelve en el ack."""
+    data = data or {}
+    name = str(data.get("name") or "")
+    client_id = str(data.get("client_id") or "").strip()
+    args = data.get("args") if isinstance(data.get("args"), dict) else {}
+    handler = TOOL_HANDLERS.get(name)
+    if handler is None:
+        return {"ok": False, "error": f"Tool '{name or 'unknown'}' not implemented"}
+    if not client_id:
+        return {"ok": False, "error": "missing client_id"}
+    if not valid_client_id(client_id):
+        return {"ok": False, "error": str(InvalidClientId(client_id))}
+    if name == "update_cart":
+        err = invalid_ops(args.get("ops") or [])
+        if err:
+            return {"ok": False, "error": err}
+        limited = rate_limited(CART_LIMIT, "tool_call:update_cart", client_id)
+        if limited is not None:
+            return limited[0]
+    # Los argumentos vienen del modelo: cualquier error vuelve en el ack,
+    # si no el cliente espera hasta su timeout.
+    try:
+        return handler(client_id, args)
+    except (TypeError, ValueError, AttributeError) as e:
+        return {"ok": False, "error": str(e)}
+    except StateBusy:
+        return {"ok": False, "error": "state_busy", "retry_after": 1}
+    except Exception:
+        log.exception("[tool_call] %s falló", name)
+        return {"ok": False, "error": f"Tool '{name}' failed"}
+
+# ---- Instrumentación de rutas y sockets ----
+CONNECTED_SOCKETS = [0]
+
+@socketio.on("connect")
+def on_connect(auth=None):
+    if current_tenant_id() != DEFAULT_TENANT and TENANTS.get(current_tenant_id()) is None:
+        return False
+    CONNECTED_SOCKETS[0] += 1
+    join_room(tenant_room())
+
+@socketio.on("disconnect")
+def on_disconnect():
+    CONNECTED_SOCKETS[0] -= 1
+
+@app.before_request
+def _metrics_start():
+    request.environ["metrics.t0"] = time.perf_counter()
+
+@app.before_request
+def _resolve_tenant():
+    tid = current_tenant_id()
+    if tid != DEFAULT_TENANT:
+        tenant = TENANTS.get(tid)
+        if tenant is None:
+            return {"ok": False, "error": f"unknown tenant {tid!r}"}, 404
+        request.environ["app.tenant_obj"] = tenant
+
+def _metrics_observe(status):
+    t0 = request.environ.get("metrics.t0")
+    if t0 is None:
+        return
+    rule = request.url_rule
+    key = (rule.rule if rule is not None else "unmatched", request.method)
+    HTTP_LATENCY.observe(key, time.perf_counter() - t0)
+    HTTP_REQUESTS.inc(key + (status,))
+    request.environ["metrics.t0"] = None
+
+@app.after_request
+def _metrics_after(response):
+    _metrics_observe(response.status_code)
+    return response
+
+@app.errorhandler(InvalidClientId)
+def _invalid_client_id(e):
+    return {"ok": False, "error": str(e)}, 400
+
+@app.errorhandler(StateBusy)
+def _state_busy(e):
+    rule = request.url_rule
+    SHED.inc((rule.rule if rule is not None else "unmatched", "state_busy"))
+    log.warning("[state] %s: %s", request.path, e)
+    return {"ok": False, "error": "state_busy", "retry_after": 1}, 503, {"Retry-After": "1"}
+
+@app.teardown_request
+def _metrics_teardown(exc):
+    if exc is not None:
+        _metrics_observe(500)
+
+metric(Gauge("state_clients", "Clientes con estado (carrito/estado/prefill).", STORE.client_count))
+metric(Gauge("state_carts", "Entradas en CARTS.", lambda: len(STORE.carts)))
+metric(Gauge("state_order_status", "Entradas en ORDER_STATUS.", lambda: len(STORE.order_status)))
+metric(Gauge("tenants_loaded", "Tenants con menú cargado (sin contar el default).", lambda: len(TENANTS.loaded)))
+metric(Gauge("socketio_connected", "Sockets conectados a este worker.", lambda: CONNECTED_SOCKETS[0]))
+metric(Gauge("session_pool_ready", "Sesiones Realtime pre-minteadas listas.", lambda: SESSION_POOL.snapshot().get("ready")))
+metric(Gauge("state_evictions_total", "Clientes expulsados por el reaper.",
+             lambda: {(k,): v for k, v in STATE_EVICTIONS.items() if k != "runs"}, ("reason",), kind="counter"))
+metric(Gauge("process_resident_memory_bytes", "RSS del proceso.", process_rss_bytes))
+
+@app.get("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 # ======================
 # Rutas
 # ======================
 
+ASSETS, ASSETS_BY_URL = build_asset_manifest(app.static_folder)
+
+@app.context_processor
+def _asset_helpers():
+    def asset_url(name):
+        a = ASSETS.get(name)
+        if a is None:
+            return url_for("static", filename=name)
+        return url_for("asset", name=a.url_name)
+    return {"asset_url": asset_url}
+
+@app.get("/assets/<name>")
+def asset(name):
+    a = ASSETS_BY_URL.get(name)
+    if a is None:
+        return {"ok": False, "error": "unknown asset"}, 404
+    return encoded_response(a.body, a.gzipped, a.brotli, a.mimetype, a.etag, IMMUTABLE)
+
+@app.get("/img/<int:generation>/<key>")
+def menu_image(generation, key):
+    """Miniatura de un img_ref del menú (?w= se ajusta a IMAGE_WIDTHS)."""
+    snap = current_tenant().snapshot
+    img_ref = snap.images.get(key)
+    if img_ref is None:
+        return {"ok": False, "error": "unknown image"}, 404
+    try:
+        path, mimetype, etag = IMAGES.get(img_ref, IMAGES.pick_width(request.args.get("w")))
+    except ImageError as e:
+        log.warning("[images] %s: %s", img_ref, e)
+        return {"ok": False, "error": "image unavailable"}, 404
+    resp = send_file(path, mimetype=mimetype, etag=etag, conditional=True)
+    # La URL lleva la generación: mientras sea la vigente, el contenido no cambia.
+    resp.headers["Cache-Control"] = IMMUTABLE if generation == snap.generation else "no-cache"
+    return resp
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -297,59 +3274,193 @@ def settings():
 
 @app.route("/api/menu", methods=["GET","POST"])
 def api_menu():
-    global MENU_CACHE, INSTRUCTIONS_CACHE
+    tenant = current_tenant()
     if request.method == "GET":
-        return app.send_static_file("menu.json")
+        return menu_response(tenant.snapshot.payload)
     else:
         payload = request.get_json(force=True, silent=True) or []
-        MENU_CACHE = normalize_menu(payload)
-        MENU_PATH.write_text(json.dumps(MENU_CACHE, indent=2), encoding="utf-8")
-        INSTRUCTIONS_CACHE = build_menu_prompt(MENU_CACHE)
-        return jsonify({"ok": True, "count": len(MENU_CACHE)})
+        if not isinstance(payload, list) or not all(isinstance(it, dict) for it in payload):
+            return {"ok": False, "error": "menu must be a list of objects"}, 400
+        try:
+            menu = normalize_menu(payload)
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}, 400
+        snap = tenant.replace_menu(menu)
+        return jsonify({"ok": True, "count": len(snap.items),
+                        "generation": snap.generation, "etag": snap.payload.etag})
+
+def menu_response(p):
+    """Sirve el menú desde memoria; 304 si el ETag del cliente coincide."""
+    headers = {
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        "X-Menu-Generation": str(p.generation),
+    }
+    if request.if_none_match.contains_weak(p.etag):
+        resp = Response(status=304, headers=headers)
+    elif "gzip" in request.accept_encodings:
+        resp = Response(p.gzipped, mimetype="application/json", headers=headers)
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(p.body, mimetype="application/json", headers=headers)
+    resp.set_etag(p.etag)
+    return resp
+
+class _RawInput(io.RawIOBase):
+    """wsgi.input como RawIOBase para BufferedReader (eventlet.wsgi.Input no tiene readinto)."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+@app.post("/api/menu/import")
+def api_menu_import():
+    """
+    Importa CSV (cabecera name,price,img_ref,ingredients,description) o JSONL
+    leyendo el body en streaming. Query:
+      format=csv|jsonl   (default: según Content-Type, si no csv)
+      mode=replace|merge (replace quita los ítems que no vienen)
+      dry_run=1          solo reporta el diff
+      strict=1           no aplica nada si hay filas con error
+    """
+    ctype = (request.mimetype or "").lower()
+    fmt = (request.args.get("format") or ("jsonl" if "json" in ctype else "csv")).lower()
+    if fmt not in ("csv", "jsonl"):
+        return {"ok": False, "error": f"unknown format: {fmt}"}, 400
+    replace = (request.args.get("mode") or "replace").lower() != "merge"
+    dry_run = request.args.get("dry_run") in ("1", "true")
+    strict = request.args.get("strict") in ("1", "true")
+
+    # Sin Content-Length (Transfer-Encoding: chunked) werkzeug entrega un
+    # request.stream vacío porque eventlet no marca wsgi.input_terminated;
+    # eventlet ya quita el chunking, así que se lee wsgi.input directo.
+    raw = request.stream if request.content_length is not None else _RawInput(request.environ["wsgi.input"])
+    stream = io.TextIOWrapper(io.BufferedReader(raw), encoding="utf-8-sig", newline="")
+    tenant = current_tenant()
+    snap = tenant.snapshot
+    menu, report = diff_menu_import(snap.items, iter_import_rows(stream, fmt), replace=replace)
+    if report.get("error"):
+        return jsonify({"ok": False, "format": fmt, "mode": "replace", "dry_run": dry_run,
+                        "applied": False, "count": len(snap.items), "generation": snap.generation, **report}), 400
+    changed = bool(report["added"] or report["changed"] or report["removed"])
+    applied = changed and not dry_run and not (strict and report["error_count"])
+    if applied:
+        snap = tenant.replace_menu(menu)
+    return jsonify({"ok": True, "format": fmt, "mode": "replace" if replace else "merge",
+                    "dry_run": dry_run, "applied": applied, "count": len(snap.items),
+                    "generation": snap.generation, **report})
+
+@app.get("/api/menu/search")
+def api_menu_search():
+    return search_menu_result(request.args.get("q"), request.args.get("limit"))
+
+@app.get("/api/menu/suggest")
+def api_menu_suggest():
+    """Ítems que otros pedidos llevaban junto con el carrito de `client_id`."""
+    client_id = (request.args.get("client_id") or "").strip()
+    return suggest_for(client_id, request.args.get("limit"))
 
 @app.post("/api/recommend")
 def api_recommend():
     data = request.get_json(force=True, silent=True) or {}
+    client_id = str(data.get("client_id") or "").strip() or None
     if data.get("reset"):
-        socketio.emit("reset", {"ok": True})
+        recommend_reset(client_id)
         return jsonify({"ok": True, "reset": True})
-    names = [str(n or "").strip() for n in (data.get("names") or []) if str(n or "").strip()]
-    socketio.emit("recommend", {"names": names})
+    names = recommend_names(data.get("names") or [], client_id)
     return jsonify({"ok": True, "names": names})
 
 @app.get("/api/cart/state")
 def api_cart_state():
+    """Snapshot del carrito, o solo los deltas si `since=<version>` (del mismo `epoch`) sigue en el log."""
     client_id = (request.args.get("client_id") or "").strip()
-    cart = CARTS.get(client_id, [])
-    total = cart_total(cart)
-    status = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
-    return jsonify({"ok": True, "cart": cart, "client_id": client_id, "total": total, "order_status": status})
+    res = cart_state_for(client_id, request.args.get("since"), request.args.get("epoch"))
+    return jsonify(res), 200, {"ETag": f'"{res["version"]}"'}
 
 @app.post("/api/cart")
 def api_cart():
     data = request.get_json(force=True, silent=True) or {}
     client_id = (data.get("client_id") or "").strip()
-    ops = data.get("ops") or []
-
-    cur = CARTS.get(client_id, [])
-    new_cart = apply_ops_to_cart(cur, ops)
-    CARTS[client_id] = new_cart
-
-    payload = {"client_id": client_id, "ops": ops, "cart": new_cart}
-    if client_id:
-        socketio.emit("cart_update", payload, to=client_id)
-    else:
-        socketio.emit("cart_update", payload)
-
-    cur_status = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
-    if cur_status in (0, 1, 2):
-        if len(new_cart) == 0:
-            set_order_status(client_id, 0, announce=True)
-        else:
-            new_status = 2 if cur_status == 2 else 1
-            set_order_status(client_id, new_status, announce=True)
-
-    return jsonify({"ok": True, "applied": len(ops), "cart": new_cart, "client_id": client_id})
+    limited = rate_limited(CART_LIMIT, "/api/cart", client_id)
+    if limited is not None:
+        return limited
+    # Precondición opcional: `expected_version` en el body o `If-Match: "<version>"`.
+    expected = data.get("expected_version", request.headers.get("If-Match"))
+    res, code = apply_cart_ops_for(client_id, data.get("ops") or [], parse_if_match(expected))
+    return jsonify(res), code, {"ETag": f'"{res["version"]}"'}
+
+BATCH_MAX_ENTRIES = env_int("BATCH_MAX_ENTRIES", 500)
+
+@app.post("/api/batch")
+def api_batch():
+    """
+    Varias mesas/clientes en un request (POS, pantalla de cocina):
+    {"entries": [
+      {"client_id": "...", "ops": [...], "expected_version": 7},   # como POST /api/cart
+      {"client_id": "...", "transition": {"to": 2, "from": 1}},   # como /api/order_status/transition
+      {"client_id": "...", "ops": [{"op": "clear"}], "transition": {"to": 5}}
+    ]}
+    Cada entrada se aplica con las mismas reglas que el endpoint individual
+    (ops antes que transition) y tiene su propio resultado y status; los
+    eventos Socket.IO salen agrupados al final.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    entries = data.get("entries")
+    if not isinstance(entries, list):
+        return {"ok": False, "error": "entries must be a list"}, 400
+    if len(entries) > BATCH_MAX_ENTRIES:
+        return {"ok": False, "error": f"too many entries (max {BATCH_MAX_ENTRIES})"}, 413
+    batch = request.environ["app.emit_batch"] = EmitBatch()
+    results = []
+    try:
+        for entry in entries:
+            results.append(_batch_entry(entry))
+    finally:
+        request.environ["app.emit_batch"] = None
+        emitted = batch.flush()
+    return {"ok": True, "results": results, "events": batch.queued, "emitted": emitted}
+
+def _batch_entry(entry):
+    if not isinstance(entry, dict):
+        return {"ok": False, "status": 400, "error": "entry must be an object"}
+    client_id = str(entry.get("client_id") or "").strip()
+    if not client_id:
+        return {"ok": False, "status": 400, "error": "missing client_id"}
+    out = {"ok": True, "status": 200, "client_id": client_id}
+    try:
+        if "ops" in entry:
+            ops = entry.get("ops") or []
+            err = invalid_ops(ops)
+            if err:
+                return dict(out, ok=False, status=400, error=err)
+            limited = rate_limited(CART_LIMIT, "/api/batch", client_id)
+            if limited is not None:
+                body = limited[0]
+                return dict(out, ok=False, status=429, error=body["error"], retry_after=body["retry_after"])
+            res, code = apply_cart_ops_for(client_id, ops, parse_if_match(entry.get("expected_version")))
+            out["cart"] = res
+            if code != 200:
+                return dict(out, ok=False, status=code)
+        transition = entry.get("transition")
+        if transition is not None and not isinstance(transition, dict):
+            return dict(out, ok=False, status=400, error="transition must be an object")
+        if transition is not None:
+            res, code = transition_order_status(client_id, transition)
+            out["transition"] = res
+            if code != 200:
+                return dict(out, ok=False, status=code)
+    except (TypeError, ValueError, AttributeError) as e:
+        return dict(out, ok=False, status=400, error=str(e))
+    except StateBusy:
+        return dict(out, ok=False, status=503, error="state_busy")
+    return out
 
 @app.route("/api/realtime/session", methods=["POST"])
 def realtime_session():
@@ -357,154 +3468,63 @@ def realtime_session():
     if not OPENAI_API_KEY:
         raise RuntimeError("Falta la variable OPENAI_API_KEY")
     body = request.get_json(silent=True) or {}
-    model = body.get("model", "gpt-4o-realtime-preview")
-    voice = body.get("voice", "verse")
+    model = body.get("model", DEFAULT_REALTIME_MODEL)
+    voice = body.get("voice", DEFAULT_REALTIME_VOICE)
 
     client_id = request.headers.get("X-Client-Id") or request.args.get("client_id") or body.get("client_id") or ""
     client_id = str(client_id).strip()
-
-    instrucciones = INSTRUCTIONS_CACHE
-
-    if client_id:
-        cart = CARTS.get(client_id, [])
-        if cart:
-            lines = []
-            total = 0.0
-            for it in cart:
-                nm = it.get("name","")
-                q = int(it.get("qty") or 0)
-                p = float(it.get("price") or 0.0)
-                total += q*p
-                lines.append(f"- {nm} x{q} — ${p:0.2f} c/u")
-            cart_block = "\n".join(lines) + f"\nTotal actual: ${total:0.2f}"
-        else:
-            cart_block = "(carrito vacío)"
-        instrucciones = (instrucciones or "") + "\n\nCurrent customer cart:\n" + cart_block
-
-        status_num = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
-        status_map = {
-            0: "0 (cart empty)",
-            1: "1 (cart has items)",
-            2: "2 (cart modal open)",
-            3: "3 (checkout form open)",
-            4: "4 (checkout valid, ready to finalize)",
-            5: "5 (order confirmation open)"
-        }
-        instrucciones += "\n\nCurrent order status:\n- " + status_map.get(status_num, str(status_num))
-
-    tools = [
-        {
-            "type": "function",
-            "name": "update_front",
-            "description": "Update the client UI to show only the given item names in real time, and include a short reply to speak to the user.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "names": {"type": "array","items": {"type": "string"}},
-                    "reply": {"type": "string"}
-                },
-                "required": ["names", "reply"]
-            }
-        },
-        {
-            "type": "function",
-            "name": "update_cart",
-            "description": (
-                "Add/remove items in the user's cart, or clear it. "
-                "Use `action`: 'apply' (default) or 'clear'. "
-                "Always include a short `reply` when appropriate."
-            ),
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "action": { "type": "string", "enum": ["apply", "clear"] },
-                    "ops": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "op": {"type": "string", "enum": ["add", "remove", "set", "clear"]},
-                                "name":{"type": "string"},
-                                "qty": {"type": "integer", "minimum": 0}
-                            },
-                            "required": ["op"]
-                        }
-                    },
-                    "reply": {"type": "string"}
-                }
-            }
-        },
-        {
-            "type": "function",
-            "name": "get_cart",
-            "description": "Return the current cart state with item names, qty, unit prices and total. Always include a short reply.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "reply": {"type":"string"}
-                }
-            }
-        },
-        {
-            "type": "function",
-            "name": "get_order_status",
-            "description": "Return current order_status (0..5). ALWAYS call this before transition_order_status.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "reply": { "type": "string" }
-                }
-            }
-        },
-        {
-            "type": "function",
-            "name": "transition_order_status",
-            "description": (
-                "Advance or adjust the order flow UI for the current customer "
-                "(0:empty, 1:cart-with-items, 2:cart-open, 3:checkout-open, "
-                "4:checkout-valid, 5:success). Optionally include 'prefill' when to ∈ {3,4}. "
-                "Always include a short 'reply'."
-            ),
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "to": { "type": "integer", "enum": [0,1,2,3,4,5] },
-                    "prefill": {
-                        "type": "object",
-                        "properties": {
-                            "name":  {"type": "string"},
-                            "phone": {"type": "string"},
-                            "email": {"type": "string"},
-                            "card":  {"type": "string"},
-                            "exp":   {"type": "string"},
-                            "cvv":   {"type": "string"}
-                        }
-                    },
-                    "reply": { "type": "string" }
-                },
-                "required": ["to", "reply"]
-            }
-        }
-    ]
+    limited = rate_limited(SESSION_LIMIT, "/api/realtime/session", client_id)
+    if limited is not None:
+        return limited
+    STATE.touch(client_id)
+
+    suffix = render_session_context(client_id) if client_id else ""
+    tenant = current_tenant()
+    template = tenant.snapshot.template
+
+    # Pool caliente (solo tenant default): la sesión ya existe con el menú
+    # base; el contexto del cliente se aplica desde app.js con `session.update`.
+    if tenant is TENANTS.default and model == DEFAULT_REALTIME_MODEL and voice == DEFAULT_REALTIME_VOICE:
+        pooled = SESSION_POOL.take()
+        if pooled is not None:
+            out = dict(pooled)
+            if suffix:
+                out["session_update"] = {"instructions": template.instructions + suffix}
+            return out
+
+    payload = template.render(model, voice, suffix)
 
     try:
-        r = requests.post(
-            "https://api.openai.com/v1/realtime/sessions",
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-                "OpenAI-Beta": "realtime=v1",
-            },
-            json={ "model": model, "voice": voice, "instructions": instrucciones, "tools": tools },
-            timeout=20,
-        )
+        r = mint_realtime_session(OPENAI_API_KEY, payload)
+    except UpstreamUnavailable as e:
+        SHED.inc(("/api/realtime/session", e.code))
+        return {"error": f"Realtime unavailable: {e}"}, 503, {"Retry-After": str(e.retry_after)}
     except requests.RequestException as e:
         return {"error": f"Realtime request failed: {e}"}, 502
 
     if r.status_code >= 400:
-        return {"error": f"{r.status_code}: {r.text}"}, r.status_code
+        extra = {"Retry-After": r.headers["Retry-After"]} if "Retry-After" in r.headers else {}
+        return {"error": f"{r.status_code}: {r.text}"}, r.status_code, extra
     return r.json()
 
+@app.get("/api/realtime/pool")
+def realtime_pool_stats():
+    return {"ok": True, **SESSION_POOL.snapshot()}
+
+@app.get("/api/state/stats")
+def state_stats():
+    return {
+        "ok": True,
+        **STORE.stats(),
+        "rss_bytes": process_rss_bytes(),
+        "max_clients": STATE_MAX_CLIENTS,
+        "idle_ttl": STATE_IDLE_TTL,
+        "evictions": dict(STATE_EVICTIONS),
+        "journal": dict(JOURNAL.stats, pending=len(JOURNAL.pending)) if JOURNAL is not None else None,
+        "tenants": TENANTS.snapshot(),
+        "orders": ORDERS.snapshot() if ORDERS is not None else None,
+    }
+
 # ======================
 # API order_status
 # ======================
@@ -514,8 +3534,7 @@ def get_order_status():
     client_id = (request.args.get("client_id") or "").strip()
     if not client_id:
         return {"ok": False, "error": "missing client_id"}, 400
-    cur = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
-    return {"ok": True, "status": cur}
+    return {"ok": True, "status": order_status_for(client_id)}
 
 @app.post("/api/order_status/transition")
 def order_status_transition():
@@ -523,7 +3542,7 @@ def order_status_transition():
     Body:
     {
       "client_id": "...",
-      "from": 1,           # opcional (optimista)
+      "from": 1,           # opcional (optimista; también vía If-Match: "1")
       "to": 3|4,           # checkout open / ready
       "prefill": {         # opcional (puede ser parcial; se fusiona y valida)
         "name": "", "phone": "", "email": "",
@@ -535,125 +3554,116 @@ def order_status_transition():
     client_id = str(body.get("client_id") or "").strip()
     if not client_id:
         return {"ok": False, "error": "missing client_id"}, 400
+    # `If-Match: "<status>"` equivale a `from`.
+    if body.get("from") is None and parse_if_match(request.headers.get("If-Match")) is not None:
+        body["from"] = parse_if_match(request.headers.get("If-Match"))
+    return transition_order_status(client_id, body)
 
+def transition_order_status(client_id, body):
+    """Valida `to` y aplica la transición; devuelve (respuesta, status HTTP)."""
     to = body.get("to", None)
     if to is None:
         return {"ok": False, "error": "missing 'to' state"}, 400
     to = int(to)
 
+    after_commit = []
+    with STATE.transaction(client_id):
+        res = _order_status_transition(client_id, to, body, after_commit)
+    for fn in after_commit:  # solo si la transacción se confirmó
+        fn()
+    return res if isinstance(res, tuple) else (res, 200)
+
+# ---- Máquina de estados del pedido (tabla construida una vez) ----
+# to -> (guardas, acción). Una guarda devuelve None o (error, status HTTP);
+# la acción devuelve (estado final, extra para el emit, extra para la respuesta).
+# El emit y la respuesta se arman en un solo lugar (_order_status_transition).
+
+def _guard_cart_empty(ctx):
+    if len(ctx["cart"]) != 0:
+        return {"ok": False, "error": "Cart is not empty", "current": ctx["cur"]}, 400
+
+def _guard_cart_has_items(ctx):
+    if len(ctx["cart"]) == 0:
+        return {"ok": False, "error": "Cart is empty", "current": ctx["cur"]}, 400
+
+def _guard_from_ready(ctx):
+    if ctx["cur"] != 4:
+        return {"ok": False, "error": "Invalid transition (must be 4 -> 5)", "current": ctx["cur"]}, 409
+
+def _enter(ctx):
+    return ctx["to"], None, {}
+
+def _enter_done(ctx):
+    """5: pedido completado; queda en el historial (el carrito suele llegar ya vacío, ver Cart.cleared)."""
+    if ORDERS is not None:
+        tid, client_id, lines = current_tenant_id(), ctx["client_id"], ctx["cart"].order_lines()
+        if ctx["after_commit"] is None:
+            ORDERS.record(tid, client_id, lines)
+        else:
+            ctx["after_commit"].append(lambda: ORDERS.record(tid, client_id, lines))
+    return 5, None, {}
+
+def _enter_checkout(ctx):
+    """3/4: fusiona el prefill parcial (si viene) y decide 3 (faltan datos) o 4."""
+    patch = ctx["body"].get("prefill")
+    if patch:
+        ok, missing, raw = merge_prefill_patch(ctx["client_id"], patch)
+        status, applied = (4 if ok else 3), ok
+    else:
+        ok, missing, raw = stored_prefill(ctx["client_id"])
+        if ctx["to"] == 3:
+            status, applied = 3, False
+        else:
+            status, applied = (4 if ok else 3), ok
+    extra = {"prefill": dict(raw)}
+    if not ok:
+        extra["missing"] = list(missing)
+    return status, extra, {
+        "applied_prefill": applied,
+        "missing": [] if ok else list(missing),
+        "prefill": dict(raw),
+    }
+
+ORDER_TRANSITIONS = {
+    0: ((_guard_cart_empty,), _enter),
+    1: ((_guard_cart_has_items,), _enter),
+    2: ((_guard_cart_has_items,), _enter),
+    3: ((_guard_cart_has_items,), _enter_checkout),
+    4: ((_guard_cart_has_items,), _enter_checkout),
+    5: ((_guard_from_ready,), _enter_done),
+}
+
+def _order_status_transition(client_id, to, body, after_commit=None):
     cur = ORDER_STATUS.get(client_id, compute_base_status_for_client(client_id))
     from_state = body.get("from", None)
     if from_state is not None and int(from_state) != cur:
         return {"ok": False, "error": "state_conflict", "current": cur, "requested_from": int(from_state)}, 409
 
-    cart = CARTS.get(client_id, [])
-    extra_emit = {}
-
-    def emit_status(s, extra=None):
-        return set_order_status(client_id, s, announce=True, extra=extra)
-
-    if to == 0:
-        if len(cart) != 0:
-            return {"ok": False, "error": "Cart is not empty", "current": cur}, 400
-        res = emit_status(0)
-        return {"ok": True, "status": 0, "changed": res["changed"]}
-
-    if to == 1:
-        if len(cart) == 0:
-            return {"ok": False, "error": "Cart is empty", "current": cur}, 400
-        res = emit_status(1)
-        return {"ok": True, "status": 1, "changed": res["changed"]}
-
-    if to == 2:
-        if len(cart) == 0:
-            return {"ok": False, "error": "Cart is empty", "current": cur}, 400
-        res = emit_status(2)
-        return {"ok": True, "status": 2, "changed": res["changed"]}
-
-    # ------ NUEVO: manejo de prefill parcial y persistente ------
-    if to in (3, 4):
-        if len(cart) == 0:
-            return {"ok": False, "error": "Cart is empty", "current": cur}, 400
-
-        prefill_patch = body.get("prefill")
-
-        # Si viene parche, lo fusionamos con lo que ya haya y decidimos estado.
-        if prefill_patch:
-            ok, missing, merged_raw = merge_prefill_patch(client_id, prefill_patch)
-            if ok:
-                extra_emit.update({"prefill": dict(merged_raw)})
-                res = emit_status(4, extra=extra_emit)
-                return {
-                    "ok": True,
-                    "status": 4,
-                    "changed": res["changed"],
-                    "applied_prefill": True,
-                    "missing": [],
-                    "prefill": dict(merged_raw)
-                }
-            else:
-                extra_emit.update({"prefill": dict(merged_raw), "missing": list(missing)})
-                res = emit_status(3, extra=extra_emit)
-                return {
-                    "ok": True,
-                    "status": 3,
-                    "changed": res["changed"],
-                    "applied_prefill": False,
-                    "missing": list(missing),
-                    "prefill": dict(merged_raw)
-                }
-
-        # Sin parche: abrir 3 con lo que haya guardado y sus faltantes,
-        # o promover a 4 si ya estaba completo.
-        st = CHECKOUT_PREFILL.get(client_id, {"raw": {}, "valid": False})
-        raw = dict(st.get("raw") or {})
-        ok, missing, _cleaned = validate_prefill(raw)
-
-        if to == 3:
-            extra_emit.update({"prefill": dict(raw)})
-            if not ok:
-                extra_emit["missing"] = list(missing)
-            res = emit_status(3, extra=extra_emit)
-            return {
-                "ok": True,
-                "status": 3,
-                "changed": res["changed"],
-                "applied_prefill": False,
-                "missing": [] if ok else list(missing),
-                "prefill": dict(raw)
-            }
-
-        # to == 4 sin prefill explícito
-        if ok:
-            extra_emit.update({"prefill": dict(raw)})
-            res = emit_status(4, extra=extra_emit)
-            return {
-                "ok": True,
-                "status": 4,
-                "changed": res["changed"],
-                "applied_prefill": True,
-                "missing": [],
-                "prefill": dict(raw)
-            }
-        else:
-            extra_emit.update({"prefill": dict(raw), "missing": list(missing)})
-            res = emit_status(3, extra=extra_emit)
-            return {
-                "ok": True,
-                "status": 3,
-                "changed": res["changed"],
-                "applied_prefill": False,
-                "missing": list(missing),
-                "prefill": dict(raw)
-            }
-
-    if to == 5:
-        if cur != 4:
-            return {"ok": False, "error": "Invalid transition (must be 4 -> 5)", "current": cur}, 409
-        res = emit_status(5)
-        return {"ok": True, "status": 5, "changed": res["changed"]}
-
-    return {"ok": False, "error": "Unknown 'to' state"}, 400
+    entry = ORDER_TRANSITIONS.get(to)
+    if entry is None:
+        return {"ok": False, "error": "Unknown 'to' state"}, 400
+    guards, action = entry
+    ctx = {"client_id": client_id, "cur": cur, "to": to, "body": body, "cart": priced_cart_for(client_id),
+           "after_commit": after_commit}
+    for guard in guards:
+        err = guard(ctx)
+        if err is not None:
+            return err
+    status, extra_emit, extra_resp = action(ctx)
+    res = set_order_status(client_id, status, announce=True, extra=extra_emit)
+    return {"ok": True, "status": status, "changed": res["changed"], **extra_resp}
+
+if JOURNAL is not None:
+    JOURNAL.replay(STORE)
+    atexit.register(JOURNAL.close)
+    socketio.start_background_task(JOURNAL.run)
+SESSION_POOL.start()
+socketio.start_background_task(state_reaper)
+if MENU_WATCH_INTERVAL > 0:
+    socketio.start_background_task(menu_watcher)
+if ORDERS is not None:
+    atexit.register(ORDERS.close)
+    socketio.start_background_task(ORDERS.run)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))   # DO asigna PORT=8080 para digital ocean :v
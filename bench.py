@@ -0,0 +1,837 @@
+# bench.py — benchmarks del servidor
+#
+#   python bench.py emit --mq redis://localhost:6379/0 --workers 1,2,4
+#   python bench.py session --concurrency 20 --latency-ms 100
+#   python bench.py session --requests 1000 --concurrency 200 --latency-ms 500 --max-concurrency 10 --queue-max 10
+#   python bench.py soak --duration 300 --max-clients 500
+#   python bench.py search --items 5000
+#   python bench.py race --clients 4 --ops 300 --concurrency 64
+#   python bench.py transition --iterations 20000
+#   python bench.py images --images 20 --size 1200
+#   python bench.py load --customers 50 --rounds 3 --out load.json
+#   python bench.py batch --tables 50 --rounds 20
+#
+# Cada benchmark imprime una línea JSON por configuración para poder
+# comparar corridas entre commits. Requiere `websocket-client` para el
+# cliente Socket.IO (pip install websocket-client).
+
+import argparse, json, os, socket, subprocess, sys, tempfile, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"el servidor no abrió el puerto {port}")
+
+
+def start_server(workers, port, env_extra):
+    env = dict(os.environ)
+    env.update(env_extra)
+    proc = subprocess.Popen(
+        [sys.executable, str(HERE / "serve.py"), "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+        cwd=str(HERE), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    wait_port(port)
+    time.sleep(0.5 * workers)  # que todos los workers terminen de importar app.py
+    return proc
+
+
+# ======================
+# emit: latencia/throughput de cart_update a través de N workers
+# ======================
+
+def bench_emit(args):
+    import requests
+    import socketio as sio_client
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        port = free_port()
+        tmp = tempfile.mkdtemp(prefix="bench-emit-")
+        env = {"STATE_BACKEND": "sqlite", "STATE_DB_PATH": os.path.join(tmp, "state.db"), "RATE_CART_PER_SEC": "0"}
+        if args.mq:
+            env["SOCKETIO_MESSAGE_QUEUE"] = args.mq
+        proc = start_server(workers, port, env)
+        url = f"http://127.0.0.1:{port}"
+        sent, latencies, clients = {}, [], []
+        lock = threading.Lock()
+        try:
+            for i in range(args.clients):
+                cid = f"bench-{workers}-{i}"
+                c = sio_client.Client(reconnection=False)
+
+                def on_update(payload, cid=cid):
+                    now = time.perf_counter()
+                    with lock:
+                        t0 = sent.pop(cid, None)
+                        if t0 is not None:
+                            latencies.append(now - t0)
+
+                c.on("cart_update", on_update)
+                c.connect(url, transports=["websocket"])
+                c.emit("register", {"client_id": cid})
+                clients.append((cid, c))
+            time.sleep(0.5)
+
+            def one_round(cid):
+                with lock:
+                    sent[cid] = time.perf_counter()
+                # Conexión nueva por request: el kernel reparte entre workers.
+                requests.post(url + "/api/cart", json={"client_id": cid, "ops": [{"op": "add", "name": "Fries", "qty": 1}]}, timeout=10)
+                deadline = time.time() + 5
+                while time.time() < deadline:
+                    with lock:
+                        if cid not in sent:
+                            return
+                    time.sleep(0.0005)
+                with lock:
+                    sent.pop(cid, None)
+
+            def client_loop(cid):
+                for _ in range(args.rounds):
+                    one_round(cid)
+
+            t_start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                list(pool.map(client_loop, [cid for cid, _ in clients]))
+            elapsed = time.perf_counter() - t_start
+        finally:
+            for _, c in clients:
+                try:
+                    c.disconnect()
+                except Exception:
+                    pass
+            proc.terminate()
+            proc.wait(timeout=10)
+
+        expected = args.clients * args.rounds
+        row = {
+            "bench": "emit",
+            "workers": workers,
+            "clients": args.clients,
+            "events_expected": expected,
+            "events_received": len(latencies),
+            "throughput_eps": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        }
+        print(json.dumps(row), flush=True)
+        results.append(row)
+    return results
+
+
+# ======================
+# session: /api/realtime/session contra fake_upstream.py
+# ======================
+
+def bench_session(args):
+    import requests
+    import fake_upstream
+
+    up_port = free_port()
+    httpd = fake_upstream.serve(port=up_port, latency_ms=args.latency_ms, fail_rate=args.fail_rate)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = free_port()
+    proc = start_server(1, port, {
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{up_port}/v1",
+        "UPSTREAM_MAX_CONCURRENCY": str(args.max_concurrency),
+        "UPSTREAM_QUEUE_MAX": str(args.queue_max),
+        "RATE_SESSION_PER_MIN": "0",  # el bench reutiliza client_id; aquí se mide el upstream
+    })
+    url = f"http://127.0.0.1:{port}/api/realtime/session"
+    latencies, statuses, by_status = [], {}, {}
+    lock = threading.Lock()
+
+    def one(i):
+        cid = f"bench-session-{i % args.concurrency}"
+        t0 = time.perf_counter()
+        try:
+            status = requests.post(url, json={"client_id": cid}, headers={"X-Client-Id": cid}, timeout=30).status_code
+        except requests.RequestException:
+            status = "error"
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            by_status.setdefault(str(status), []).append(dt)
+
+    try:
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(one, range(args.requests)))
+        elapsed = time.perf_counter() - t_start
+        upstream = requests.get(f"http://127.0.0.1:{up_port}/stats", timeout=5).json()
+        shed = [ln for ln in requests.get(f"http://127.0.0.1:{port}/metrics", timeout=5).text.splitlines()
+                if ln.startswith("requests_shed_total")]
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        httpd.shutdown()
+
+    row = {
+        "bench": "session",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "upstream_latency_ms": args.latency_ms,
+        "max_concurrency": args.max_concurrency,
+        "queue_max": args.queue_max,
+        "statuses": statuses,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "upstream_requests": upstream["requests"],
+        "upstream_connections": upstream["connections"],
+        "by_status": {k: summarize(v) for k, v in sorted(by_status.items())},
+        "shed": {ln.split("{", 1)[1].split("}")[0]: float(ln.rsplit(" ", 1)[1]) for ln in shed},
+    }
+    print(json.dumps(row), flush=True)
+    return row
+
+
+# ======================
+# soak: clientes nuevos sin parar; RSS y conteos deben quedar planos
+# ======================
+
+def bench_soak(args):
+    import requests
+    import uuid
+
+    port = free_port()
+    proc = start_server(1, port, {
+        "STATE_MAX_CLIENTS": str(args.max_clients),
+        "STATE_IDLE_TTL": str(args.idle_ttl),
+        "STATE_REAP_INTERVAL": str(args.reap_interval),
+    })
+    url = f"http://127.0.0.1:{port}"
+    http = requests.Session()
+    rows = []
+    try:
+        t_start = time.time()
+        next_sample = t_start
+        created = 0
+        while time.time() - t_start < args.duration:
+            cid = uuid.uuid4().hex
+            http.post(url + "/api/cart", json={"client_id": cid, "ops": [
+                {"op": "add", "name": "Fries", "qty": 2}, {"op": "add", "name": "Hamburger", "qty": 1},
+            ]}, timeout=10)
+            created += 1
+            if time.time() >= next_sample:
+                st = http.get(url + "/api/state/stats", timeout=10).json()
+                row = {
+                    "bench": "soak",
+                    "t": round(time.time() - t_start, 1),
+                    "created": created,
+                    "clients": st["clients"],
+                    "approx_bytes": st["approx_bytes"],
+                    "rss_bytes": st["rss_bytes"],
+                    "evictions": st["evictions"],
+                }
+                print(json.dumps(row), flush=True)
+                rows.append(row)
+                next_sample += args.sample_every
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return rows
+
+
+# ======================
+# race: mutaciones concurrentes por cliente; no debe perderse ninguna
+# ======================
+
+def bench_race(args):
+    import requests
+
+    port = free_port()
+    env = {"RATE_CART_PER_SEC": "0"}  # el bench martilla pocos client_id a propósito
+    if args.workers > 1 or args.backend == "sqlite":
+        tmp = tempfile.mkdtemp(prefix="bench-race-")
+        env.update({"STATE_BACKEND": "sqlite", "STATE_DB_PATH": os.path.join(tmp, "state.db")})
+    if args.mq:
+        env["SOCKETIO_MESSAGE_QUEUE"] = args.mq
+    proc = start_server(args.workers, port, env)
+    url = f"http://127.0.0.1:{port}"
+    local = threading.local()
+
+    def http():
+        if not hasattr(local, "s"):
+            local.s = requests.Session()
+        return local.s
+
+    cids = [f"race-{i}" for i in range(args.clients)]
+    rows = []
+    try:
+        # 1) `add` sin precondición: el lock por cliente serializa, qty final == ops.
+        #    Se reparte entre los ítems del menú porque cada línea topa en 99.
+        names = [it["name"] for it in http().get(url + "/api/menu", timeout=30).json()]
+        n_add = min(args.ops, 99 * len(names))
+
+        def add(job):
+            cid, i = job
+            return http().post(url + "/api/cart", json={"client_id": cid, "ops": [{"op": "add", "name": names[i % len(names)], "qty": 1}]}, timeout=30).status_code
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            statuses = list(pool.map(add, [(cid, i) for cid in cids for i in range(n_add)]))
+        elapsed = time.perf_counter() - t0
+        lost = 0
+        for cid in cids:
+            st = http().get(url + "/api/cart/state", params={"client_id": cid}, timeout=30).json()
+            lost += n_add - sum(l["qty"] for l in st["cart"])
+        rows.append({"bench": "race", "case": "add", "ops": len(statuses), "workers": args.workers,
+                     "non_200": sum(1 for s in statuses if s != 200), "lost_updates": lost,
+                     "ops_per_s": round(len(statuses) / elapsed, 1)})
+
+        # 2) compare-and-set: leer versión, `set` qty+1 con expected_version, reintentar en 409.
+        #    Antes se vacía el carrito (también por CAS) para partir de cero.
+        for cid in cids:
+            http().post(url + "/api/cart", json={"client_id": cid, "ops": [{"op": "clear"}, {"op": "add", "name": names[0], "qty": 1}]}, timeout=30)
+        conflicts = [0]
+        lock = threading.Lock()
+
+        def cas_increment(cid):
+            st = http().get(url + "/api/cart/state", params={"client_id": cid}, timeout=30).json()
+            version, cart = st["version"], st["cart"]
+            while True:
+                qty = sum(l["qty"] for l in cart if l["name"] == names[-1])
+                r = http().post(url + "/api/cart", json={
+                    "client_id": cid, "expected_version": version,
+                    "ops": [{"op": "set", "name": names[-1], "qty": qty + 1}],
+                }, timeout=30)
+                j = r.json()
+                if r.status_code == 200:
+                    return
+                with lock:
+                    conflicts[0] += 1
+                version, cart = j["version"], j["cart"]
+
+        n_cas = min(args.ops, 99)  # qty máx por línea
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(cas_increment, [cid for cid in cids for _ in range(n_cas)]))
+        elapsed = time.perf_counter() - t0
+        lost = 0
+        for cid in cids:
+            st = http().get(url + "/api/cart/state", params={"client_id": cid}, timeout=30).json()
+            lost += n_cas - sum(l["qty"] for l in st["cart"] if l["name"] == names[-1])
+        rows.append({"bench": "race", "case": "cas", "ops": n_cas * len(cids), "conflicts_retried": conflicts[0],
+                     "lost_updates": lost, "ops_per_s": round(n_cas * len(cids) / elapsed, 1)})
+
+        # 3) transiciones con la misma precondición: solo una gana por cliente.
+        def transition(cid):
+            r = http().post(url + "/api/order_status/transition", json={"client_id": cid, "from": 1, "to": 2}, timeout=30)
+            return cid, r.status_code, r.json().get("changed")
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(transition, [cid for cid in cids for _ in range(args.transitions)]))
+        winners = {}
+        for cid, status, changed in results:
+            if status == 200 and changed:
+                winners[cid] = winners.get(cid, 0) + 1
+        rows.append({"bench": "race", "case": "transition", "attempts": len(results),
+                     "conflicts": sum(1 for _, s, _c in results if s == 409),
+                     "clients_with_one_winner": sum(1 for cid in cids if winners.get(cid) == 1),
+                     "clients": len(cids)})
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    for row in rows:
+        print(json.dumps(row), flush=True)
+    return rows
+
+
+# ======================
+# batch: un POS actualizando N mesas, N llamadas sueltas vs un /api/batch
+# ======================
+
+def bench_batch(args):
+    import requests
+    import socketio as sio_client
+
+    port = free_port()
+    proc = start_server(1, port, {"RATE_CART_PER_SEC": "0"})
+    url = f"http://127.0.0.1:{port}"
+    http = requests.Session()
+    received = [0]
+    lock = threading.Lock()
+
+    def on_event(_payload):
+        with lock:
+            received[0] += 1
+
+    def settle(expected_min, timeout=5.0):
+        deadline = time.time() + timeout
+        last, still = -1, 0
+        while time.time() < deadline:
+            with lock:
+                n = received[0]
+            still = still + 1 if n == last else 0
+            if n >= expected_min and still >= 5:
+                return
+            last = n
+            time.sleep(0.02)
+
+    rows, clients = [], []
+    try:
+        names = [it["name"] for it in http.get(url + "/api/menu", timeout=30).json()]
+        for mode in ("single", "batch"):
+            cids = [f"{mode}-table-{i}" for i in range(args.tables)]
+            for cid in cids:
+                c = sio_client.Client(reconnection=False)
+                c.on("cart_update", on_event)
+                c.on("order_status", on_event)
+                c.connect(url, transports=["websocket"])
+                c.emit("register", {"client_id": cid})
+                clients.append(c)
+            time.sleep(0.5)
+            with lock:
+                received[0] = 0
+            round_ms, requests_sent = [], 0
+            for r in range(args.rounds):
+                # Por mesa y ronda: un ítem más al carrito y alternar 1 <-> 2 (en cocina / pendiente).
+                entries = []
+                for i, cid in enumerate(cids):
+                    entries.append({"client_id": cid, "ops": [{"op": "add", "name": names[(r + i) % len(names)], "qty": 1}]})
+                    entries.append({"client_id": cid, "transition": {"to": 2 if r % 2 == 0 else 1}})
+                t0 = time.perf_counter()
+                if mode == "single":
+                    for e in entries:
+                        if "ops" in e:
+                            resp = http.post(url + "/api/cart", json=e, timeout=30)
+                        else:
+                            resp = http.post(url + "/api/order_status/transition", json=dict(e["transition"], client_id=e["client_id"]), timeout=30)
+                        assert resp.status_code == 200, resp.text
+                    requests_sent += len(entries)
+                else:
+                    resp = http.post(url + "/api/batch", json={"entries": entries}, timeout=30)
+                    assert resp.status_code == 200 and all(x["ok"] for x in resp.json()["results"]), resp.text[:500]
+                    requests_sent += 1
+                round_ms.append((time.perf_counter() - t0) * 1000)
+            settle(args.rounds * args.tables)
+            updates = args.rounds * len(entries)
+            rows.append({
+                "bench": "batch", "mode": mode, "tables": args.tables, "rounds": args.rounds,
+                "updates": updates, "http_requests": requests_sent,
+                "round_p50_ms": round(percentile(round_ms, 50), 2),
+                "round_p95_ms": round(percentile(round_ms, 95), 2),
+                "updates_per_s": round(updates / (sum(round_ms) / 1000), 1),
+                "socket_events": received[0],
+            })
+    finally:
+        for c in clients:
+            try:
+                c.disconnect()
+            except Exception:
+                pass
+        proc.terminate()
+        proc.wait(timeout=10)
+    for row in rows:
+        print(json.dumps(row), flush=True)
+    return rows
+
+
+# ======================
+# images: miniaturas del menú con fixtures locales (sin red) + estáticos
+# ======================
+
+def write_png(path, width, height, seed=0):
+    """PNG RGB con ruido suave, sin dependencias (fixtures para bench images)."""
+    import random, struct, zlib
+    rnd = random.Random(seed)
+    rows = []
+    for y in range(height):
+        base = (seed * 37 + y) % 256
+        rows.append(b"\x00" + bytes((base + x // 4 + rnd.randrange(6)) % 256 for x in range(width * 3)))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+                + chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) + chunk(b"IEND", b""))
+
+
+def bench_images(args):
+    import app
+
+    tmp = Path(tempfile.mkdtemp(prefix="bench-images-"))
+    fixtures = tmp / "fixtures"
+    fixtures.mkdir()
+    for i in range(args.images):
+        write_png(fixtures / f"item{i}.png", args.size, args.size * 3 // 4, seed=i)
+    app.IMAGES = app.ImageCache(tmp / "cache", fixtures, app.IMAGE_WIDTHS)
+    menu = [{"name": f"Item {i}", "price": 1 + i, "img_ref": f"item{i}.png"} for i in range(args.images)]
+    snap = app.TENANTS.default.install(app.normalize_menu(menu))  # solo en memoria, no toca static/menu.json
+    thumbs = [it["thumb"] for it in json.loads(snap.payload.body)]
+    c = app.app.test_client()
+
+    for width in app.IMAGE_WIDTHS:
+        cold, warm, sizes, etags = [], [], [], []
+        for url in thumbs:
+            t0 = time.perf_counter()
+            r = c.get(f"{url}?w={width}")
+            cold.append(time.perf_counter() - t0)
+            sizes.append(len(r.data))
+            etags.append(r.headers.get("ETag"))
+        for url in thumbs:
+            t0 = time.perf_counter()
+            c.get(f"{url}?w={width}")
+            warm.append(time.perf_counter() - t0)
+        not_modified = sum(c.get(f"{u}?w={width}", headers={"If-None-Match": e}).status_code == 304
+                           for u, e in zip(thumbs, etags))
+        print(json.dumps({
+            "bench": "images", "width": width, "images": len(thumbs), "resize": app.Image is not None,
+            "original_bytes_avg": int(sum(p.stat().st_size for p in fixtures.iterdir()) / len(thumbs)),
+            "thumb_bytes_avg": int(sum(sizes) / len(sizes)),
+            "cold_p50_ms": round(percentile(cold, 50) * 1000, 2),
+            "warm_p50_ms": round(percentile(warm, 50) * 1000, 2),
+            "warm_p99_ms": round(percentile(warm, 99) * 1000, 2),
+            "not_modified": not_modified,
+        }), flush=True)
+
+    for name, a in sorted(app.ASSETS.items()):
+        print(json.dumps({"bench": "assets", "name": name, "url": f"/assets/{a.url_name}", "bytes": len(a.body),
+                          "gzip": len(a.gzipped), "br": len(a.brotli) if a.brotli is not None else None}), flush=True)
+
+
+# ======================
+# transition: camino caliente de la máquina de estados (en proceso)
+# ======================
+
+def bench_transition(args):
+    import app
+
+    cid = "bench-transition"
+    app.apply_cart_ops_for(cid, [{"op": "add", "name": app.TENANTS.default.snapshot.items[0]["name"], "qty": 1}])
+    full = {"name": "Ana", "phone": "300 123 4567", "email": "ana@example.com",
+            "card": "4111 1111 1111 1111", "exp": "12/29", "cvv": "123"}
+    cases = {
+        "1<->2": [{"to": 2}, {"to": 1}],
+        "checkout_no_prefill": [{"to": 3}, {"to": 4}],
+        "prefill_one_field": [{"to": 4, "prefill": {"phone": "300 123 4567"}}, {"to": 4, "prefill": {"phone": "300 123 4568"}}],
+        "prefill_full": [{"to": 4, "prefill": full}, {"to": 4, "prefill": dict(full, name="Bea")}],
+        "validate_prefill": None,
+    }
+    for name, bodies in cases.items():
+        latencies = []
+        for i in range(args.iterations):
+            t0 = time.perf_counter()
+            if bodies is None:
+                app.validate_prefill(full)
+            else:
+                app.transition_order_status(cid, dict(bodies[i % 2]))
+            latencies.append(time.perf_counter() - t0)
+        print(json.dumps({
+            "bench": "transition",
+            "case": name,
+            "iterations": args.iterations,
+            "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+            "p95_us": round(percentile(latencies, 95) * 1e6, 1),
+            "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+        }), flush=True)
+
+
+# ======================
+# load: N clientes simulando el flujo completo (socket + HTTP + sesión)
+# ======================
+
+def summarize(latencies):
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+def bench_load(args):
+    import random
+    import requests
+    import socketio as sio_client
+    import fake_upstream
+
+    up_port = free_port()
+    httpd = fake_upstream.serve(port=up_port, latency_ms=args.latency_ms)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = free_port()
+    env = {"OPENAI_API_KEY": "fake", "OPENAI_BASE_URL": f"http://127.0.0.1:{up_port}/v1",
+           "RATE_SESSION_PER_MIN": "0", "RATE_CART_PER_SEC": "0"}  # --env RATE_...=N para medir con límites
+    if args.workers > 1:
+        tmp = tempfile.mkdtemp(prefix="bench-load-")
+        env.update({"STATE_BACKEND": "sqlite", "STATE_DB_PATH": os.path.join(tmp, "state.db")})
+    if args.mq:
+        env["SOCKETIO_MESSAGE_QUEUE"] = args.mq
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+    proc = start_server(args.workers, port, env)
+    url = f"http://127.0.0.1:{port}"
+
+    lat, errors, lock = {}, {}, threading.Lock()
+
+    def record(name, dt, ok=True):
+        with lock:
+            lat.setdefault(name, []).append(dt)
+            if not ok:
+                errors[name] = errors.get(name, 0) + 1
+
+    def customer(idx):
+        rnd = random.Random(idx)
+        http = requests.Session()
+        # Cada POST /api/cart del flujo cambia el carrito -> un cart_update, en
+        # orden (FIFO). Los order_status se emparejan por estado destino.
+        cart_sent = deque()
+        status_sent = {}
+
+        def on_cart_update(payload):
+            if cart_sent:
+                record("event:cart_update", time.perf_counter() - cart_sent.popleft())
+
+        def on_order_status(payload):
+            t0 = status_sent.pop((payload or {}).get("status"), None)
+            if t0 is not None:
+                record("event:order_status", time.perf_counter() - t0)
+
+        sio = sio_client.Client(reconnection=False)
+        sio.on("cart_update", on_cart_update)
+        sio.on("order_status", on_order_status)
+
+        def call(name, method, path, **kw):
+            t0 = time.perf_counter()
+            try:
+                r = http.request(method, url + path, timeout=30, **kw)
+                record(name, time.perf_counter() - t0, r.status_code < 400)
+                return r
+            except requests.RequestException:
+                record(name, time.perf_counter() - t0, False)
+                return None
+
+        t0 = time.perf_counter()
+        try:
+            sio.connect(url, transports=["websocket"])
+        except Exception:
+            record("socket:connect", time.perf_counter() - t0, False)
+            return
+        record("socket:connect", time.perf_counter() - t0)
+        etag = None
+        try:
+            for rnd_i in range(args.rounds):
+                cid = f"load-{idx}-{rnd_i}"
+                sio.emit("register", {"client_id": cid})
+                r = call("GET /api/menu", "GET", "/api/menu", headers={"If-None-Match": etag} if etag else {})
+                if r is not None and r.status_code == 200:
+                    etag = r.headers.get("ETag")
+                    names = [it["name"] for it in r.json()]
+                call("POST /api/realtime/session", "POST", "/api/realtime/session",
+                     json={"client_id": cid}, headers={"X-Client-Id": cid})
+                for _ in range(args.cart_ops):
+                    ops = [{"op": "add", "name": rnd.choice(names), "qty": rnd.randint(1, 2)}]
+                    cart_sent.append(time.perf_counter())
+                    call("POST /api/cart", "POST", "/api/cart", json={"client_id": cid, "ops": ops})
+                    if args.think_ms:
+                        time.sleep(args.think_ms / 1000.0)
+                call("GET /api/cart/state", "GET", "/api/cart/state", params={"client_id": cid})
+                for body in (
+                    {"to": 2},
+                    {"to": 3, "prefill": {"name": "Ana", "phone": "300 123 4567"}},
+                    {"to": 4, "prefill": {"email": "ana@example.com", "card": "4111 1111 1111 1111", "exp": "12/29", "cvv": "123"}},
+                ):
+                    status_sent[body["to"]] = time.perf_counter()
+                    call("POST /api/order_status/transition", "POST", "/api/order_status/transition", json={"client_id": cid, **body})
+                cart_sent.append(time.perf_counter())
+                call("POST /api/cart", "POST", "/api/cart", json={"client_id": cid, "ops": [{"op": "clear"}]})
+                status_sent[5] = time.perf_counter()
+                call("POST /api/order_status/transition", "POST", "/api/order_status/transition", json={"client_id": cid, "to": 5})
+        finally:
+            time.sleep(0.2)
+            sio.disconnect()
+
+    try:
+        rss_before = requests.get(url + "/api/state/stats", timeout=10).json().get("rss_bytes")
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.customers) as pool:
+            list(pool.map(customer, range(args.customers)))
+        elapsed = time.perf_counter() - t_start
+        rss_after = requests.get(url + "/api/state/stats", timeout=10).json().get("rss_bytes")
+        upstream = requests.get(f"http://127.0.0.1:{up_port}/stats", timeout=5).json()
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        httpd.shutdown()
+
+    http_requests = sum(len(v) for k, v in lat.items() if " /" in k)
+    report = {
+        "bench": "load",
+        "customers": args.customers,
+        "rounds": args.rounds,
+        "workers": args.workers,
+        "upstream_latency_ms": args.latency_ms,
+        "elapsed_s": round(elapsed, 2),
+        "http_requests": http_requests,
+        "throughput_rps": round(http_requests / elapsed, 1) if elapsed else None,
+        "rss_before_bytes": rss_before,
+        "rss_after_bytes": rss_after,
+        "upstream_requests": upstream["requests"],
+        "endpoints": {k: dict(summarize(v), errors=errors.get(k, 0)) for k, v in sorted(lat.items())},
+    }
+    print(json.dumps(report), flush=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    return report
+
+
+# ======================
+# search: consultas al índice invertido de search_menu (en proceso)
+# ======================
+
+def synthetic_menu(n, seed=7):
+    import random
+    rnd = random.Random(seed)
+    bases = ["Burger", "Chicken Sandwich", "Fish Taco", "Salad", "Pizza", "Wrap", "Soup", "Pie", "Nuggets", "Fries"]
+    adjs = ["Crispy", "Spicy", "Double", "Classic", "Smoked", "Garlic", "BBQ", "Vegan", "Mini", "Deluxe"]
+    ingr = ["cheese", "lettuce", "tomato", "onion", "bacon", "pickles", "mayo", "avocado", "rice", "beans",
+            "apple", "cinnamon", "chicken", "beef", "fish", "mushroom", "pepper", "corn", "egg", "ham"]
+    return [{
+        "name": f"{rnd.choice(adjs)} {rnd.choice(bases)} {i}",
+        "price": round(rnd.uniform(1, 20), 2),
+        "img_ref": "",
+        "ingredients": ", ".join(rnd.sample(ingr, 4)),
+        "description": f"{rnd.choice(adjs)} house special with {rnd.choice(ingr)} and {rnd.choice(ingr)}",
+    } for i in range(n)]
+
+
+def bench_search(args):
+    import app
+
+    queries = ["spicy chicken", "bacon cheese burger", "vegan", "pollo", "queso", "papas fritas",
+               "avoc", "something without match", "fish taco 42", "pie de manzana"]
+    for n in [int(x) for x in args.items.split(",")]:
+        menu = app.normalize_menu(synthetic_menu(n))
+        t0 = time.perf_counter()
+        index = app.build_search_index(menu)
+        build_ms = (time.perf_counter() - t0) * 1000
+        latencies = []
+        for i in range(args.queries):
+            q = queries[i % len(queries)]
+            t0 = time.perf_counter()
+            app.search_menu_index(index, q, 5)
+            latencies.append(time.perf_counter() - t0)
+        row = {
+            "bench": "search",
+            "items": n,
+            "vocab": len(index["vocab"]),
+            "build_ms": round(build_ms, 2),
+            "full_prompt_chars": len(app.build_menu_prompt(menu, compact=False)),
+            "compact_prompt_chars": len(app.build_menu_prompt(menu, compact=True)),
+            "p50_us": round(percentile(latencies, 50) * 1e6, 1),
+            "p95_us": round(percentile(latencies, 95) * 1e6, 1),
+            "p99_us": round(percentile(latencies, 99) * 1e6, 1),
+        }
+        print(json.dumps(row), flush=True)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Benchmarks del servidor (salida JSON por línea).")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    e = sub.add_parser("emit", help="latencia POST /api/cart -> cart_update con N workers")
+    e.add_argument("--mq", default=os.getenv("SOCKETIO_MESSAGE_QUEUE"), help="URL del broker (redis://...)")
+    e.add_argument("--workers", default="1,2,4")
+    e.add_argument("--clients", type=int, default=16)
+    e.add_argument("--rounds", type=int, default=50)
+    e.set_defaults(func=bench_emit)
+
+    se = sub.add_parser("session", help="latencia de /api/realtime/session contra fake_upstream.py")
+    se.add_argument("--requests", type=int, default=200)
+    se.add_argument("--concurrency", type=int, default=20)
+    se.add_argument("--latency-ms", type=float, default=100)
+    se.add_argument("--fail-rate", type=float, default=0.0)
+    se.add_argument("--max-concurrency", type=int, default=20, help="UPSTREAM_MAX_CONCURRENCY")
+    se.add_argument("--queue-max", type=int, default=50, help="UPSTREAM_QUEUE_MAX (sobrecarga: comparar 10 vs 100000)")
+    se.set_defaults(func=bench_session)
+
+    so = sub.add_parser("soak", help="RSS y conteos de estado con clientes nuevos continuamente")
+    so.add_argument("--duration", type=float, default=60)
+    so.add_argument("--sample-every", type=float, default=5)
+    so.add_argument("--max-clients", type=int, default=500)
+    so.add_argument("--idle-ttl", type=float, default=30)
+    so.add_argument("--reap-interval", type=float, default=2)
+    so.set_defaults(func=bench_soak)
+
+    ra = sub.add_parser("race", help="mutaciones concurrentes por cliente (lost updates, CAS, transiciones)")
+    ra.add_argument("--clients", type=int, default=4)
+    ra.add_argument("--ops", type=int, default=300, help="ops por cliente")
+    ra.add_argument("--transitions", type=int, default=20, help="transiciones simultáneas por cliente")
+    ra.add_argument("--concurrency", type=int, default=64)
+    ra.add_argument("--workers", type=int, default=1)
+    ra.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    ra.add_argument("--mq", default=os.getenv("SOCKETIO_MESSAGE_QUEUE"))
+    ra.set_defaults(func=bench_race)
+
+    tr = sub.add_parser("transition", help="microbenchmark de order_status/transition en proceso")
+    tr.add_argument("--iterations", type=int, default=20000)
+    tr.set_defaults(func=bench_transition)
+
+    lo = sub.add_parser("load", help="flujo completo de N clientes: latencias por endpoint, lag de eventos, RSS")
+    lo.add_argument("--customers", type=int, default=20)
+    lo.add_argument("--rounds", type=int, default=3, help="pedidos completos por cliente")
+    lo.add_argument("--cart-ops", type=int, default=5, help="POST /api/cart por pedido")
+    lo.add_argument("--think-ms", type=float, default=0)
+    lo.add_argument("--latency-ms", type=float, default=50, help="latencia del fake upstream")
+    lo.add_argument("--workers", type=int, default=1)
+    lo.add_argument("--mq", default=os.getenv("SOCKETIO_MESSAGE_QUEUE"))
+    lo.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="variables extra para el servidor")
+    lo.add_argument("--out", help="además escribir el reporte JSON en este archivo")
+    lo.set_defaults(func=bench_load)
+
+    im = sub.add_parser("images", help="miniaturas del menú con fixtures PNG locales (sin red) y tamaños de /assets")
+    im.add_argument("--images", type=int, default=20)
+    im.add_argument("--size", type=int, default=1200, help="ancho del PNG de origen")
+    im.set_defaults(func=bench_images)
+
+    ba = sub.add_parser("batch", help="POS con N mesas: llamadas sueltas vs POST /api/batch (latencia y eventos emitidos)")
+    ba.add_argument("--tables", type=int, default=50)
+    ba.add_argument("--rounds", type=int, default=20)
+    ba.set_defaults(func=bench_batch)
+
+    sr = sub.add_parser("search", help="latencia del índice de search_menu sobre menús sintéticos")
+    sr.add_argument("--items", default="100,1000,5000")
+    sr.add_argument("--queries", type=int, default=5000)
+    sr.set_defaults(func=bench_search)
+
+    args = p.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
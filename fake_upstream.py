@@ -0,0 +1,98 @@
+# fake_upstream.py — stand-in local de la API de sesiones Realtime
+#
+#   python fake_upstream.py --port 9100 --latency-ms 200
+#   OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=fake python app.py
+#
+# Responde POST /v1/realtime/sessions con una sesión efímera falsa y expone
+# GET /stats (requests, conexiones TCP abiertas, errores inyectados) para
+# comprobar el keep-alive del pool y el circuit breaker. --fail-rate y
+# --fail-status simulan un upstream degradado.
+
+import argparse, json, random, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATS = {"requests": 0, "connections": 0, "failures": 0}
+_lock = threading.Lock()
+
+
+def make_handler(opts):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with _lock:
+                STATS["connections"] += 1
+
+        def log_message(self, *_args):
+            pass
+
+        def _send(self, status, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with _lock:
+                    return self._send(200, dict(STATS))
+            self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b"{}"
+            if self.path.rstrip("/") != "/v1/realtime/sessions":
+                return self._send(404, {"error": "not found"})
+            with _lock:
+                STATS["requests"] += 1
+            if opts.latency_ms:
+                time.sleep(opts.latency_ms / 1000.0)
+            if opts.fail_rate and random.random() < opts.fail_rate:
+                with _lock:
+                    STATS["failures"] += 1
+                return self._send(opts.fail_status, {"error": {"message": "injected failure"}})
+            try:
+                req = json.loads(raw or b"{}")
+            except ValueError:
+                return self._send(400, {"error": {"message": "invalid json"}})
+            now = int(time.time())
+            self._send(200, {
+                "id": "sess_" + uuid.uuid4().hex[:16],
+                "object": "realtime.session",
+                "model": req.get("model"),
+                "voice": req.get("voice"),
+                "instructions_chars": len(req.get("instructions") or ""),
+                "tools": [t.get("name") for t in (req.get("tools") or [])],
+                "expires_at": now + opts.ttl,
+                "client_secret": {"value": "ek_" + uuid.uuid4().hex, "expires_at": now + opts.ttl},
+            })
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=9100, latency_ms=0, fail_rate=0.0, fail_status=503, ttl=60):
+    opts = argparse.Namespace(latency_ms=latency_ms, fail_rate=fail_rate, fail_status=fail_status, ttl=ttl)
+    httpd = ThreadingHTTPServer((host, port), make_handler(opts))
+    httpd.daemon_threads = True
+    return httpd
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Fake de POST /v1/realtime/sessions para pruebas locales.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=9100)
+    p.add_argument("--latency-ms", type=float, default=0)
+    p.add_argument("--fail-rate", type=float, default=0.0)
+    p.add_argument("--fail-status", type=int, default=503)
+    p.add_argument("--ttl", type=int, default=60, help="segundos de vida de la sesión efímera")
+    args = p.parse_args(argv)
+    httpd = serve(args.host, args.port, args.latency_ms, args.fail_rate, args.fail_status, args.ttl)
+    print(f"fake upstream en http://{args.host}:{args.port}/v1", flush=True)
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# import_menu.py — sube un CSV/JSONL grande a /api/menu/import en streaming
+#
+#   python import_menu.py catalogo.csv --dry-run
+#   python import_menu.py catalogo.jsonl --mode merge --url http://localhost:8080
+#
+# El archivo se envía en trozos (Transfer-Encoding: chunked) y el servidor
+# lo procesa fila a fila, así que ni el cliente ni el servidor cargan el
+# catálogo completo en memoria. Imprime el reporte JSON del servidor.
+
+import argparse, json, sys
+
+import requests
+
+CHUNK = 64 * 1024
+
+
+def iter_file(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Importa un menú CSV/JSONL vía /api/menu/import.")
+    p.add_argument("path")
+    p.add_argument("--url", default="http://localhost:8080")
+    p.add_argument("--format", choices=["csv", "jsonl"], help="por defecto según la extensión")
+    p.add_argument("--mode", choices=["replace", "merge"], default="replace")
+    p.add_argument("--dry-run", action="store_true", help="solo mostrar el diff")
+    p.add_argument("--strict", action="store_true", help="no aplicar si hay filas inválidas")
+    args = p.parse_args(argv)
+
+    fmt = args.format or ("jsonl" if args.path.lower().endswith((".jsonl", ".ndjson")) else "csv")
+    params = {"format": fmt, "mode": args.mode}
+    if args.dry_run:
+        params["dry_run"] = "1"
+    if args.strict:
+        params["strict"] = "1"
+    ctype = "application/x-ndjson" if fmt == "jsonl" else "text/csv"
+    r = requests.post(args.url.rstrip("/") + "/api/menu/import", params=params,
+                      data=iter_file(args.path), headers={"Content-Type": ctype}, timeout=600)
+    try:
+        report = r.json()
+    except ValueError:
+        sys.exit(f"HTTP {r.status_code}: {r.text[:500]}")
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if r.status_code >= 400 or report.get("error_count"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# serve.py — lanzador multi-worker (pre-fork) para app.py
+#
+#   STATE_BACKEND=sqlite SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0 \
+#       python serve.py --workers 4 --port 8080
+#
+# El proceso padre abre el socket de escucha y hace fork de N workers
+# eventlet que aceptan sobre el mismo socket. app.js usa solo transporte
+# websocket, así que no hace falta sticky session: cualquier worker puede
+# atender cualquier conexión. El estado compartido (STATE_BACKEND=sqlite) y
+# el bus de Socket.IO (SOCKETIO_MESSAGE_QUEUE) son obligatorios con N > 1.
+
+import argparse, logging, os, signal, sys, time
+
+import eventlet
+import eventlet.wsgi
+
+log = logging.getLogger("serve")
+
+
+def run_worker(sock, idx):
+    import app as server  # monkey_patch + estado se inicializan dentro del worker
+    server.log.info("[serve] worker %s pid=%s", idx, os.getpid())
+    eventlet.wsgi.server(sock, server.app, log_output=False)
+
+
+def check_env(workers):
+    if workers <= 1:
+        return
+    problems = []
+    if (os.getenv("STATE_BACKEND") or "memory").strip().lower() == "memory":
+        problems.append("STATE_BACKEND=sqlite (el estado en memoria no se comparte entre workers)")
+    if not os.getenv("SOCKETIO_MESSAGE_QUEUE"):
+        problems.append("SOCKETIO_MESSAGE_QUEUE=redis://... (los emits no cruzarían de worker)")
+    if problems:
+        sys.exit("serve.py con --workers > 1 requiere:\n  - " + "\n  - ".join(problems))
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    p = argparse.ArgumentParser(description="Lanza app.py con varios workers eventlet.")
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    p.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)))
+    args = p.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    check_env(args.workers)
+
+    sock = eventlet.listen((args.host, args.port))
+    children = {}
+    stopping = False
+
+    def spawn(idx):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(sock, idx)
+            finally:
+                os._exit(0)
+        children[pid] = idx
+
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(args.workers):
+        spawn(i)
+    log.info("[serve] %s worker(s) en %s:%s", args.workers, args.host, args.port)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        idx = children.pop(pid, None)
+        if idx is None or stopping:
+            continue
+        log.warning("[serve] worker %s (pid=%s) terminó con %s; relanzando", idx, pid, status)
+        time.sleep(0.5)
+        spawn(idx)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@
    ======================= */
 var data = [];
 var cart = [];                // Carrito local (refleja backend)
+var cartVersion = 0;          // versión del carrito en backend (deltas)
+var cartEpoch = null;         // instancia del carrito en backend; cambia si el server lo recrea
 var selectedQty = 1;          // Qty seleccionada (1–99)
 var CLIENT_ID = getOrCreateClientId();
 var currentOrderStatus = 0;   // estado sincronizado con backend (0..5)
@@ -40,10 +42,25 @@ function normalize(s){ return (s||"").trim().toLowerCase(); }
 /* =======================
    Menú: fetch + render
    ======================= */
+var menuEtag = null;           // ETag del menú cargado (GET condicional)
+
 async function fetchMenu(){
+  var cached = null;
+  try{ cached = JSON.parse(localStorage.getItem("menu_cache" + API_BASE)||"null"); }catch(_e){}
   try{
-    var res = await fetch(API_MENU);
-    data = await res.json();
+    var headers = {};
+    if(cached && cached.etag && Array.isArray(cached.data)) headers["If-None-Match"] = cached.etag;
+    var res = await fetch(API_MENU, { headers: headers });
+    if(res.status === 304){
+      data = cached.data;
+      menuEtag = cached.etag;
+    }else{
+      data = await res.json();
+      menuEtag = res.headers.get("ETag");
+      if(menuEtag){
+        try{ localStorage.setItem("menu_cache" + API_BASE, JSON.stringify({ etag: menuEtag, generation: Number(res.headers.get("X-Menu-Generation"))||0, data: data })); }catch(_e2){}
+      }
+    }
     localStorage.setItem("menu_data", JSON.stringify(data));
   }catch(e){
     try{ data = JSON.parse(localStorage.getItem("menu_data")||"[]"); }catch(_e){ data = []; }
@@ -59,6 +76,19 @@ function getMenuItemByName(name){
   return null;
 }
 
+/* Miniatura servida por el backend (/img/...) si el menú la trae; si no, la imagen original */
+function imgSrc(item, w){
+  if(item && item.thumb) return API_BASE + item.thumb + "?w=" + w;
+  return (item && item.img_ref) || "";
+}
+/* Si el backend no tiene la miniatura (404), el navegador carga el original (data-fallback) */
+document.addEventListener("error", function(ev){
+  var el = ev.target;
+  if(el && el.tagName === "IMG" && el.dataset && el.dataset.fallback && el.getAttribute("src") !== el.dataset.fallback){
+    el.src = el.dataset.fallback;
+  }
+}, true);
+
 /* =======================
    GRID (todos los items)
    ======================= */
@@ -74,7 +104,8 @@ function renderGrid(){
 
     var img = document.createElement("img");
     img.className = "grid-thumb";
-    img.src = item.img_ref || "";
+    img.dataset.fallback = item.img_ref || "";
+    img.src = imgSrc(item, 320);
     img.alt = item.name || "";
 
     var info = document.createElement("div");
@@ -125,7 +156,7 @@ function renderDetail(item){
   var descEl = byId("detailDesc");
   var ingrEl = byId("detailIngr");
 
-  if(img){ img.src = item.img_ref || ""; img.alt = item.name || ""; }
+  if(img){ img.dataset.fallback = item.img_ref || ""; img.src = imgSrc(item, 640); img.alt = item.name || ""; }
   if(nameEl) nameEl.textContent = item.name || "";
   if(priceEl) priceEl.textContent = "Precio: $" + Number(item.price||0).toFixed(2);
   if(descEl) descEl.textContent = item.description || "";
@@ -148,12 +179,6 @@ function clampQty(q){
   if (q > 99) return 99;
   return q;
 }
-function clampQtyAllowZero(q){
-  q = parseInt(q, 10);
-  if (isNaN(q) || q < 0) return 0;
-  if (q > 99) return 99;
-  return q;
-}
 function updateQtyDisplay(){
   var el = byId("qtyDisplay");
   if (el) el.textContent = String(selectedQty);
@@ -228,23 +253,85 @@ function sanitizeCart(list){
   }
   return out;
 }
-function replaceCart(newCart){
-  cart = sanitizeCart(newCart);
+function cartChanged(){
   try{ localStorage.setItem("cart", JSON.stringify(cart)); }catch(_e){}
   updateCartBadge();
   renderCart();
 
   if(isSelectedInCart()) setAddedAddBtn(); else setDefaultAddBtn();
 }
+function replaceCart(newCart, version, epoch){
+  cart = sanitizeCart(newCart);
+  if(typeof version === "number") cartVersion = version;
+  if(epoch !== undefined) cartEpoch = epoch;
+  cartChanged();
+}
+/* Epoch nuevo = carrito recreado en el server (p.ej. expulsado por inactividad):
+   sus versiones arrancan de 0, así que se descarta la versión local. */
+function adoptCartEpoch(epoch){
+  if(epoch === undefined || epoch === null || epoch === cartEpoch) return false;
+  var known = cartEpoch !== null;
+  cartEpoch = epoch; cartVersion = 0;
+  if(known) cart = [];
+  return true;
+}
+function findCartIdx(name){
+  var k = normalize(name);
+  for(var i=0;i<cart.length;i++){ if(normalize(cart[i].name)===k) return i; }
+  return -1;
+}
+/* Deltas del backend: put (línea nueva/actualizada), qty, del, clear */
+function applyCartDeltas(deltas, version){
+  for(var i=0;i<deltas.length;i++){
+    var d = deltas[i] || {};
+    if(typeof d.v === "number" && d.v <= cartVersion) continue;
+    if(d.t === "clear"){ cart = []; }
+    else if(d.t === "put" && d.line){
+      var line = sanitizeCart([d.line])[0];
+      var ip = findCartIdx(d.line.name);
+      if(!line){ if(ip>=0) cart.splice(ip,1); }
+      else if(ip>=0){ cart[ip] = line; } else { cart.push(line); }
+    }
+    else if(d.t === "qty"){
+      var iq = findCartIdx(d.name);
+      if(iq>=0) cart[iq].qty = Number(d.qty)||0;
+    }
+    else if(d.t === "del"){
+      var id = findCartIdx(d.name);
+      if(id>=0) cart.splice(id,1);
+    }
+  }
+  if(typeof version === "number") cartVersion = version;
+  cartChanged();
+}
+function cartDeltasAddItems(deltas){
+  for(var i=0;i<deltas.length;i++){
+    var d = deltas[i] || {};
+    if(d.t === "put") return true;
+    if(d.t === "qty"){
+      var idx = findCartIdx(d.name);
+      if(idx < 0 || Number(d.qty) > Number(cart[idx].qty||0)) return true;
+    }
+  }
+  return false;
+}
+/* Respuesta de /api/cart/state: deltas desde `since` o snapshot completo */
+function applyCartState(j){
+  if(Array.isArray(j.deltas) && j.epoch === cartEpoch){ applyCartDeltas(j.deltas, j.version); }
+  else { replaceCart(j.cart || [], j.version, j.epoch); }
+}
 async function syncCartFromBackend(){
   try{
-    var res = await fetch("/api/cart/state?client_id="+encodeURIComponent(CLIENT_ID));
+    var url = API_BASE + "/api/cart/state?client_id="+encodeURIComponent(CLIENT_ID);
+    if(cartVersion > 0 && cartEpoch !== null) url += "&since="+cartVersion+"&epoch="+encodeURIComponent(cartEpoch);
+    var res = await fetch(url);
     var j = await res.json();
     if(j && j.ok && j.client_id === CLIENT_ID){
-      replaceCart(j.cart || []);
+      applyCartState(j);
       currentOrderStatus = typeof j.order_status === "number" ? j.order_status : currentOrderStatus;
     }
-  }catch(_e){}
+    return j;
+  }catch(_e){ return null; }
 }
 function updateCartBadge(){
   var n = cart.reduce(function(acc, it){ return acc + (Number(it.qty)||0); }, 0);
@@ -275,7 +362,7 @@ function renderCart(){
     var li = document.createElement("li");
     li.className = "cart-item";
     li.innerHTML =
-      '<div class="cart-item-img">'+(it.img_ref ? '<img src="'+it.img_ref+'" alt="'+it.name+'">' : "")+'</div>'+
+      '<div class="cart-item-img">'+(it.img_ref ? '<img src="'+imgSrc(getMenuItemByName(it.name) || it, 160)+'" data-fallback="'+it.img_ref+'" alt="'+it.name+'">' : "")+'</div>'+
       '<div class="cart-item-info">'+
         '<div class="cart-item-name">'+it.name+'</div>'+
         '<div class="cart-item-meta">Cantidad: <b>'+qty+'</b> · $'+unit.toFixed(2)+' c/u · Subtotal: <b>$'+line.toFixed(2)+'</b></div>'+
@@ -350,11 +437,16 @@ function setUpSettingsModal(){
    ======================= */
 async function sendCartOps(ops){
   try{
-    await fetch("/api/cart", {
+    var res = await fetch(API_BASE + "/api/cart", {
       method: "POST",
       headers: {"Content-Type":"application/json"},
       body: JSON.stringify({ client_id: CLIENT_ID, ops: ops })
     });
+    var j = await res.json();
+    // Versión hacia atrás o epoch nuevo: el cart_update se descartaría, tomar la respuesta
+    if(j && j.ok && j.client_id === CLIENT_ID && (j.epoch !== cartEpoch || j.version < cartVersion)){
+      replaceCart(j.cart || [], j.version, j.epoch);
+    }
     var toShow = extractAddedNames(ops);
     if(toShow.length){ await recommendNames(toShow); }
   }catch(_e){}
@@ -376,19 +468,19 @@ function extractAddedNames(ops){
 async function recommendNames(names){
   if(!names || !names.length) return;
   try{
-    await fetch("/api/recommend", {
+    await fetch(API_BASE + "/api/recommend", {
       method: "POST",
       headers: {"Content-Type":"application/json"},
-      body: JSON.stringify({ names: names })
+      body: JSON.stringify({ client_id: CLIENT_ID, names: names })
     });
   }catch(_e){}
 }
 async function recommendReset(){
   try{
-    await fetch("/api/recommend", {
+    await fetch(API_BASE + "/api/recommend", {
       method: "POST",
       headers: {"Content-Type":"application/json"},
-      body: JSON.stringify({ reset: true })
+      body: JSON.stringify({ client_id: CLIENT_ID, reset: true })
     });
   }catch(_e){}
 }
@@ -398,7 +490,7 @@ async function recommendReset(){
    ======================= */
 var socket = null;
 if (typeof window !== "undefined" && typeof window.io === "function") {
-  socket = window.io({ transports: ["websocket"], path: "/socket.io" });
+  socket = window.io({ transports: ["websocket"], path: API_BASE + "/socket.io" });
 } else { socket = { on: function(){}, emit: function(){} }; }
 
 socket.on("connect", function(){
@@ -406,7 +498,14 @@ socket.on("connect", function(){
 });
 
 /* update_front -> ahora selecciona (simula clic) */
+function clearRecommendation(){
+  selectedName = null;
+  var panel = byId("detailPanel"); if(panel){ panel.setAttribute("aria-hidden","true"); }
+  renderGrid();
+  setDefaultAddBtn();
+}
 socket.on("recommend", function(payload){
+  if(payload && payload.client_id && payload.client_id !== CLIENT_ID) return;
   var names = []; if(payload && Array.isArray(payload.names)) names = payload.names;
   if(names.length){
     var chosen = null;
@@ -416,89 +515,47 @@ socket.on("recommend", function(payload){
     }
     if(chosen){ selectItem(chosen, true); }
   }else{
-    selectedName = null;
-    var panel = byId("detailPanel"); if(panel){ panel.setAttribute("aria-hidden","true"); }
-    renderGrid();
-    setDefaultAddBtn();
+    clearRecommendation();
   }
 });
+socket.on("reset", function(payload){
+  if(payload && payload.client_id && payload.client_id !== CLIENT_ID) return;
+  clearRecommendation();
+});
 
-/* Cart desde server — abrir carrito cuando hay ADD/SET>0 */
+/* Cart desde server (deltas versionados) — abrir carrito cuando se agregan ítems */
 socket.on("cart_update", function(payload){
-  if(payload && payload.client_id && payload.client_id !== CLIENT_ID) return;
+  if(!payload) return;
+  if(payload.client_id && payload.client_id !== CLIENT_ID) return;
+  adoptCartEpoch(payload.epoch);
+  if(typeof payload.version === "number" && payload.version <= cartVersion) return; // ya aplicado
 
   var openBecauseAdd = false;
-  var ops = (payload && Array.isArray(payload.ops)) ? payload.ops : [];
-
-  for(var i=0;i<ops.length;i++){
-    var op = ops[i] || {};
-    var kind = String(op.op||"").toLowerCase();
-    var q = parseInt(op.qty,10);
-    if(isNaN(q)) q = 0;
-    if(kind === "add" && q > 0) openBecauseAdd = true;
-    if(kind === "set" && q > 0) openBecauseAdd = true;
+  if(Array.isArray(payload.deltas)){
+    // Hueco de versiones (evento perdido/reconexión): pedir solo lo que falta
+    if(payload.base !== cartVersion){ syncCartFromBackend(); return; }
+    openBecauseAdd = cartDeltasAddItems(payload.deltas);
+    applyCartDeltas(payload.deltas, payload.version);
+  } else if(Array.isArray(payload.cart)){
+    replaceCart(payload.cart, payload.version);
   }
 
-  if(payload && Array.isArray(payload.cart)){ replaceCart(payload.cart); }
-  else { applyCartOpsFromServer(ops); }
-
   if(openBecauseAdd){ openCart(); } // mantener abierto si ya estaba
 });
 
+/* Menú cambiado en backend: refetch solo si el ETag es otro */
+socket.on("menu_updated", async function(payload){
+  if(payload && payload.etag && menuEtag && ('"'+payload.etag+'"') === menuEtag) return;
+  await fetchMenu();
+  renderGrid();
+});
+
 /* Orquestación por estado */
 socket.on("order_status", function(payload){
   if(!payload || payload.client_id !== CLIENT_ID) return;
   applyOrderStatusUpdate(payload);
 });
 
-/* aplicar ops locales si llegan por socket (fallback) */
-function applyCartOpsFromServer(ops){
-  for(var i=0;i<ops.length;i++){
-    var op = ops[i] || {};
-    var kind = String(op.op || "").toLowerCase();
-    if(kind === "clear"){ cart = []; continue; }
-    var name = op && op.name ? op.name : "";
-    if(!name && kind !== "clear") continue;
-
-    if(kind === "add"){
-      var qAdd = clampQty(op && op.qty ? op.qty : 1);
-      var miA = getMenuItemByName(name);
-      if(miA){
-        var found=false;
-        for(var j=0;j<cart.length;j++){
-          if(normalize(cart[j].name)===normalize(miA.name)){ cart[j].qty = (cart[j].qty||0)+qAdd; found=true; break; }
-        }
-        if(!found) cart.push({ name: miA.name, price: Number(miA.price||0), img_ref: miA.img_ref||"", qty: qAdd });
-      }
-    } else if(kind === "remove"){
-      var qRem = clampQty(op && op.qty ? op.qty : 1);
-      for(var k=0;k<cart.length;k++){
-        if(normalize(cart[k].name)===normalize(name)){
-          var cur = Number(cart[k].qty||1);
-          if(cur <= qRem){ cart.splice(k,1); } else { cart[k].qty = cur - qRem; }
-          break;
-        }
-      }
-    } else if(kind === "set"){
-      var qSet = clampQtyAllowZero(op && op.qty != null ? op.qty : 1);
-      var idx = -1;
-      for(var kk=0;kk<cart.length;kk++){ if(normalize(cart[kk].name)===normalize(name)){ idx=kk; break; } }
-      if(qSet <= 0){ if(idx>=0) cart.splice(idx,1); }
-      else{
-        var mi = getMenuItemByName(name);
-        if(mi){
-          if(idx>=0){ cart[idx].qty = qSet; }
-          else{ cart.push({ name: mi.name, price: Number(mi.price||0), img_ref: mi.img_ref||"", qty: qSet }); }
-        }
-      }
-    }
-  }
-  try{ localStorage.setItem("cart", JSON.stringify(cart)); }catch(_e){}
-  updateCartBadge();
-  renderCart();
-  if(isSelectedInCart()) setAddedAddBtn(); else setDefaultAddBtn();
-}
-
 /* =======================
    Realtime + tools
    ======================= */
@@ -548,17 +605,79 @@ function startGreetingTurn(){
   });
 }
 
+/* Tools resueltas en el servidor: un evento `tool_call` con ack por llamada.
+   Si el socket no está conectado se usa el camino HTTP de abajo. */
+var SERVER_TOOLS = { update_front:1, update_cart:1, get_cart:1, get_order_status:1, transition_order_status:1, search_menu:1, suggest_items:1 };
+var ORDER_STATUS_REPLIES = {0:"Tu carrito está vacío.",1:"Tienes artículos en el carrito.",2:"Tienes el carrito abierto.",3:"Estamos en checkout. Necesito los datos del formulario",4:"Datos completos, puedes finalizar.",5:"Mostrando confirmación de pedido."};
+
+function replyOf(args){
+  return (args && typeof args.reply==="string" && args.reply.trim().length>0) ? args.reply.trim() : "";
+}
+function cartReplyDefault(total){
+  if(!cart.length) return "Tu carrito está vacío por ahora.";
+  var c = cart.reduce(function(a, it){ return a + (Number(it.qty)||0); }, 0);
+  return "Tienes " + c + " artículo" + (c>1?"s":"") + ", total $" + total.toFixed(2) + ".";
+}
+
+// undefined = sin socket (usar HTTP); si no, el resultado del ack.
+function socketToolCall(name, args){
+  return new Promise(function(resolve){
+    if(!socket || !socket.connected || typeof socket.timeout !== "function"){ resolve(undefined); return; }
+    socket.timeout(10000).emit("tool_call", { client_id: CLIENT_ID, name: name, args: args || {} }, function(err, res){
+      resolve(err ? { ok:false, error:"timeout" } : res);
+    });
+  });
+}
+
+function finishServerTool(name, callId, args, res){
+  var reply = replyOf(args);
+  res = res || { ok:false, error:"empty response" };
+  if(name === "update_cart"){
+    var cleared = res.action === "clear";
+    sendFunctionResult(callId, res, reply || (res.ok ? (cleared ? "Listo, vacié tu carrito." : "Listo, actualicé tu carrito.") : ""));
+    return;
+  }
+  if(name === "get_cart"){
+    if(res.ok && res.client_id === CLIENT_ID){
+      applyCartState(res);
+      if(typeof res.order_status === "number") currentOrderStatus = res.order_status;
+      sendFunctionResult(callId, { ok:true, client_id: res.client_id, cart: cart, total: res.total }, cartReplyDefault(res.total));
+    } else {
+      sendFunctionResult(callId, { ok:false, error:"No se pudo obtener el carrito." }, "No pude obtener tu carrito ahora mismo.");
+    }
+    return;
+  }
+  if(name === "get_order_status"){
+    if(res.ok && typeof res.status === "number"){
+      currentOrderStatus = res.status;
+      sendFunctionResult(callId, res, reply || (ORDER_STATUS_REPLIES[res.status] || ("Estado actual: " + res.status)));
+    } else {
+      sendFunctionResult(callId, res, reply || "No pude obtener el estado ahora mismo.");
+    }
+    return;
+  }
+  sendFunctionResult(callId, res, reply);
+}
+
 async function handleToolCall(evt){
   var meta = getToolMeta(evt);
   var name = meta.name, callId = meta.callId;
   if(!callId){ console.warn("[toolcall:missing_call_id]", { name: name, evt: evt && evt.type }); return; }
 
+  if(SERVER_TOOLS[name]){
+    var sargs = {};
+    for(var k in (meta.args || {})){ if(meta.args.hasOwnProperty(k)) sargs[k] = meta.args[k]; }
+    if(name === "transition_order_status"){ sargs.from = currentOrderStatus; }
+    var sres = await socketToolCall(name, sargs);
+    if(sres !== undefined){ finishServerTool(name, callId, sargs, sres); return; }
+  }
+
   if(name === "update_front"){
     var parsed = meta.args || {};
     var names = Array.isArray(parsed.names) ? parsed.names : [];
     var reply = (typeof parsed.reply==="string" && parsed.reply.trim().length>0) ? parsed.reply.trim() : "";
     try{
-      await fetch("/api/recommend", { method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify({ names: names }) });
+      await fetch(API_BASE + "/api/recommend", { method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify({ client_id: CLIENT_ID, names: names }) });
     }catch(_e){}
     sendFunctionResult(callId, { ok:true, names:names }, reply || "");
     return;
@@ -571,13 +690,13 @@ async function handleToolCall(evt){
     var reply2 = (typeof parsed2.reply==="string" && parsed2.reply.trim().length>0) ? parsed2.reply.trim() : "";
 
     if(action === "clear"){
-      try{ await fetch("/api/cart", { method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify({ client_id: CLIENT_ID, ops: [{ op:"clear" }] }) }); }catch(_e4){}
+      try{ await fetch(API_BASE + "/api/cart", { method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify({ client_id: CLIENT_ID, ops: [{ op:"clear" }] }) }); }catch(_e4){}
       await recommendReset();
       sendFunctionResult(callId, { ok:true, action:"clear" }, reply2 || "Listo, vacié tu carrito.");
       return;
     }
 
-    try{ await fetch("/api/cart", { method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify({ client_id: CLIENT_ID, ops: ops }) }); }catch(_e5){}
+    try{ await fetch(API_BASE + "/api/cart", { method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify({ client_id: CLIENT_ID, ops: ops }) }); }catch(_e5){}
     var toShow = extractAddedNames(ops);
     if(toShow.length){ await recommendNames(toShow); }
     sendFunctionResult(callId, { ok:true, action:"apply", applied: ops.length }, reply2 || "Listo, actualicé tu carrito.");
@@ -587,18 +706,12 @@ async function handleToolCall(evt){
   if (name === "get_cart" || name === ""){
     try {
       var cid3 = CLIENT_ID;
-      var res3 = await fetch("/api/cart/state?client_id=" + encodeURIComponent(cid3));
-      var j3 = await res3.json();
+      var j3 = await syncCartFromBackend();
 
       if (j3 && j3.ok && j3.client_id === CLIENT_ID) {
-        replaceCart(j3.cart || []);
         var total3 = (typeof j3.total === "number") ? j3.total :
                      cart.reduce(function(acc, it){ return acc + Number(it.price||0)*Number(it.qty||1); }, 0);
-        var shortDefault = (!cart.length) ? "Tu carrito está vacío por ahora."
-                           : (function(){ var c = cart.reduce(function(a, it){ return a + (Number(it.qty)||0); }, 0);
-                                          return "Tienes " + c + " artículo" + (c>1?"s":"") + ", total $" + total3.toFixed(2) + "."; })();
-
-        sendFunctionResult(callId, { ok:true, client_id: cid3, cart: j3.cart || [], total: total3 }, shortDefault);
+        sendFunctionResult(callId, { ok:true, client_id: cid3, cart: cart, total: total3 }, cartReplyDefault(total3));
       } else {
         sendFunctionResult(callId, { ok:false, error:"No se pudo obtener el carrito." }, "No pude obtener tu carrito ahora mismo.");
       }
@@ -608,17 +721,39 @@ async function handleToolCall(evt){
     return;
   }
 
+  if (name === "search_menu") {
+    var argsS = meta.args || {};
+    var q = String(argsS.query || "").trim();
+    try {
+      var resS = await fetch(API_BASE + "/api/menu/search?q=" + encodeURIComponent(q) + "&limit=" + encodeURIComponent(argsS.limit || 5));
+      var jS = await resS.json();
+      sendFunctionResult(callId, jS, "");
+    } catch (e) {
+      sendFunctionResult(callId, { ok:false, error:String(e && e.message || e) }, "");
+    }
+    return;
+  }
+
+  if (name === "suggest_items") {
+    try {
+      var resSg = await fetch(API_BASE + "/api/menu/suggest?client_id=" + encodeURIComponent(CLIENT_ID) + "&limit=" + encodeURIComponent((meta.args || {}).limit || 3));
+      sendFunctionResult(callId, await resSg.json(), "");
+    } catch (e) {
+      sendFunctionResult(callId, { ok:false, error:String(e && e.message || e) }, "");
+    }
+    return;
+  }
+
   if (name === "get_order_status") {
     var args = meta.args || {};
     var replyG = (typeof args.reply==="string" && args.reply.trim().length>0) ? args.reply.trim() : "";
     try{
-      var resG = await fetch("/api/order_status?client_id=" + encodeURIComponent(CLIENT_ID));
+      var resG = await fetch(API_BASE + "/api/order_status?client_id=" + encodeURIComponent(CLIENT_ID));
       var jG = await resG.json();
       var st = (jG && jG.ok) ? jG.status : null;
       if (typeof st === "number") {
         currentOrderStatus = st;
-        var m = {0:"Tu carrito está vacío.",1:"Tienes artículos en el carrito.",2:"Tienes el carrito abierto.",3:"Estamos en checkout. Necesito los datos del formulario",4:"Datos completos, puedes finalizar.",5:"Mostrando confirmación de pedido."};
-        sendFunctionResult(callId, { ok:true, status: st }, replyG || (m[st] || ("Estado actual: " + st)));
+        sendFunctionResult(callId, { ok:true, status: st }, replyG || (ORDER_STATUS_REPLIES[st] || ("Estado actual: " + st)));
       } else {
         sendFunctionResult(callId, { ok:false, error:"No status" }, replyG || "No pude obtener el estado ahora mismo.");
       }
@@ -640,7 +775,7 @@ async function handleToolCall(evt){
       var body = { client_id: CLIENT_ID, from: currentOrderStatus, to: to };
       if (prefill) body.prefill = prefill;
 
-      var resT = await fetch("/api/order_status/transition", {
+      var resT = await fetch(API_BASE + "/api/order_status/transition", {
         method: "POST", headers: {"Content-Type":"application/json"}, body: JSON.stringify(body)
       });
       var jT = await resT.json();
@@ -682,7 +817,7 @@ function openCheckout(preserve){
       var li = document.createElement("li");
       li.className = "cart-item";
       li.innerHTML =
-        '<div class="cart-item-img">'+(it.img_ref ? '<img src="'+it.img_ref+'" alt="'+it.name+'">' : "")+'</div>'+
+        '<div class="cart-item-img">'+(it.img_ref ? '<img src="'+imgSrc(getMenuItemByName(it.name) || it, 160)+'" data-fallback="'+it.img_ref+'" alt="'+it.name+'">' : "")+'</div>'+
         '<div class="cart-item-info">'+
           '<div class="cart-item-name">'+it.name+'</div>'+
           '<div class="cart-item-meta">Cantidad: <b>'+qty+'</b> · $'+price.toFixed(2)+' c/u · Subtotal: <b>$'+line.toFixed(2)+'</b></div>'+
@@ -846,7 +981,7 @@ async function requestTransition(to, prefill){
   try{
     var body = { client_id: CLIENT_ID, from: currentOrderStatus, to: to };
     if(prefill){ body.prefill = prefill; }
-    var res = await fetch("/api/order_status/transition", {
+    var res = await fetch(API_BASE + "/api/order_status/transition", {
       method: "POST", headers: {"Content-Type":"application/json"}, body: JSON.stringify(body)
     });
     var j = await res.json();
@@ -886,7 +1021,7 @@ async function requestTransition(to, prefill){
 async function startRealtime(){
   await syncCartFromBackend();
 
-  var url = "/api/realtime/session?client_id=" + encodeURIComponent(CLIENT_ID);
+  var url = API_BASE + "/api/realtime/session?client_id=" + encodeURIComponent(CLIENT_ID);
   var res = await fetch(url, {
     method:"POST",
     headers:{ "Content-Type":"application/json", "X-Client-Id": CLIENT_ID },
@@ -897,6 +1032,8 @@ async function startRealtime(){
 
   var EPHEMERAL_KEY = (sess.client_secret && sess.client_secret.value) || sess.value || null;
   if(!EPHEMERAL_KEY){ alert("No ephemeral key received"); return; }
+  // Sesión del pool caliente: el contexto (carrito/estado) llega aparte
+  var sessionUpdate = sess.session_update || null;
 
   var pcLocal = new RTCPeerConnection(); pc = pcLocal;
   if(!remoteAudio){ remoteAudio = new Audio(); remoteAudio.autoplay = true; }
@@ -906,7 +1043,10 @@ async function startRealtime(){
   ms.getTracks().forEach(function(t){ pc.addTrack(t, ms); });
 
   dataChannel = pc.createDataChannel("oai-events");
-  dataChannel.onopen = function(){ startGreetingTurn(); };
+  dataChannel.onopen = function(){
+    if(sessionUpdate){ dcSend({ type: "session.update", session: sessionUpdate }); }
+    startGreetingTurn();
+  };
   dataChannel.onmessage = function(e){ handleIncomingEvent(e.data); };
 
   var offer = await pc.createOffer();
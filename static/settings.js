@@ -3,9 +3,21 @@ let data = [];
 const tableBody = () => document.querySelector("#menuTable tbody");
 
 async function fetchMenu(){
+  let cached = null;
+  try{ cached = JSON.parse(localStorage.getItem("menu_cache" + API_BASE)||"null"); }catch(_e){}
   try{
-    const res = await fetch(API_MENU);
-    data = await res.json();
+    const headers = {};
+    if(cached && cached.etag && Array.isArray(cached.data)) headers["If-None-Match"] = cached.etag;
+    const res = await fetch(API_MENU, { headers });
+    if(res.status === 304){
+      data = JSON.parse(JSON.stringify(cached.data));
+    }else{
+      data = await res.json();
+      const etag = res.headers.get("ETag");
+      if(etag){
+        try{ localStorage.setItem("menu_cache" + API_BASE, JSON.stringify({ etag, generation: Number(res.headers.get("X-Menu-Generation"))||0, data })); }catch(_e){}
+      }
+    }
   }catch(e){
     data = JSON.parse(localStorage.getItem("menu_data")||"[]");
   }